@@ -0,0 +1,255 @@
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import tempfile
+import threading
+import time
+from functools import partial
+import dmg_fakesession
+from dmg_fakesession import FakeSession,newFeature
+from sartopo_bg import sartopo_bg
+
+# offline benchmark for the debrief map generator
+#
+# a synthetic incident is loaded into an in-memory source map (see dmg_fakesession.py), then
+#  sartopo_bg is started against it and an empty in-memory target map, with a simulated
+#  latency for every target map write:
+#   1. cold start - time for sartopo_bg to import everything that is already on the source map
+#   2. live phase - some of the tracks grow (as AppTracks do), a few features are edited, and
+#       new clues are added; for each source map event, the time from the change on the
+#       source map to the end of its handling is recorded
+#  then the report gives cold start time, per-event latency percentiles, and target map write counts
+#
+# usage example:
+#   python dmg_bench.py --assignments 40 --tracks 3 --vertices 2000 --live-tracks 10 --latency 0.02
+
+sourceMapID='BENCHSRC'
+targetMapID='BENCHTGT'
+
+def assignmentLetters(i):
+    return chr(65+(i//26)%26)+chr(65+i%26)
+
+# randomWalk - track that starts outside the square (at the 'trailhead') and then wanders
+#  around inside it, occasionally leaving it; vertices are [lon,lat,ele,time]
+def randomWalk(rng,x0,y0,size,n,t0):
+    coords=[]
+    x=x0-size*0.5
+    y=y0-size*0.5
+    step=size/40
+    t=t0
+    for i in range(n):
+        # head toward a point that moves around the square, with some noise
+        (tx,ty)=(x0+size*(0.5+0.45*math.sin(i/50.0)),y0+size*(0.5+0.45*math.cos(i/73.0)))
+        d=math.hypot(tx-x,ty-y) or 1
+        x+=step*((tx-x)/d+rng.uniform(-0.8,0.8))
+        y+=step*((ty-y)/d+rng.uniform(-0.8,0.8))
+        t+=rng.randint(5000,15000)
+        coords.append([round(x,6),round(y,6),1500+rng.randint(0,200),t])
+    return coords
+
+# generateIncident - return the list of source map features for a synthetic incident:
+#  one assignment per team, tracksPerTeam tracks ('AA101a', 'AA101b', ...) per team, and
+#  clues and markers scattered around the assignments
+def generateIncident(assignments=20,tracksPerTeam=3,vertices=500,clues=20,markers=5,seed=0):
+    rng=random.Random(seed)
+    features=[]
+    cols=max(1,int(math.ceil(math.sqrt(assignments))))
+    size=0.02 # degrees; about 2km
+    lon0=-120.5
+    lat0=39.0
+    squares=[]
+    for i in range(assignments):
+        x0=lon0+(i%cols)*size*1.5
+        y0=lat0+(i//cols)*size*1.5
+        squares.append((x0,y0))
+        letters=assignmentLetters(i)
+        number=str(101+i)
+        features.append(newFeature('Assignment',
+            {'type':'Polygon','coordinates':[[[x0,y0],[x0+size,y0],[x0+size,y0+size],[x0,y0+size],[x0,y0]]]},
+            title=letters+' '+number,letter=letters,number=number))
+        for j in range(tracksPerTeam):
+            features.append(newFeature('Shape',
+                {'type':'LineString','coordinates':randomWalk(rng,x0,y0,size,vertices,1600000000000)},
+                title=letters+number+chr(97+j),stroke='#FF0000',pattern='solid',
+                **{'stroke-width':2,'stroke-opacity':1}))
+    for i in range(clues):
+        (x0,y0)=rng.choice(squares)
+        features.append(newFeature('Clue',
+            {'type':'Point','coordinates':[x0+rng.uniform(0,size),y0+rng.uniform(0,size)]},
+            title='clue '+str(i+1)))
+    for i in range(markers):
+        (x0,y0)=rng.choice(squares)
+        features.append(newFeature('Marker',
+            {'type':'Point','coordinates':[x0+rng.uniform(0,size),y0+rng.uniform(0,size)]},
+            title='marker '+str(i+1),**{'marker-symbol':'point','marker-color':'#FF0000'}))
+    return features
+
+def percentiles(values):
+    if not values:
+        return {'count':0}
+    v=sorted(values)
+    def q(f):
+        return round(v[int(round(f*(len(v)-1)))],4)
+    return {'count':len(v),'p50':q(0.5),'p90':q(0.9),'p99':q(0.99),'max':round(v[-1],4)}
+
+def countDiff(after,before):
+    return {k:n-before.get(k,0) for (k,n) in after.items() if n-before.get(k,0)}
+
+# LatencyRecorder - time from each source map change to the end of the handler call that
+#  processed it; with event coalescing, several changes can be handled by one call, in which
+#  case the latency is measured from the first of those changes
+class LatencyRecorder():
+    def __init__(self):
+        self.lock=threading.Lock()
+        self.pending={} # key = source id, val = time of first unhandled change
+        self.latencies={} # key = event kind, val = list of seconds
+        self.durations={} # key = event kind, val = list of seconds spent in the handler
+
+    def changed(self,sid):
+        with self.lock:
+            self.pending.setdefault(sid,time.time())
+
+    # wrap - return handler, modified to record latency and duration
+    def wrap(self,kind,handler):
+        def wrapped(f):
+            t0=time.time()
+            try:
+                handler(f)
+            finally:
+                t1=time.time()
+                with self.lock:
+                    self.durations.setdefault(kind,[]).append(t1-t0)
+                    tc=self.pending.pop(f['id'],None)
+                    if tc is not None:
+                        self.latencies.setdefault(kind,[]).append(t1-tc)
+        return wrapped
+
+def runBenchmark(assignments=20,tracksPerTeam=3,vertices=500,clues=20,markers=5,
+        liveTracks=5,liveSteps=20,liveVertices=10,liveInterval=0.2,latency=0.02,
+        writeWorkers=4,coalesceWindow=1.0,localCrop=True,seed=0,workDir=None,options=None):
+    rng=random.Random(seed+1)
+    dmg_fakesession.clearMaps()
+    features=generateIncident(assignments,tracksPerTeam,vertices,clues,markers,seed)
+    src=FakeSession(mapID=sourceMapID)
+    for f in features:
+        src.put(f)
+    oldDir=os.getcwd()
+    os.chdir(workDir or tempfile.mkdtemp(prefix='dmg_bench_'))
+    try:
+        # 1. cold start
+        t0=time.time()
+        bg=sartopo_bg(sourceMapID,targetMapID,options,localCrop=localCrop,coalesceWindow=coalesceWindow,
+            writeWorkers=writeWorkers,logLevel=logging.WARNING,
+            sessionClass=partial(FakeSession,latency=latency))
+        bg.start()
+        coldStart=time.time()-t0
+        coldWrites=dict(bg.sts2.calls)
+
+        # 2. live phase
+        recorder=LatencyRecorder()
+        for kind in list(bg.sourceEventHandlers.keys()):
+            bg.sourceEventHandlers[kind]=recorder.wrap(kind,bg.sourceEventHandlers[kind])
+        tracks=[f for f in features if f['properties']['class']=='Shape']
+        growing=rng.sample(tracks,min(liveTracks,len(tracks)))
+        others=[f for f in features if f['properties']['class'] in ['Marker','Clue']]
+        corners=squaresForClues(features)
+        nLiveEvents=0
+        t1=time.time()
+        for step in range(liveSteps):
+            for f in growing:
+                gc=f['geometry']['coordinates']
+                more=randomWalk(rng,gc[-1][0]+0.01,gc[-1][1]+0.01,0.02,liveVertices,gc[-1][3])
+                recorder.changed(f['id'])
+                bg.sts1.simulateEdit(f['id'],geometry={'type':'LineString','coordinates':gc+more})
+                nLiveEvents+=1
+            if others and step%5==0:
+                # an edit of a field that is not copied to the target map, then one that is
+                f=rng.choice(others)
+                p=dict(f['properties'])
+                p['updated']=int(time.time()*1000)
+                recorder.changed(f['id'])
+                bg.sts1.simulateEdit(f['id'],properties=p)
+                p=dict(p)
+                p['description']='edited at step '+str(step)
+                recorder.changed(f['id'])
+                bg.sts1.simulateEdit(f['id'],properties=p)
+                nLiveEvents+=2
+            if corners and step%4==0:
+                (x,y)=rng.choice(corners)
+                f=newFeature('Clue',{'type':'Point','coordinates':[x,y]},title='live clue '+str(step))
+                recorder.changed(f['id'])
+                bg.sts1.simulateNew(f)
+                nLiveEvents+=1
+            if liveInterval:
+                time.sleep(liveInterval)
+        if bg.eventQueue:
+            # let pending events come due on their own (flush would dispatch them early)
+            while bg.eventQueue.getDepth():
+                time.sleep(0.01)
+            bg.eventQueue.flush()
+        bg.writer.drain()
+        live=time.time()-t1
+        liveWrites=countDiff(bg.sts2.calls,coldWrites)
+        bg.stop()
+    finally:
+        os.chdir(oldDir)
+    return {
+        'incident':{'assignments':assignments,'tracksPerTeam':tracksPerTeam,'vertices':vertices,
+            'clues':clues,'markers':markers,'features':len(features)},
+        'settings':{'latency':latency,'writeWorkers':writeWorkers,'coalesceWindow':coalesceWindow,'localCrop':localCrop,'options':options or {}},
+        'coldStart':{'seconds':round(coldStart,3),'targetWrites':coldWrites,'totalTargetWrites':sum(coldWrites.values())},
+        'live':{'seconds':round(live,3),'sourceEvents':nLiveEvents,
+            'latency':{k:percentiles(v) for (k,v) in recorder.latencies.items()},
+            'handlerDuration':{k:percentiles(v) for (k,v) in recorder.durations.items()},
+            'targetWrites':liveWrites,'totalTargetWrites':sum(liveWrites.values())},
+        'dmd':{'outings':len(bg.dmd['outings']),'corr':len(bg.dmd['corr'])}}
+
+# squaresForClues - lower left corners of the assignment boundaries, for placing new clues
+def squaresForClues(features):
+    return [tuple(f['geometry']['coordinates'][0][0][0:2]) for f in features if f['properties']['class']=='Assignment']
+
+def printReport(r):
+    print('incident: '+', '.join(k+'='+str(v) for (k,v) in r['incident'].items()))
+    print('settings: '+', '.join(k+'='+str(v) for (k,v) in r['settings'].items()))
+    print('cold start: %.3f s, %d target writes %s'%(r['coldStart']['seconds'],r['coldStart']['totalTargetWrites'],r['coldStart']['targetWrites']))
+    print('live phase: %.3f s, %d source events, %d target writes %s'%(r['live']['seconds'],r['live']['sourceEvents'],r['live']['totalTargetWrites'],r['live']['targetWrites']))
+    for (kind,p) in sorted(r['live']['latency'].items()):
+        d=r['live']['handlerDuration'].get(kind,{})
+        print('  %-9s latency n=%d p50=%.3f p90=%.3f p99=%.3f max=%.3f   handler p50=%.3f max=%.3f'%(
+            kind,p['count'],p['p50'],p['p90'],p['p99'],p['max'],d.get('p50',0),d.get('max',0)))
+    print('dmd: '+str(r['dmd']))
+
+def main():
+    parser=argparse.ArgumentParser(description='offline debrief map generator benchmark')
+    parser.add_argument('--assignments',type=int,default=20)
+    parser.add_argument('--tracks',type=int,default=3,help='tracks per team')
+    parser.add_argument('--vertices',type=int,default=500,help='vertices per track')
+    parser.add_argument('--clues',type=int,default=20)
+    parser.add_argument('--markers',type=int,default=5)
+    parser.add_argument('--live-tracks',type=int,default=5,help='number of tracks that grow during the live phase')
+    parser.add_argument('--live-steps',type=int,default=20)
+    parser.add_argument('--live-vertices',type=int,default=10,help='vertices added to each growing track per step')
+    parser.add_argument('--live-interval',type=float,default=0.2,help='seconds between live steps')
+    parser.add_argument('--latency',type=float,default=0.02,help='simulated seconds per target map write')
+    parser.add_argument('--workers',type=int,default=4)
+    parser.add_argument('--coalesce',type=float,default=1.0,help='event coalescing window in seconds (negative: no coalescing)')
+    parser.add_argument('--server-crop',action='store_true',help='crop with (simulated) sts2.crop instead of locally')
+    parser.add_argument('--seed',type=int,default=0)
+    parser.add_argument('--options',type=json.loads,default=None,help='other sartopo_bg options, as a json object (e.g. \'{"simplifyScale":24000}\')')
+    parser.add_argument('--json',action='store_true',help='print the report as json')
+    args=parser.parse_args()
+    r=runBenchmark(assignments=args.assignments,tracksPerTeam=args.tracks,vertices=args.vertices,
+        clues=args.clues,markers=args.markers,liveTracks=args.live_tracks,liveSteps=args.live_steps,
+        liveVertices=args.live_vertices,liveInterval=args.live_interval,latency=args.latency,
+        writeWorkers=args.workers,coalesceWindow=None if args.coalesce<0 else args.coalesce,
+        localCrop=not args.server_crop,seed=args.seed,options=args.options)
+    if args.json:
+        print(json.dumps(r,indent=3))
+    else:
+        printReport(r)
+
+if __name__=='__main__':
+    main()
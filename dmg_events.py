@@ -0,0 +1,275 @@
+import logging
+import threading
+import time
+import gzip
+import json
+from collections import OrderedDict
+from functools import partial
+
+# CoalescingQueue - sits between the source map session callbacks and the handlers that
+#  update the target map
+#
+# sartopo_python calls the callbacks from its sync thread, once per feature per sync; a burst of
+#  edits to the same feature (a growing live track, someone dragging an assignment vertex) would
+#  otherwise cause one full target map update per event.  Instead, events are held for up to
+#  'window' seconds after the first pending event for that source feature id, and all pending
+#  events for the same id are combined:
+#   - only the latest version of the feature (geometry and properties) is kept
+#   - property and geometry updates of a feature that is still pending as new are absorbed into
+#      the new feature event
+#   - a new feature that is deleted before it is dispatched is dropped entirely
+#   - a deletion replaces any pending updates
+#  then the handlers are called from this queue's own worker thread, one feature at a time, in
+#  the order that the features were first queued.  For each feature with both update types
+#  pending, the geometry update is dispatched before the property update.
+#
+# the four methods newFeatureCallback, propertyUpdateCallback, geometryUpdateCallback and
+#  deletedFeatureCallback can be assigned directly to the corresponding SartopoSession attributes
+#
+# sync-cycle batching: if endCycle is called at the end of each source map sync pass (see
+#  syncCycleSessionClass), everything pending is dispatched right away as one batch, sorted by
+#  order(feature) (a stable sort, so features with the same order value stay in the order they were
+#  queued), and then batchCallback is called with the list of handler return values; window is then
+#  only the longest time that an event waits for the end of a sync pass
+class CoalescingQueue():
+    kindOrder=['deleted','new','geometry','property'] # dispatch order within one feature
+
+    def __init__(self,handlers,window=1.0,order=None,batchCallback=None):
+        self.handlers=handlers # key = kind ('new','property','geometry','deleted'), val = function(feature)
+        self.window=window
+        self.order=order
+        self.batchCallback=batchCallback
+        self.pending=OrderedDict() # key = source feature id, val = dictionary: kinds, f, first, events
+        self.lock=threading.Condition()
+        self.stopping=False
+        self.busy=False
+        self.stats={
+            'events':0, # total number of events queued
+            'coalesced':0, # events that were combined into an already-pending event for the same feature
+            'cancelled':0, # new-then-deleted pairs that were dropped before dispatch
+            'dispatched':0, # handler calls
+            'errors':0, # handler calls that raised an exception
+            'maxDepth':0,
+            'batches':0} # number of batches dispatched (sync-cycle batching)
+        self.thread=threading.Thread(target=self.run,name='CoalescingQueue',daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    # stop - dispatch everything that is still pending (unless drain is False), then stop the worker thread
+    def stop(self,drain=True,timeout=None):
+        with self.lock:
+            if not drain:
+                self.pending.clear()
+            self.stopping=True
+            self.lock.notify_all()
+        if self.thread.is_alive():
+            self.thread.join(timeout)
+
+    def newFeatureCallback(self,f):
+        self.put('new',f)
+
+    def propertyUpdateCallback(self,f):
+        self.put('property',f)
+
+    def geometryUpdateCallback(self,f):
+        self.put('geometry',f)
+
+    def deletedFeatureCallback(self,f):
+        self.put('deleted',f)
+
+    def put(self,kind,f):
+        sid=f['id']
+        with self.lock:
+            self.stats['events']+=1
+            e=self.pending.get(sid,None)
+            if e is None:
+                self.pending[sid]={'kinds':[kind],'f':f,'first':time.time(),'events':1}
+                self.stats['maxDepth']=max(self.stats['maxDepth'],len(self.pending))
+                self.lock.notify_all()
+                return
+            self.stats['coalesced']+=1
+            e['events']+=1
+            kinds=e['kinds']
+            if kind=='deleted':
+                if 'new' in kinds:
+                    if kinds[0]=='deleted': # deleted, then re-added, then deleted again
+                        e['kinds']=['deleted']
+                    else: # never dispatched: nothing to do at all
+                        logging.info('event queue: feature '+sid+' was added and then deleted before being processed; both events dropped')
+                        del self.pending[sid]
+                        self.stats['cancelled']+=1
+                        return
+                else:
+                    e['kinds']=['deleted']
+            elif kind=='new':
+                if 'new' not in kinds:
+                    kinds.append('new')
+            elif kinds==['deleted']:
+                logging.warning('event queue: '+kind+' update received for feature '+sid+' which is pending deletion; ignored')
+                return
+            elif 'new' not in kinds and kind not in kinds:
+                kinds.append(kind)
+            e['f']=f # always keep the latest version of the feature
+
+    # getDepth - number of source features with pending events
+    def getDepth(self):
+        with self.lock:
+            return len(self.pending)
+
+    # getLag - seconds since the oldest pending event was queued (0 if nothing is pending)
+    def getLag(self):
+        with self.lock:
+            if not self.pending:
+                return 0
+            return time.time()-min(e['first'] for e in self.pending.values())
+
+    def getStats(self):
+        with self.lock:
+            stats=dict(self.stats)
+            stats['depth']=len(self.pending)
+        return stats
+
+    # flush - block until every event queued so far has been dispatched
+    def flush(self,timeout=None):
+        deadline=None if timeout is None else time.time()+timeout
+        with self.lock:
+            for sid in self.pending: # make everything due now
+                self.pending[sid]['first']=0
+            self.lock.notify_all()
+            while self.pending or self.busy:
+                remaining=None if deadline is None else deadline-time.time()
+                if remaining is not None and remaining<=0:
+                    return False
+                self.lock.wait(remaining)
+        return True
+
+    # endCycle - make everything queued so far due now, without waiting for it to be dispatched
+    def endCycle(self):
+        with self.lock:
+            for sid in self.pending:
+                self.pending[sid]['first']=0
+            self.lock.notify_all()
+
+    # popDue - remove and return the pending entries whose window has expired (all entries if stopping)
+    def popDue(self):
+        now=time.time()
+        due=[]
+        for sid in list(self.pending.keys()):
+            e=self.pending[sid]
+            if self.stopping or now-e['first']>=self.window:
+                due.append(self.pending.pop(sid))
+        return due
+
+    def nextDueTime(self):
+        return min(e['first'] for e in self.pending.values())+self.window
+
+    def run(self):
+        while True:
+            with self.lock:
+                due=self.popDue()
+                while not due:
+                    if self.stopping:
+                        return
+                    if self.pending:
+                        self.lock.wait(max(0,self.nextDueTime()-time.time()))
+                    else:
+                        self.lock.wait()
+                    due=self.popDue()
+                self.busy=True
+            if self.order:
+                due.sort(key=lambda e:self.order(e['f']))
+            results=[]
+            for e in due:
+                results+=self.dispatch(e)
+            if self.batchCallback:
+                try:
+                    self.batchCallback(results)
+                except Exception:
+                    logging.exception('event queue: batch callback failed')
+                self.stats['batches']+=1
+            with self.lock:
+                self.busy=False
+                self.lock.notify_all()
+
+    # dispatch - call the handlers for one pending entry; returns the list of their return values
+    def dispatch(self,e):
+        results=[]
+        for kind in sorted(e['kinds'],key=self.kindOrder.index):
+            try:
+                results.append(self.handlers[kind](e['f']))
+            except Exception:
+                logging.exception('event queue: '+kind+' handler failed for feature '+str(e['f'].get('id')))
+                self.stats['errors']+=1
+            self.stats['dispatched']+=1
+        return results
+
+# syncCycleSessionClass - return a subclass of sessionClass (a SartopoSession-like class, or a
+#  partial of one) that calls its syncCycleCallback attribute, if set, after each sync pass, i.e.
+#  after the callbacks for all of the changes in one 'since' response have been called; returns
+#  sessionClass itself if it doesn't sync that way (e.g. dmg_fakesession.FakeSession); a partial of
+#  a function that takes a sessionClass argument (e.g. dmg_supervisor.limitedSession) is handled too
+def syncCycleSessionClass(sessionClass):
+    if isinstance(sessionClass,partial):
+        if 'sessionClass' in sessionClass.keywords:
+            return partial(sessionClass.func,*sessionClass.args,**dict(sessionClass.keywords,sessionClass=syncCycleSessionClass(sessionClass.keywords['sessionClass'])))
+        return partial(syncCycleSessionClass(sessionClass.func),*sessionClass.args,**sessionClass.keywords)
+    # older sartopo_python versions call it doSync; newer versions call it _doSync
+    syncName=next((n for n in ['_doSync','doSync'] if hasattr(sessionClass,n)),None)
+    if syncName is None:
+        return sessionClass
+    baseSync=getattr(sessionClass,syncName)
+    def sync(self,*args,**kwargs):
+        try:
+            return baseSync(self,*args,**kwargs)
+        finally:
+            callback=getattr(self,'syncCycleCallback',None)
+            if callback:
+                callback()
+    return type('Cycle'+sessionClass.__name__,(sessionClass,),{syncName:sync})
+
+# EventRecorder - records the source map features that exist at startup, followed by every source
+#  map event, with the time it was received, to a gzip-compressed file of json lines, for replay
+#  by dmg_replay.py:
+#     {"k":"start","t":<time>,"map":<source map ID>,"features":[...]}
+#     {"k":"new"|"property"|"geometry"|"deleted","t":<time>,"f":<feature>}
+#  record and wrap may be called from any thread
+class EventRecorder():
+    def __init__(self,fileName):
+        self.fileName=fileName
+        self.lock=threading.Lock()
+        self.file=gzip.open(fileName,'wt')
+        self.count=0
+
+    def write(self,r):
+        line=json.dumps(r,separators=(',',':'))+'\n'
+        with self.lock:
+            if self.file:
+                self.file.write(line)
+                self.count+=1
+
+    # start - record the source map features that exist before any events are received
+    def start(self,mapID,features):
+        self.write({'k':'start','t':time.time(),'map':mapID,'features':features})
+
+    def record(self,kind,f):
+        self.write({'k':kind,'t':time.time(),'f':f})
+
+    # wrap - return a callback that records the event and then calls callback
+    def wrap(self,kind,callback):
+        def recordingCallback(f):
+            self.record(kind,f)
+            callback(f)
+        return recordingCallback
+
+    def flush(self):
+        with self.lock:
+            if self.file:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file=None
+        logging.info('event recording '+self.fileName+' closed after '+str(self.count)+' records')
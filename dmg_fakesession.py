@@ -0,0 +1,204 @@
+import logging
+import threading
+import time
+import uuid
+import copy
+from dmg_geometry import CropBoundary,cropLine
+
+# FakeSession - in-memory stand-in for sartopo_python.SartopoSession, for benchmarking and
+#  replaying without a live SARTopo / CalTopo server
+#
+# implements the parts of the SartopoSession interface that sartopo_bg uses: mapData, refresh,
+#  getFeature, addFolder, addLine, addPolygon, addMarker, editObject, delObject, crop, and the
+#  four callback attributes
+#
+# all sessions opened on the same map ID share the same map data (the 'server'), so a target map
+#  written by one sartopo_bg instance is still there when the next instance starts
+#
+# latency - seconds that each map-changing call takes (to simulate the http round trip);
+#  reads (getFeature, mapData) come from the local cache, as they do in sartopo_python
+#
+# the source map side of an incident is driven by calling simulateNew, simulateEdit and
+#  simulateDelete, which update the map data and then call the registered callback(s), the same
+#  way the sartopo_python sync thread would
+
+maps={} # key = map ID, val = mapData dictionary shared by all sessions on that map
+mapIndexes={} # key = map ID, val = dictionary of the map's features, key = feature id
+mapsLock=threading.RLock()
+
+def clearMaps():
+    with mapsLock:
+        maps.clear()
+        mapIndexes.clear()
+
+# newFeature - build a source map feature dictionary
+def newFeature(className,geometry,**properties):
+    p={'class':className,'title':'','description':''}
+    p.update(properties)
+    return {'id':str(uuid.uuid4()),'type':'Feature','properties':p,'geometry':geometry}
+
+class FakeSession():
+    def __init__(self,domainAndPort='localhost:8080',mapID=None,latency=0.0,
+            newFeatureCallback=None,propertyUpdateCallback=None,geometryUpdateCallback=None,deletedFeatureCallback=None,
+            **kwargs):
+        self.domainAndPort=domainAndPort
+        self.mapID=mapID
+        self.latency=latency
+        self.newFeatureCallback=newFeatureCallback
+        self.propertyUpdateCallback=propertyUpdateCallback
+        self.geometryUpdateCallback=geometryUpdateCallback
+        self.deletedFeatureCallback=deletedFeatureCallback
+        with mapsLock:
+            self.mapData=maps.setdefault(mapID,{'ids':{},'state':{'features':[]}})
+            self.byId=mapIndexes.setdefault(mapID,{})
+            self.byId.update({f['id']:f for f in self.mapData['state']['features']})
+        self.lock=mapsLock
+        self.calls={} # key = method name, val = number of calls (map-changing calls only)
+
+    def count(self,name):
+        with self.lock:
+            self.calls[name]=self.calls.get(name,0)+1
+        if self.latency:
+            time.sleep(self.latency)
+
+    # getWriteCount - total number of map-changing calls
+    def getWriteCount(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+    def refresh(self,blocking=True,forceImmediate=False):
+        pass
+
+    def put(self,f):
+        with self.lock:
+            self.mapData['state']['features'].append(f)
+            self.mapData['ids'].setdefault(f['properties']['class'],[]).append(f['id'])
+            self.byId[f['id']]=f
+        return f['id']
+
+    def create(self,className,geometry,**properties):
+        p={'class':className}
+        p.update(properties)
+        return self.put({'id':str(uuid.uuid4()),'type':'Feature','properties':p,'geometry':geometry})
+
+    def lookup(self,id):
+        return self.byId.get(id,None)
+
+    def getFeature(self,featureClass=None,title=None,id=None,**kwargs):
+        return self.lookup(id)
+
+    def addFolder(self,label='New Folder',**kwargs):
+        self.count('addFolder')
+        return self.create('Folder',None,title=label)
+
+    def addLine(self,points,title='New Line',description='',width=2,opacity=1,color='#FF0000',pattern='solid',folderId=None,**kwargs):
+        self.count('addLine')
+        return self.create('Shape',{'type':'LineString','coordinates':points},
+            title=title,description=description,stroke=color,pattern=pattern,folderId=folderId,
+            **{'stroke-width':width,'stroke-opacity':opacity})
+
+    def addPolygon(self,points,title='New Shape',folderId=None,description='',strokeOpacity=1,strokeWidth=2,fillOpacity=0.1,stroke='#FF0000',fill='#FF0000',**kwargs):
+        self.count('addPolygon')
+        return self.create('Shape',{'type':'Polygon','coordinates':[points]},
+            title=title,description=description,stroke=stroke,fill=fill,folderId=folderId,
+            **{'stroke-width':strokeWidth,'stroke-opacity':strokeOpacity,'fill-opacity':fillOpacity})
+
+    def addMarker(self,lat,lon,title='New Marker',description='',color='#FF0000',symbol='point',rotation=None,folderId=None,size=1,**kwargs):
+        self.count('addMarker')
+        return self.create('Marker',{'type':'Point','coordinates':[lon,lat]},
+            title=title,description=description,folderId=folderId,
+            **{'marker-color':color,'marker-symbol':symbol,'marker-rotation':rotation,'marker-size':size})
+
+    def editObject(self,id=None,className=None,title=None,letter=None,properties=None,geometry=None,**kwargs):
+        self.count('editObject')
+        f=self.lookup(id)
+        if f is None:
+            logging.error('FakeSession.editObject: feature '+str(id)+' not found')
+            return False
+        with self.lock:
+            if properties:
+                f['properties']=dict(properties)
+            if geometry:
+                f['geometry']=geometry
+        return id
+
+    def delObject(self,objType,existingId=None,**kwargs):
+        self.count('delObject')
+        f=self.lookup(existingId)
+        if f is None:
+            logging.error('FakeSession.delObject: feature '+str(existingId)+' not found')
+            return False
+        with self.lock:
+            self.mapData['state']['features'].remove(f)
+            self.mapData['ids'][f['properties']['class']].remove(existingId)
+            self.byId.pop(existingId,None)
+        return True
+
+    # crop - same result as SartopoSession.crop: the target line is edited to become the first
+    #  piece inside the boundary, other pieces are added as new lines; returns the list of ids,
+    #  or False if no part of the line is inside the boundary (in which case nothing is changed)
+    def crop(self,target,boundary,beyond=0.0001,**kwargs):
+        self.count('crop')
+        tf=self.lookup(target)
+        bf=self.lookup(boundary)
+        pieces=cropLine(tf['geometry']['coordinates'],CropBoundary(bf['geometry'],beyond))
+        if not pieces:
+            return False
+        with self.lock:
+            tf['geometry']={'type':'LineString','coordinates':pieces[0]}
+        ids=[target]
+        tp=tf['properties']
+        for piece in pieces[1:]:
+            ids.append(self.create('Shape',{'type':'LineString','coordinates':piece},**copy.deepcopy(tp)))
+        return ids
+
+    # simulated source map activity
+
+    def simulateNew(self,f):
+        self.put(f)
+        if self.newFeatureCallback:
+            self.newFeatureCallback(f)
+
+    # simulateEdit - replace properties and/or geometry of an existing feature, then call the
+    #  corresponding callback(s); the callbacks get a copy, as they would from a real sync
+    def simulateEdit(self,id,properties=None,geometry=None):
+        f=self.lookup(id)
+        with self.lock:
+            if properties is not None:
+                f['properties']=properties
+            if geometry is not None:
+                f['geometry']=geometry
+            fc=copy.deepcopy(f)
+        if geometry is not None and self.geometryUpdateCallback:
+            self.geometryUpdateCallback(fc)
+        if properties is not None and self.propertyUpdateCallback:
+            self.propertyUpdateCallback(fc)
+
+    # simulateEvent - apply a recorded source map event ('new', 'property', 'geometry' or
+    #  'deleted', with the feature as it was at the time) and call the corresponding callback
+    def simulateEvent(self,kind,f):
+        if kind=='new':
+            if self.lookup(f['id']) is None:
+                self.simulateNew(f)
+            elif self.newFeatureCallback:
+                self.newFeatureCallback(f)
+        elif kind=='deleted':
+            if self.lookup(f['id']) is not None:
+                self.simulateDelete(f['id'])
+            elif self.deletedFeatureCallback:
+                self.deletedFeatureCallback(f)
+        elif self.lookup(f['id']) is None:
+            logging.warning('FakeSession.simulateEvent: '+kind+' update for feature '+f['id']+' which does not exist; ignored')
+        elif kind=='property':
+            self.simulateEdit(f['id'],properties=f['properties'])
+        elif kind=='geometry':
+            self.simulateEdit(f['id'],geometry=f['geometry'])
+
+    def simulateDelete(self,id):
+        f=self.lookup(id)
+        with self.lock:
+            self.mapData['state']['features'].remove(f)
+            self.mapData['ids'][f['properties']['class']].remove(id)
+            self.byId.pop(id,None)
+        if self.deletedFeatureCallback:
+            self.deletedFeatureCallback(f)
@@ -0,0 +1,511 @@
+import logging
+import hashlib
+import threading
+import numpy as np
+import shapely
+from shapely.geometry import Polygon,LineString
+from shapely.ops import unary_union
+
+# local (in-process) geometry operations for the debrief map generator
+#
+# coordinate lists use the same format as sartopo features: a list of [lon,lat] or
+#  [lon,lat,elevation,timestamp] vertices; any vertex elements beyond lon and lat are
+#  carried through to the results
+
+# CropBoundary - an assignment boundary, oversized by 'beyond' degrees the same way that
+#  SartopoSession.crop does it (polygon: buffer(0) then unary_union then buffer(beyond);
+#  line: buffer(beyond)), and held as numpy edge arrays so that any number of tracks can
+#  be cropped against it without re-buffering
+class CropBoundary():
+    def __init__(self,geometry,beyond=0.001):
+        gt=geometry['type']
+        gc=geometry['coordinates']
+        if gt=='Polygon':
+            g=unary_union(Polygon([c[0:2] for c in gc[0]]).buffer(0)).buffer(beyond)
+        elif gt=='LineString':
+            g=LineString([c[0:2] for c in gc]).buffer(beyond)
+        else:
+            raise ValueError('crop boundary must be a Polygon or LineString, not '+str(gt))
+        # all rings (exteriors and holes, of all polygons if the buffer result is a MultiPolygon)
+        #  are used together with the even-odd rule, which gives the same inside/outside answer
+        #  as shapely 'within' for everything except points exactly on the boundary
+        polygons=getattr(g,'geoms',[g])
+        rings=[]
+        for p in polygons:
+            rings.append(np.asarray(p.exterior.coords)[:,0:2])
+            for interior in p.interiors:
+                rings.append(np.asarray(interior.coords)[:,0:2])
+        self.edgeStarts=np.concatenate([r[:-1] for r in rings])
+        self.edgeEnds=np.concatenate([r[1:] for r in rings])
+        self.bounds=g.bounds # minx,miny,maxx,maxy
+
+    # contains - boolean array: which of the Nx2 points are inside the oversized boundary
+    def contains(self,pts,chunkSize=4096):
+        inside=np.zeros(len(pts),dtype=bool)
+        x0=self.edgeStarts[:,0]
+        y0=self.edgeStarts[:,1]
+        x1=self.edgeEnds[:,0]
+        y1=self.edgeEnds[:,1]
+        (minx,miny,maxx,maxy)=self.bounds
+        # only points inside the bounding box need the full test
+        candidates=np.nonzero((pts[:,0]>=minx)&(pts[:,0]<=maxx)&(pts[:,1]>=miny)&(pts[:,1]<=maxy))[0]
+        for i in range(0,len(candidates),chunkSize):
+            idx=candidates[i:i+chunkSize]
+            px=pts[idx,0][:,None]
+            py=pts[idx,1][:,None]
+            # crossing number: count edges that straddle the horizontal ray to the right of the point
+            straddles=(y0>py)!=(y1>py)
+            with np.errstate(divide='ignore',invalid='ignore'):
+                xCross=x0+(py-y0)*(x1-x0)/(y1-y0)
+            crossings=np.count_nonzero(straddles&(px<xCross),axis=1)
+            inside[idx]=(crossings%2)==1
+        return inside
+
+    # containsPoint - True if the single vertex is inside the oversized boundary
+    def containsPoint(self,c):
+        return bool(self.contains(np.asarray([c[0:2]],dtype=float))[0])
+
+    # crossings -for each segment a[i]->b[i], return the sorted array of parameters t (0..1)
+    #  at which the segment crosses the boundary
+    def crossings(self,a,b,chunkSize=1024):
+        rval=[]
+        q=self.edgeStarts[None,:,:]
+        s=(self.edgeEnds-self.edgeStarts)[None,:,:]
+        for i in range(0,len(a),chunkSize):
+            p=a[i:i+chunkSize][:,None,:]
+            r=(b[i:i+chunkSize]-a[i:i+chunkSize])[:,None,:]
+            qp=q-p
+            denom=r[...,0]*s[...,1]-r[...,1]*s[...,0]
+            with np.errstate(divide='ignore',invalid='ignore'):
+                t=(qp[...,0]*s[...,1]-qp[...,1]*s[...,0])/denom
+                u=(qp[...,0]*r[...,1]-qp[...,1]*r[...,0])/denom
+            hit=(denom!=0)&(t>=0)&(t<=1)&(u>=0)&(u<=1)
+            for row in range(hit.shape[0]):
+                rval.append(np.unique(t[row][hit[row]]))
+        return rval
+
+# DistanceBoundary - crop boundary for roaming teams (trailing dogs, trackers): everything within
+#  'distance' meters of the assignment geometry (polygon interior, or line) is inside; same
+#  interface as CropBoundary, so cropLine works with either
+#
+# distances are computed on a local equirectangular projection centered on the assignment, which
+#  is within about 0.2% of the geodesic distance out to a few tens of kilometers; every vertex is
+#  measured against every edge of the assignment as one numpy array operation (in chunks), and the
+#  boundary crossing points are found by bisection along the crossing segments
+class DistanceBoundary():
+    earthRadius=6371008.8 # meters
+
+    def __init__(self,geometry,distance=10000):
+        gt=geometry['type']
+        gc=geometry['coordinates']
+        if gt=='Polygon':
+            verts=np.asarray([c[0:2] for c in gc[0]],dtype=float)
+            self.area=CropBoundary(geometry,0)
+        elif gt=='LineString':
+            verts=np.asarray([c[0:2] for c in gc],dtype=float)
+            self.area=None
+        else:
+            raise ValueError('crop boundary must be a Polygon or LineString, not '+str(gt))
+        self.distance=distance
+        (minx,miny)=verts.min(axis=0)
+        (maxx,maxy)=verts.max(axis=0)
+        self.lon0=(minx+maxx)/2
+        self.lat0=(miny+maxy)/2
+        self.ky=np.radians(1)*self.earthRadius # meters per degree of latitude
+        self.kx=self.ky*np.cos(np.radians(self.lat0))
+        p=self.project(verts)
+        if len(p)<2:
+            p=np.concatenate([p,p])
+        self.edgeStarts=p[:-1]
+        self.edgeVectors=p[1:]-p[:-1]
+        self.edgeLengths2=np.maximum((self.edgeVectors**2).sum(axis=1),1e-12)
+        # bounding box in degrees, using the longitude scale at the pole-most latitude
+        dy=distance/self.ky
+        poleward=min(89.0,max(abs(miny),abs(maxy))+dy)
+        dx=distance/(self.ky*np.cos(np.radians(poleward)))
+        self.bounds=(minx-dx,miny-dy,maxx+dx,maxy+dy)
+
+    def project(self,pts):
+        return np.column_stack(((pts[:,0]-self.lon0)*self.kx,(pts[:,1]-self.lat0)*self.ky))
+
+    # distances - array of distances in meters from each of the Nx2 lon,lat points to the
+    #  assignment (0 inside an assignment polygon); unless exact is True, points outside the
+    #  bounds get inf without being measured
+    def distances(self,pts,chunkSize=4096,exact=False):
+        d=np.full(len(pts),np.inf)
+        (minx,miny,maxx,maxy)=self.bounds
+        if exact:
+            candidates=np.arange(len(pts))
+        else:
+            candidates=np.nonzero((pts[:,0]>=minx)&(pts[:,0]<=maxx)&(pts[:,1]>=miny)&(pts[:,1]<=maxy))[0]
+        for i in range(0,len(candidates),chunkSize):
+            idx=candidates[i:i+chunkSize]
+            p=self.project(pts[idx])[:,None,:]
+            w=p-self.edgeStarts[None,:,:]
+            t=np.clip((w*self.edgeVectors[None,:,:]).sum(axis=2)/self.edgeLengths2[None,:],0,1)
+            nearest=w-t[:,:,None]*self.edgeVectors[None,:,:]
+            d[idx]=np.sqrt((nearest**2).sum(axis=2).min(axis=1))
+        if self.area is not None and len(candidates):
+            d[candidates[self.area.contains(pts[candidates])]]=0
+        return d
+
+    def contains(self,pts,chunkSize=4096):
+        return self.distances(pts,chunkSize)<=self.distance
+
+    def containsPoint(self,c):
+        return bool(self.contains(np.asarray([c[0:2]],dtype=float))[0])
+
+    # crossings - for each segment a[i]->b[i], the sorted parameters t (0..1) at which the segment
+    #  crosses the distance threshold: one crossing if one end is inside, and for segments with
+    #  both ends outside, two crossings if the segment passes within the distance (checked at
+    #  'samples' points along the segment)
+    def crossings(self,a,b,iterations=30,samples=16):
+        n=len(a)
+        rval=[np.array([])]*n
+        if n==0:
+            return rval
+        da=self.distances(a,exact=True)
+        db=self.distances(b,exact=True)
+        ina=da<=self.distance
+        inb=db<=self.distance
+        # bisection for many segments at once: lo and hi start on opposite sides of the threshold
+        def bisect(aa,bb,lo,hi):
+            loInside=self.contains(aa+(bb-aa)*lo[:,None])
+            for j in range(iterations):
+                mid=(lo+hi)/2
+                same=self.contains(aa+(bb-aa)*mid[:,None])==loInside
+                lo=np.where(same,mid,lo)
+                hi=np.where(same,hi,mid)
+            return (lo+hi)/2
+        one=np.nonzero(ina!=inb)[0]
+        if len(one):
+            t=bisect(a[one],b[one],np.zeros(len(one)),np.ones(len(one)))
+            for (i,tt) in zip(one.tolist(),t.tolist()):
+                rval[i]=np.array([tt])
+        # segments with both ends outside: if the sample point nearest to the assignment is
+        #  inside, the segment enters and leaves; no point of a segment of length L can be closer
+        #  than (da+db-L)/2, so only segments that are long compared to their distance are sampled
+        lengths=np.sqrt(((self.project(b)-self.project(a))**2).sum(axis=1))
+        both=np.nonzero(~ina&~inb&((da+db-lengths)/2<=self.distance))[0]
+        if len(both):
+            ts=np.linspace(0,1,samples+2)[1:-1]
+            aa=a[both]
+            bb=b[both]
+            pts=(aa[:,None,:]+(bb-aa)[:,None,:]*ts[None,:,None]).reshape(-1,2)
+            d=self.distances(pts).reshape(len(both),samples)
+            k=d.argmin(axis=1)
+            dips=np.nonzero(d[np.arange(len(both)),k]<=self.distance)[0]
+            if len(dips):
+                tMid=ts[k[dips]]
+                t0=bisect(aa[dips],bb[dips],np.zeros(len(dips)),tMid)
+                t1=bisect(aa[dips],bb[dips],tMid,np.ones(len(dips)))
+                for (i,u,v) in zip(both[dips].tolist(),t0.tolist(),t1.tolist()):
+                    rval[i]=np.array([u,v])
+        return rval
+
+# removeSpurs - same as SartopoSession._removeSpurs: drop repeated vertices, and for a
+#  sequence like a,b,c,d,c,e,f (where c,d,c is a single-point 'spur'), drop the spur to give
+#  a,b,c,e,f; returns the indices of the vertices to keep
+def removeSpurs(pts):
+    n=len(pts)
+    if n<=3:
+        return np.arange(n)
+    same1=np.all(pts[2:]==pts[1:-1],axis=1)
+    same2=np.all(pts[2:]==pts[:-2],axis=1)
+    if not same2.any():
+        # the usual case: only repeated vertices, if anything, need to be dropped
+        return np.concatenate(([0,1],np.nonzero(~same1)[0]+2))
+    keep=[0,1]
+    for i in range(2,n):
+        if not np.array_equal(pts[i],pts[i-1]):
+            if not np.array_equal(pts[i],pts[i-2]):
+                keep.append(i)
+            else:
+                keep.pop()
+    return np.array(keep)
+
+# cropLine - crop the track coordinate list to the boundary (a CropBoundary), using the same
+#  rules as SartopoSession._intersection2, which preserves tracks that cross over themselves:
+#   - each run of consecutive vertices inside the boundary becomes one result line, starting
+#      with the point where the track entered the boundary and ending with the point where
+#      it left the boundary (unless the run is at the start or end of the track)
+#   - a segment whose two vertices are both outside, but which passes through the boundary,
+#      becomes its own short result line
+#  the vertex classification and all segment/boundary intersections are computed as numpy array
+#  operations; only the (usually few) boundary crossings are handled one at a time.
+#  extra vertex elements (elevation, timestamp) are interpolated for generated crossing points.
+#  returns a list of coordinate lists, which is empty if no part of the track is inside the boundary
+def cropLine(coords,boundary):
+    if len(coords)<2:
+        return []
+    try:
+        full=np.asarray(coords,dtype=float)
+    except ValueError: # vertices with different numbers of elements: keep only lon,lat
+        full=np.asarray([c[0:2] for c in coords],dtype=float)
+    full=full[removeSpurs(full[:,0:2])]
+    pts=full[:,0:2]
+    n=len(pts)
+    if n<2:
+        return []
+    inside=boundary.contains(pts)
+
+    def interpolate(i,t):
+        return full[i]+(full[i+1]-full[i])*t
+
+    pieces=[] # list of [sort key,coordinate array]
+
+    # runs of consecutive inside vertices
+    edges=np.diff(np.concatenate(([0],inside.astype(np.int8),[0])))
+    runStarts=np.nonzero(edges==1)[0]
+    runEnds=np.nonzero(edges==-1)[0]-1
+    # boundary crossings are only needed for the segments just before and just after each run
+    entrySegs=runStarts[runStarts>0]-1
+    exitSegs=runEnds[runEnds<n-1]
+    # segments with both vertices outside, but bounding boxes overlapping the boundary
+    (minx,miny,maxx,maxy)=boundary.bounds
+    a=pts[:-1]
+    b=pts[1:]
+    outOut=np.nonzero(~inside[:-1]&~inside[1:]
+        &(np.maximum(a[:,0],b[:,0])>=minx)&(np.minimum(a[:,0],b[:,0])<=maxx)
+        &(np.maximum(a[:,1],b[:,1])>=miny)&(np.minimum(a[:,1],b[:,1])<=maxy))[0]
+    segs=np.concatenate((entrySegs,exitSegs,outOut)).astype(int)
+    ts=dict(zip(segs.tolist(),boundary.crossings(a[segs],b[segs])))
+
+    for (s,e) in zip(runStarts.tolist(),runEnds.tolist()):
+        parts=[]
+        if s>0 and len(ts[s-1])>0:
+            parts.append(interpolate(s-1,ts[s-1][-1])[None,:]) # last crossing before the inside vertex
+        parts.append(full[s:e+1])
+        if e<n-1 and len(ts[e])>0:
+            parts.append(interpolate(e,ts[e][0])[None,:]) # first crossing after the inside vertex
+        pieces.append([s,np.concatenate(parts)])
+    for i in outOut.tolist():
+        t=ts[i]
+        if len(t)>1: # a single crossing means the segment only touches the boundary
+            pieces.append([i,np.array([interpolate(i,tt) for tt in t])])
+    pieces.sort(key=lambda x:x[0])
+    rval=[p[1].tolist() for p in pieces if len(p[1])>1]
+    logging.debug('cropLine: '+str(len(coords))+' vertices --> '+str(len(rval))+' line(s), '+str(sum(len(r) for r in rval))+' vertices')
+    return rval
+
+# coordsHash - hash of a coordinate list, used to detect whether any of the vertices of a
+#  track have changed (as opposed to new vertices only being appended)
+def coordsHash(coords):
+    try:
+        a=np.asarray(coords,dtype=float)
+    except ValueError: # vertices with different numbers of elements
+        return hashlib.sha1(repr(coords).encode()).hexdigest()
+    return hashlib.sha1(a.tobytes()).hexdigest()
+
+# simplifyLine - Douglas-Peucker simplification of a line (list of [lon,lat,...] vertices) to within
+#  tolerance meters, with lon/lat of the remaining vertices rounded to digits decimal places (if
+#  specified); the first and last vertices are always kept, and kept vertices keep any other
+#  elements (elevation, time) unchanged
+#
+# the recursive algorithm makes one pass over each segment being split, i.e. one set of numpy calls
+#  per kept vertex; instead, each pass measures every vertex that is still in an unfinished segment
+#  against the segment between the kept vertices on either side of it, and keeps the farthest
+#  vertex of every segment that has one beyond tolerance, so the number of passes is only the
+#  depth of the recursion
+#
+# distances are to the segment rather than the infinite line through it, so that a track that
+#  doubles back on itself isn't simplified to a single straight line
+def simplifyLine(coords,tolerance,digits=None):
+    n=len(coords)
+    if n==0:
+        return []
+    try:
+        pts=np.asarray(coords,dtype=float)[:,:2]
+    except ValueError: # vertices with different numbers of elements
+        pts=np.asarray([c[0:2] for c in coords],dtype=float)
+    keep=np.ones(n,dtype=bool)
+    if n>2 and tolerance>0:
+        # local equirectangular projection, in meters
+        ky=np.radians(1)*DistanceBoundary.earthRadius
+        kx=ky*np.cos(np.radians(pts[:,1].mean()))
+        x=(pts[:,0]-pts[0,0])*kx
+        y=(pts[:,1]-pts[0,1])*ky
+        keep[1:-1]=False
+        cand=np.arange(1,n-1) # vertices in unfinished segments
+        while len(cand):
+            kept=np.flatnonzero(keep)
+            seg=np.cumsum(keep)[cand]-1 # segment from kept[seg] to kept[seg+1]
+            (i,j)=(kept[seg],kept[seg+1])
+            (abx,aby)=(x[j]-x[i],y[j]-y[i])
+            (apx,apy)=(x[cand]-x[i],y[cand]-y[i])
+            t=np.clip((apx*abx+apy*aby)/np.maximum(abx*abx+aby*aby,1e-12),0,1)
+            d2=(apx-t*abx)**2+(apy-t*aby)**2
+            # farthest vertex of each segment (cand is in order, so each segment is one run)
+            starts=np.flatnonzero(np.r_[True,seg[1:]!=seg[:-1]])
+            runs=np.repeat(np.arange(len(starts)),np.diff(np.r_[starts,len(seg)]))
+            far=np.maximum.reduceat(d2,starts)
+            split=far>tolerance*tolerance
+            if not split.any():
+                break
+            isFar=(d2==far[runs])&split[runs]
+            (splitRuns,first)=np.unique(runs[isFar],return_index=True)
+            keep[cand[np.flatnonzero(isFar)[first]]]=True
+            cand=cand[split[runs]&~keep[cand]]
+    indices=np.flatnonzero(keep)
+    lonLat=pts[indices]
+    if digits is not None:
+        lonLat=np.round(lonLat,digits)
+    return [p+list(coords[i][2:]) for (p,i) in zip(lonLat.tolist(),indices.tolist())]
+
+# TrackFingerprint - geometry fingerprint of a track, for detecting the same GPS log imported more
+#  than once, or near-identical logs from two devices carried by the same team
+#
+# the track is resampled at a fixed spacing along its length (coarser for very long tracks, so
+#  there are at most maxPoints points), so that copies with different vertex density, elevation
+#  or timestamps give the same points:
+#   hash - hash of the resampled points rounded to digits decimal places (about 1m); exact copies
+#            have the same hash
+#   isNear(other) - True if at least 95% of the resampled points of each track are within
+#            tolerance meters of the other track, i.e. the tracks differ only by GPS noise
+class TrackFingerprint():
+    def __init__(self,coords,spacing=10,maxPoints=2000,digits=5):
+        try:
+            pts=np.asarray(coords,dtype=float)[:,:2]
+        except ValueError: # vertices with different numbers of elements
+            pts=np.asarray([c[0:2] for c in coords],dtype=float)
+        self.ky=np.radians(1)*DistanceBoundary.earthRadius
+        self.kx=self.ky*np.cos(np.radians(pts[0,1]))
+        steps=np.hypot(np.diff(pts[:,0])*self.kx,np.diff(pts[:,1])*self.ky)
+        along=np.concatenate([[0],np.cumsum(steps)])
+        self.length=along[-1]
+        self.spacing=max(spacing,self.length/maxPoints)
+        at=np.append(np.arange(0,self.length,self.spacing),self.length)
+        self.points=np.column_stack((np.interp(at,along,pts[:,0]),np.interp(at,along,pts[:,1])))
+        self.bounds=(*self.points.min(axis=0),*self.points.max(axis=0))
+        self.hash=hashlib.sha1(np.round(self.points,digits).tobytes()).hexdigest()
+
+    def isNear(self,other,tolerance=15):
+        (dx,dy)=(tolerance/self.kx,tolerance/self.ky)
+        if self.bounds[0]>other.bounds[2]+dx or other.bounds[0]>self.bounds[2]+dx or \
+                self.bounds[1]>other.bounds[3]+dy or other.bounds[1]>self.bounds[3]+dy:
+            return False
+        if len(self.points)<2 or len(other.points)<2:
+            return False
+        # distances from the points of each track to the other track, in meters
+        a=np.column_stack((self.points[:,0]*self.kx,self.points[:,1]*self.ky))
+        b=np.column_stack((other.points[:,0]*self.kx,other.points[:,1]*self.ky))
+        return self.fractionNear(a,b,tolerance)>=0.95 and self.fractionNear(b,a,tolerance)>=0.95
+
+    # fractionNear - fraction of the points a that are within tolerance of the line through b
+    @staticmethod
+    def fractionNear(a,b,tolerance):
+        tree=shapely.STRtree(shapely.linestrings(np.stack([b[:-1],b[1:]],axis=1)))
+        (near,segments)=tree.query(shapely.points(a),predicate='dwithin',distance=tolerance)
+        return len(np.unique(near))/len(a)
+
+    # matches - True if the other track is a duplicate of this one: an exact copy, or (if near is
+    #  True) a near-identical one
+    def matches(self,other,near=False):
+        return self.hash==other.hash or (near and self.isNear(other))
+
+# GridIndex - incrementally maintained spatial index of target map features on a regular lon/lat
+#  grid, for selecting the features that are inside a print area without scanning the whole map
+#
+# lines and polygon rings are indexed as pieces of up to pieceSize segments, so that a query
+#  returns only the parts of a long line (trail, road, power line) that are near the extent;
+#  a piece whose bounding box covers more than maxCells grid cells (e.g. a long straight line
+#  from the IC) is kept in a separate list that is checked on every query instead
+#
+# query returns a list of (id,coordinates) pieces whose bounding box intersects the extent; points
+#  are returned as a single [lon,lat,...] vertex; pieces of the same feature are in order, and
+#  consecutive pieces share their end vertex
+class GridIndex():
+    def __init__(self,cellSize=0.01,pieceSize=32,maxCells=1024):
+        self.cellSize=cellSize # degrees; about 1 km
+        self.pieceSize=pieceSize
+        self.maxCells=maxCells
+        self.cells={} # key = (ix,iy), val = set of (id,piece number)
+        self.large=set() # (id,piece number) of pieces that cover more than maxCells cells
+        self.entries={} # key = id, val = list of (bbox,coordinates,cell keys) per piece
+        self.lock=threading.Lock()
+
+    def __contains__(self,id):
+        return id in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def pieces(self,geometry):
+        gt=geometry['type']
+        gc=geometry['coordinates']
+        if gt=='Point':
+            return [gc]
+        if gt=='Polygon':
+            gc=gc[0]
+        elif gt!='LineString':
+            return []
+        n=self.pieceSize
+        return [gc[i:i+n+1] for i in range(0,max(1,len(gc)-1),n)]
+
+    def cellRange(self,bbox):
+        s=self.cellSize
+        return (int(np.floor(bbox[0]/s)),int(np.floor(bbox[1]/s)),int(np.floor(bbox[2]/s)),int(np.floor(bbox[3]/s)))
+
+    # insert - add the feature, or replace it if it is already in the index
+    def insert(self,id,geometry):
+        entry=[]
+        for (i,piece) in enumerate(self.pieces(geometry or {'type':None,'coordinates':None})):
+            a=np.asarray([piece] if not isinstance(piece[0],(list,tuple)) else piece,dtype=float)[:,:2]
+            bbox=(a[:,0].min(),a[:,1].min(),a[:,0].max(),a[:,1].max())
+            (ix0,iy0,ix1,iy1)=self.cellRange(bbox)
+            if (ix1-ix0+1)*(iy1-iy0+1)>self.maxCells:
+                keys=None
+            else:
+                keys=[(ix,iy) for ix in range(ix0,ix1+1) for iy in range(iy0,iy1+1)]
+            entry.append((bbox,piece,keys))
+        with self.lock:
+            self.removeNow(id)
+            if not entry:
+                return
+            self.entries[id]=entry
+            for (i,(bbox,piece,keys)) in enumerate(entry):
+                if keys is None:
+                    self.large.add((id,i))
+                else:
+                    for key in keys:
+                        self.cells.setdefault(key,set()).add((id,i))
+
+    def remove(self,id):
+        with self.lock:
+            self.removeNow(id)
+
+    def removeNow(self,id):
+        entry=self.entries.pop(id,None)
+        if entry is None:
+            return
+        for (i,(bbox,piece,keys)) in enumerate(entry):
+            if keys is None:
+                self.large.discard((id,i))
+                continue
+            for key in keys:
+                cell=self.cells.get(key)
+                if cell is not None:
+                    cell.discard((id,i))
+                    if not cell:
+                        del self.cells[key]
+
+    # query - pieces that intersect the extent (minLon,minLat,maxLon,maxLat)
+    def query(self,extent):
+        (ix0,iy0,ix1,iy1)=self.cellRange(extent)
+        with self.lock:
+            found=set(self.large)
+            if (ix1-ix0+1)*(iy1-iy0+1)>len(self.cells):
+                for cell in self.cells.values():
+                    found|=cell
+            else:
+                for ix in range(ix0,ix1+1):
+                    for iy in range(iy0,iy1+1):
+                        cell=self.cells.get((ix,iy))
+                        if cell:
+                            found|=cell
+            rval=[]
+            for (id,i) in sorted(found):
+                (bbox,piece,keys)=self.entries[id][i]
+                if bbox[0]<=extent[2] and bbox[2]>=extent[0] and bbox[1]<=extent[3] and bbox[3]>=extent[1]:
+                    rval.append((id,piece))
+        return rval
@@ -0,0 +1,70 @@
+import logging
+import logging.handlers
+import sys
+import json
+import queue
+import atexit
+
+# logging for the debrief map generator
+#
+# log records are put on a queue by the thread that creates them, and written to the log file
+#  and the console by a separate listener thread, so that a slow disk or terminal never holds up
+#  the handling of source map events
+#
+# large structures (dmd, map data, features) should only be logged at DEBUG level, and only with
+#  LazyJson, so that they are never serialized unless DEBUG logging is actually enabled:
+#     logging.debug('dmd:\n%s',LazyJson(self.dmd))
+#
+# each handled source map event produces one structured record on the 'dmg.events' logger (see
+#  logEvent); the values are also attached to the record as attributes, for any handler that
+#  wants them as fields rather than text
+
+eventLogger=logging.getLogger('dmg.events')
+
+# LazyJson - json.dumps of obj, but only done if and when the log message is actually formatted
+class LazyJson():
+    def __init__(self,obj,indent=3):
+        self.obj=obj
+        self.indent=indent
+
+    def __str__(self):
+        return json.dumps(self.obj,indent=self.indent)
+
+# setupLogging - replace any existing root logger handlers with a queue handler, whose listener
+#  writes to <fileNameBase>_bg.log and (if console is True) to stdout; returns the listener (already started)
+def setupLogging(fileNameBase,level=logging.INFO,console=True):
+    # Remove all handlers associated with the root logger object.
+    #  (to redefine basicConfig, per stackoverflow.com/questions/12158048)
+    root=logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    formatter=logging.Formatter('%(asctime)s [%(levelname)s] %(message)s')
+    fileHandler=logging.FileHandler(fileNameBase+'_bg.log','w')
+    fileHandler.setFormatter(formatter)
+    handlers=[fileHandler]
+    if console:
+        streamHandler=logging.StreamHandler(sys.stdout)
+        streamHandler.setFormatter(formatter)
+        handlers.append(streamHandler)
+    logQueue=queue.SimpleQueue()
+    listener=logging.handlers.QueueListener(logQueue,*handlers,respect_handler_level=True)
+    root.addHandler(logging.handlers.QueueHandler(logQueue))
+    root.setLevel(level)
+    listener.start()
+    atexit.register(listener.stop) # write out anything still queued when the program exits
+    return listener
+
+# stopLogging - write out everything still queued, and stop the listener started by setupLogging
+def stopLogging(listener):
+    atexit.unregister(listener.stop)
+    listener.stop()
+
+# logEvent - one record per handled source map event
+#   kind - 'new', 'property', 'geometry' or 'deleted'
+#   sid - source feature id
+#   outing - outing title, or None if the feature doesn't belong to an outing
+#   duration - seconds spent handling the event
+def logEvent(kind,sid,outing,duration,ok=True):
+    if eventLogger.isEnabledFor(logging.INFO):
+        eventLogger.info('event %s sid=%s outing=%s duration=%.3f%s',kind,sid,outing,duration,'' if ok else ' FAILED',
+            extra={'event':kind,'sid':sid,'outing':outing,'duration':duration,'ok':ok})
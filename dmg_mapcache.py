@@ -0,0 +1,103 @@
+import logging
+import json
+import gzip
+import os
+import time
+from os import path
+from functools import partial
+
+# MapCache - cached copies of the source and target map data, for warm restarts
+#
+# On a cold start, opening each map session downloads every feature of the map, and then every
+#  source feature is reconciled against the target map, so restart time grows with the size of
+#  the incident.  Instead, when sartopo_bg stops cleanly, the map data of both sessions is saved
+#  along with each map's server sync timestamp; on the next start, each session's first sync
+#  starts from the cached copy and only asks the server for changes since that timestamp, and
+#  only the source features affected by those changes are reconciled (see sartopo_bg.start).
+#
+# cache file = <source>_<target>_maps.json.gz:
+#   {"version":1,"saved":<time>,
+#    "source":{"mapID":...,"timestamp":<server sync timestamp>,"mapData":{"ids":...,"state":...}},
+#    "target":{...}}
+#
+# the cache is only written after the source map sync has stopped and all source map events have
+#  been handled, so every feature in the cached source map data is already reflected in dmd; the
+#  dmd journal may be newer than the cache (after a crash), which only means that the changes
+#  since the cache timestamp include some that were already handled
+class MapCache():
+    version=1
+
+    def __init__(self,fileNameBase):
+        self.fileName=fileNameBase+'_maps.json.gz'
+
+    # load - return the cache dictionary, or None if there is no usable cache for these maps
+    def load(self,sourceMapID,targetMapID):
+        if not path.exists(self.fileName):
+            return None
+        try:
+            with gzip.open(self.fileName,'rt') as cacheFile:
+                cache=json.load(cacheFile)
+        except (OSError,ValueError,EOFError) as e:
+            logging.warning('map cache '+self.fileName+' could not be read ('+str(e)+'); doing a full sync instead')
+            return None
+        if cache.get('version')!=self.version:
+            logging.info('map cache '+self.fileName+' has version '+str(cache.get('version'))+' (expected '+str(self.version)+'); doing a full sync instead')
+            return None
+        if cache['source']['mapID']!=sourceMapID or cache['target']['mapID']!=targetMapID:
+            logging.warning('map cache '+self.fileName+' is for different maps; doing a full sync instead')
+            return None
+        logging.info('read map cache '+self.fileName+' saved '+time.strftime('%Y-%m-%d %H:%M:%S',time.localtime(cache['saved']))+
+            ': '+str(len(cache['source']['mapData']['state']['features']))+' source features, '+
+            str(len(cache['target']['mapData']['state']['features']))+' target features')
+        return cache
+
+    # save - write the map data and sync timestamps of both sessions; the sessions must not be
+    #  syncing while this is called
+    def save(self,sourceSession,targetSession):
+        cache={'version':self.version,'saved':time.time()}
+        for (side,session) in [('source',sourceSession),('target',targetSession)]:
+            timestamp=getattr(session,'lastSuccessfulSyncTimestamp',0)
+            if not timestamp:
+                logging.info('map cache not written: the '+side+' map session has no sync timestamp')
+                return False
+            cache[side]={'mapID':session.mapID,'timestamp':timestamp,'mapData':session.mapData}
+        tmpFileName=self.fileName+'.tmp'
+        with gzip.open(tmpFileName,'wt',compresslevel=1) as tmpFile:
+            json.dump(cache,tmpFile,separators=(',',':'))
+        os.replace(tmpFileName,self.fileName)
+        return True
+
+    # discard - remove the cache, so that the next start is a cold start
+    def discard(self):
+        if path.exists(self.fileName):
+            os.remove(self.fileName)
+
+# warmSessionClass - return a subclass of sessionClass (a SartopoSession-like class, or a partial
+#  of one) that takes an additional warmMapCache argument (one side of a MapCache dictionary):
+#  the session's first sync starts from the cached map data and timestamp instead of from an
+#  empty cache, so only the changes since then are downloaded (and passed to the callbacks);
+#  returns None if sessionClass does not sync that way (e.g. dmg_fakesession.FakeSession); a partial
+#  of a function that takes a sessionClass argument (e.g. dmg_supervisor.limitedSession) is handled too
+def warmSessionClass(sessionClass):
+    if isinstance(sessionClass,partial):
+        if 'sessionClass' in sessionClass.keywords:
+            c=warmSessionClass(sessionClass.keywords['sessionClass'])
+            return c and partial(sessionClass.func,*sessionClass.args,**dict(sessionClass.keywords,sessionClass=c))
+        c=warmSessionClass(sessionClass.func)
+        return c and partial(c,*sessionClass.args,**sessionClass.keywords)
+    # older sartopo_python versions call it doSync; newer versions call it _doSync
+    syncName=next((n for n in ['_doSync','doSync'] if hasattr(sessionClass,n)),None)
+    if syncName is None:
+        return None
+    baseSync=getattr(sessionClass,syncName)
+    def __init__(self,*args,warmMapCache=None,**kwargs):
+        self.warmMapCache=warmMapCache
+        sessionClass.__init__(self,*args,**kwargs)
+    def sync(self,*args,**kwargs):
+        cache=self.warmMapCache
+        if cache:
+            self.warmMapCache=None
+            self.mapData=cache['mapData']
+            self.lastSuccessfulSyncTimestamp=cache['timestamp']
+        return baseSync(self,*args,**kwargs)
+    return type('Warm'+sessionClass.__name__,(sessionClass,),{'__init__':__init__,syncName:sync})
@@ -0,0 +1,284 @@
+import logging
+import threading
+import time
+import json
+import io
+import bisect
+import cProfile
+import pstats
+from contextlib import contextmanager
+from functools import wraps
+from http.server import ThreadingHTTPServer,BaseHTTPRequestHandler
+
+# hot-path instrumentation for the debrief map generator
+#
+# Metrics - counters and latency histograms, kept in memory; sartopo_bg records:
+#   event.<kind> - handling of each source map event (new, property, geometry, deleted)
+#   reconcile.<op> - each reconcile plan operation (see dmg_reconcile.py)
+#   sts2.<method> - each target map session call (see instrumentSession)
+#   crop.local - local cropping of a track (see dmg_geometry.cropLine); server crops are sts2.crop
+#   simplify - track simplification
+#   dmd.journal, dmd.flush, dmd.snapshot - dmd persistence (see dmg_store.py)
+#   pdf.render - debrief PDF rendering, in the render worker process
+#  and counters such as events.failed; histograms have fixed buckets (bucketBounds, in seconds),
+#  so recording a value is one bisect and a few additions
+#
+# the metrics, plus the gauges from sartopo_bg.getStats (lag, queue depth, outings, corr size,
+#  uncropped tracks, etc.), are available as:
+#   - a compact stats line, logged every statsInterval seconds (see statsLine)
+#   - a local HTTP endpoint, if a metrics port is specified (see MetricsServer):
+#       /metrics - Prometheus text format
+#       /stats - json
+#
+# ProfileCapture - cProfile capture of source map event handling, started by a signal (SIGUSR2)
+
+bucketBounds=[0.0005,0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30,60] # seconds
+
+class Histogram():
+    def __init__(self):
+        self.counts=[0]*(len(bucketBounds)+1) # the last bucket is everything above the last bound
+        self.count=0
+        self.sum=0.0
+        self.max=0.0
+
+    def observe(self,value):
+        self.counts[bisect.bisect_left(bucketBounds,value)]+=1
+        self.count+=1
+        self.sum+=value
+        if value>self.max:
+            self.max=value
+
+    # quantile - upper bound of the bucket that contains the q quantile (no higher than max)
+    def quantile(self,q):
+        if not self.count:
+            return None
+        target=q*self.count
+        n=0
+        for (i,c) in enumerate(self.counts):
+            n+=c
+            if n>=target:
+                return min(self.max,bucketBounds[i]) if i<len(bucketBounds) else self.max
+        return self.max
+
+    def summary(self):
+        return {'count':self.count,'sum':self.sum,'max':self.max,
+            'p50':self.quantile(0.5),'p95':self.quantile(0.95),'p99':self.quantile(0.99)}
+
+class Metrics():
+    def __init__(self):
+        self.lock=threading.Lock()
+        self.counters={}
+        self.histograms={}
+
+    def count(self,name,n=1):
+        with self.lock:
+            self.counters[name]=self.counters.get(name,0)+n
+
+    def observe(self,name,seconds):
+        with self.lock:
+            h=self.histograms.get(name,None)
+            if h is None:
+                h=self.histograms[name]=Histogram()
+            h.observe(seconds)
+
+    # timer - context manager that records the duration of its block
+    @contextmanager
+    def timer(self,name):
+        t0=time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name,time.perf_counter()-t0)
+
+    # wrap - return a function that calls fn and records its duration
+    def wrap(self,name,fn):
+        @wraps(fn)
+        def timed(*args,**kwargs):
+            t0=time.perf_counter()
+            try:
+                return fn(*args,**kwargs)
+            finally:
+                self.observe(name,time.perf_counter()-t0)
+        return timed
+
+    def snapshot(self):
+        with self.lock:
+            return {'counters':dict(self.counters),
+                'histograms':{name:h.summary() for (name,h) in self.histograms.items()}}
+
+    # statsLine - one compact line: the gauges, then count / median / 95th percentile / max of each histogram
+    def statsLine(self,gauges={}):
+        def ms(v):
+            return '-' if v is None else ('%.1f'%(v*1000))
+        parts=[k+'='+(('%.1f'%v) if isinstance(v,float) else str(v)) for (k,v) in gauges.items()]
+        snap=self.snapshot()
+        parts+=[k+'='+str(v) for (k,v) in sorted(snap['counters'].items())]
+        line=' '.join(parts)
+        hists=['%s n=%d p50/p95/max=%s/%s/%sms'%(name,h['count'],ms(h['p50']),ms(h['p95']),ms(h['max']))
+            for (name,h) in sorted(snap['histograms'].items())]
+        return line+(' | '+'; '.join(hists) if hists else '')
+
+    # prometheusText - everything in Prometheus text exposition format; gauges is a dictionary of
+    #  numeric values (non-numeric values are skipped)
+    def prometheusText(self,gauges={},prefix='dmg_'):
+        def metricName(name):
+            return prefix+''.join(c if c.isalnum() else '_' for c in name)
+        lines=[]
+        for (name,v) in sorted(gauges.items()):
+            if isinstance(v,(int,float)):
+                lines+=['# TYPE '+metricName(name)+' gauge',metricName(name)+' '+repr(float(v))]
+        with self.lock:
+            for (name,v) in sorted(self.counters.items()):
+                lines+=['# TYPE '+metricName(name)+'_total counter',metricName(name)+'_total '+str(v)]
+            for (name,h) in sorted(self.histograms.items()):
+                m=metricName(name)+'_seconds'
+                lines.append('# TYPE '+m+' histogram')
+                n=0
+                for (bound,c) in zip(bucketBounds,h.counts):
+                    n+=c
+                    lines.append(m+'_bucket{le="'+repr(float(bound))+'"} '+str(n))
+                lines.append(m+'_bucket{le="+Inf"} '+str(h.count))
+                lines.append(m+'_sum '+repr(h.sum))
+                lines.append(m+'_count '+str(h.count))
+        return '\n'.join(lines)+'\n'
+
+# instrumentSession - record the duration of each call of the listed methods of a map session, as
+#  <prefix>.<method>; the methods are replaced on the session object itself (as dmg_supervisor's
+#  limitedSession does), so this works with any session class
+def instrumentSession(session,metrics,prefix,methods):
+    for name in methods:
+        method=getattr(session,name,None)
+        if method:
+            setattr(session,name,metrics.wrap(prefix+'.'+name,method))
+    return session
+
+# MetricsServer - local HTTP metrics endpoint, served from a daemon thread; getGauges() and getJson()
+#  are called for each request
+class MetricsServer():
+    def __init__(self,metrics,getGauges,getJson,port,host='127.0.0.1'):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                try:
+                    if self.path.split('?')[0]=='/metrics':
+                        body=metrics.prometheusText(getGauges()).encode()
+                        contentType='text/plain; version=0.0.4'
+                    elif self.path.split('?')[0] in ['/','/stats']:
+                        body=json.dumps(getJson(),indent=2,default=str).encode()
+                        contentType='application/json'
+                    else:
+                        self.send_error(404)
+                        return
+                except Exception:
+                    logging.exception('metrics request failed')
+                    self.send_error(500)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type',contentType)
+                self.send_header('Content-Length',str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self,format,*args):
+                logging.debug('metrics server: '+(format%args))
+        self.httpd=ThreadingHTTPServer((host,port),Handler)
+        self.httpd.daemon_threads=True
+        self.thread=threading.Thread(target=self.httpd.serve_forever,name='MetricsServer',daemon=True)
+
+    def start(self):
+        self.thread.start()
+        logging.info('metrics endpoint: http://'+self.httpd.server_address[0]+':'+str(self.httpd.server_address[1])+'/metrics')
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+# ProfileCapture - cProfile capture of the calls made through call(), for duration seconds after
+#  request() (e.g. from a SIGUSR2 handler; a second request ends the capture early); since cProfile
+#  only profiles the thread that enables it, each thread that runs a call gets its own profiler, and
+#  the results are combined at the end of the capture: written to <fileNameBase>_<time>.prof (for
+#  pstats or snakeviz), and the top functions by cumulative time are logged
+class ProfileCapture():
+    def __init__(self,fileNameBase,duration=30,top=25):
+        self.fileNameBase=fileNameBase
+        self.duration=duration
+        self.top=top
+        self.lock=threading.Condition()
+        self.active=False
+        self.profiles=[]
+        self.running=0 # calls being profiled right now
+        self.local=threading.local()
+        self.timer=None
+
+    # request - start a capture, or end the current one; safe to call from a signal handler, since
+    #  the capture is started and finished in other threads
+    def request(self,*args):
+        threading.Thread(target=self.toggle,name='ProfileCapture',daemon=True).start()
+
+    def toggle(self):
+        with self.lock:
+            if self.active:
+                finish=True
+            else:
+                finish=False
+                self.active=True
+                self.profiles=[]
+                self.local=threading.local()
+                self.timer=threading.Timer(self.duration,self.finish)
+                self.timer.daemon=True
+                self.timer.start()
+                logging.info('profile capture started for '+str(self.duration)+' seconds')
+        if finish:
+            self.finish()
+
+    def call(self,fn,*args,**kwargs):
+        local=self.local
+        if not self.active or getattr(local,'depth',0): # nested calls are profiled by the outer call
+            return fn(*args,**kwargs)
+        with self.lock:
+            if not self.active:
+                profile=None
+            else:
+                profile=getattr(local,'profile',None)
+                if profile is None:
+                    profile=local.profile=cProfile.Profile()
+                    self.profiles.append(profile)
+                self.running+=1
+        if profile is None:
+            return fn(*args,**kwargs)
+        local.depth=1
+        profile.enable()
+        try:
+            return fn(*args,**kwargs)
+        finally:
+            profile.disable()
+            local.depth=0
+            with self.lock:
+                self.running-=1
+                self.lock.notify_all()
+
+    # finish - end the capture, wait for the calls being profiled, then write and log the results
+    def finish(self,timeout=10):
+        with self.lock:
+            if not self.active:
+                return None
+            self.active=False
+            if self.timer:
+                self.timer.cancel()
+            deadline=time.time()+timeout
+            while self.running and time.time()<deadline:
+                self.lock.wait(max(0,deadline-time.time()))
+            profiles=self.profiles
+            self.profiles=[]
+        if not profiles:
+            logging.info('profile capture finished: nothing was profiled')
+            return None
+        stats=pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        fileName=self.fileNameBase+'_'+time.strftime('%Y%m%d-%H%M%S')+'.prof'
+        stats.dump_stats(fileName)
+        out=io.StringIO()
+        stats.stream=out
+        stats.sort_stats('cumulative').print_stats(self.top)
+        logging.info('profile capture finished ('+str(len(profiles))+' thread(s)); written to '+fileName+':\n'+out.getvalue())
+        return fileName
@@ -0,0 +1,139 @@
+import logging
+import threading
+import time
+
+# ReadinessTracker - per-outing debrief readiness: is the outing's debrief material complete and
+#  stable, and has it changed since its debrief PDF was last rendered?
+#
+# describe(title) returns the current description of an outing (or None if the outing no longer
+#  exists), a dictionary with:
+#   tracks - number of source tracks that have cropped lines in the outing
+#   uncropped - number of tracks waiting for the outing's boundary
+#   clues - number of clues shown on the outing's debrief
+#   boundary - True if the outing has a boundary
+#   hash - content hash of the boundary, cropped tracks and clues (see dmg_render.contentHash), or
+#      None if there is nothing to show yet
+#   rendered - content hash of the last rendered debrief PDF of the outing, or None
+#
+# whatever might change an outing calls touch(title) (or touchAll); every interval seconds, the
+#  tracker's thread describes each touched outing again, and calls callback(title,event,state):
+#   changed - the content hash changed, and is not the rendered one
+#   ready - the content has not changed for settle seconds, the outing has a boundary, at least one
+#      track and no uncropped tracks, and the content is not the rendered one; emitted once per
+#      version of the content
+# so a consumer (automatic PDF rendering, a UI) only needs to regenerate the outings that changed;
+#  outings that are not touched are not described again, so idle outings cost nothing
+#
+# state of each outing (see getStates) = the latest description, plus:
+#   modified - time at which the content hash last changed (or was first seen)
+#   ready - True once the ready event has been emitted for the current content
+class ReadinessTracker():
+    def __init__(self,describe,callback=None,settle=300,interval=5):
+        self.describe=describe
+        self.callback=callback
+        self.settle=settle
+        self.interval=interval
+        self.states={} # key = outing title
+        self.touched=set()
+        self.lock=threading.Condition()
+        self.checkLock=threading.Lock() # one check at a time
+        self.stopping=False
+        self.stats={
+            'checks':0,
+            'described':0, # describe calls
+            'changedEvents':0,
+            'readyEvents':0}
+        self.thread=threading.Thread(target=self.run,name='ReadinessTracker',daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self,timeout=None):
+        with self.lock:
+            self.stopping=True
+            self.lock.notify_all()
+        if self.thread.is_alive():
+            self.thread.join(timeout)
+
+    def touch(self,title):
+        with self.lock:
+            self.touched.add(title)
+
+    # touchAll - describe every known outing again, and also the specified titles (e.g. all outings
+    #  in dmd, to pick up outings that are not known yet)
+    def touchAll(self,titles=[]):
+        with self.lock:
+            self.touched.update(self.states.keys())
+            self.touched.update(titles)
+
+    def run(self):
+        while True:
+            with self.lock:
+                self.lock.wait(self.interval)
+                if self.stopping:
+                    return
+            try:
+                self.check()
+            except Exception:
+                logging.exception('debrief readiness check failed')
+
+    # check - describe the touched outings again, and emit the events that are due
+    def check(self,now=None):
+        with self.checkLock:
+            with self.lock:
+                touched=self.touched
+                self.touched=set()
+            if now is None:
+                now=time.time()
+            events=[]
+            for title in sorted(touched):
+                d=self.describe(title)
+                self.stats['described']+=1
+                old=self.states.get(title,None)
+                if d is None:
+                    self.states.pop(title,None)
+                    continue
+                if old is None or d['hash']!=old['hash']:
+                    self.states[title]=dict(d,modified=now,ready=False)
+                    if old is not None and d['hash']!=d['rendered']:
+                        events.append((title,'changed'))
+                else:
+                    old.update(d)
+            for (title,state) in self.states.items():
+                if not state['ready'] and now-state['modified']>=self.settle and self.isComplete(state) and state['hash']!=state['rendered']:
+                    state['ready']=True
+                    events.append((title,'ready'))
+            self.stats['checks']+=1
+            for (title,event) in events:
+                self.stats[event+'Events']+=1
+            events=[(title,event,dict(self.states[title])) for (title,event) in events]
+        # the callback is called without holding the lock, so it may use any method of the tracker
+        for (title,event,state) in events:
+            logging.info('debrief readiness: '+title+' '+event+' ('+str(state['tracks'])+' track(s), '+
+                str(state['clues'])+' clue(s), '+str(state['uncropped'])+' uncropped)')
+            if self.callback:
+                self.callback(title,event,state)
+
+    def isComplete(self,state):
+        return state['boundary'] and state['tracks']>0 and state['uncropped']==0 and state['hash'] is not None
+
+    # isChanged - True if the outing's content (as of the latest check) is not the rendered one
+    def isChanged(self,title):
+        with self.checkLock:
+            state=self.states.get(title,None)
+            return state is None or state['hash']!=state['rendered']
+
+    def getStates(self):
+        with self.checkLock:
+            return {title:dict(state) for (title,state) in self.states.items()}
+
+    def getStats(self):
+        with self.checkLock:
+            s=dict(self.stats)
+            s['outings']=len(self.states)
+            # outings whose content is not the rendered one, and those of them that are ready
+            s['changed']=sum(1 for state in self.states.values() if state['hash']!=state['rendered'])
+            s['ready']=sum(1 for state in self.states.values() if state['ready'] and state['hash']!=state['rendered'])
+        with self.lock:
+            s['touched']=len(self.touched)
+        return s
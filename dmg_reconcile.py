@@ -0,0 +1,312 @@
+import re
+from dmg_geometry import CropBoundary,DistanceBoundary,cropLine,simplifyLine,TrackFingerprint
+
+# reconciliation: compute the target (debrief) map state that should exist, as a pure function of
+#  the source map features plus the Debrief Map Data (dmd), compare it to the actual target map
+#  features, and produce an ordered plan of the operations needed to make them match
+#
+# nothing in this module reads or writes either map; sartopo_bg.reconcile gathers the inputs and
+#  applies the resulting plan (or just logs it, for a dry run)
+#
+# each plan entry is a dictionary with an 'op' key:
+#   addOuting - create folder and boundary for a source assignment, or adopt (f)
+#               the outing that was created for its tracks before it existed
+#   retitleOuting - rename an outing whose title gained a number            (outing, title)
+#   editBoundary - set the geometry of the current outing boundary           (outing, bid, geometry)
+#   addFeature - import a source feature that has no target correspondence  (f, pieces)
+#   replaceFeature - delete the target features, then import again          (f, tids, pieces)
+#   editFeature - edit properties and/or geometry of one target feature     (f, tid, properties, geometry)
+#   deleteFeatures - delete target features of a deleted source feature     (sid, tids)
+#  and a 'key' entry, which is the sartopo_bg.writeKey value for the operation: operations with the
+#  same key must be applied in plan order, and operations with different keys may be applied
+#  concurrently
+#
+# plan order: outings, then boundary edits, then tracks, then everything else, then deletions; since
+#  the key of an outing's assignment and tracks is the outing title, a cold start import creates each
+#  outing's folder and boundary before uploading its tracks, one chain of operations per outing
+#
+# for a track, pieces is the result of cropping it to its outing's crop boundary, which the plan needs
+#  to compute anyway; sartopo_bg uses it instead of cropping the track again, if it crops locally
+#  (None if the outing has no boundary yet)
+
+coordDigits=7 # coordinates are compared after rounding to this many decimal places (about 1cm)
+
+# roaming teams, such as trailing dogs or trackers, are expected to leave their assignment area,
+#  so their tracks are cropped to a distance from the assignment shape instead of to the boundary;
+#  an assignment is roaming if its resource type is one of roamingResourceTypes, or if its
+#  description contains roamingTag (for any other kind of team that should be handled the same way)
+roamingResourceTypes=['DOG_TRAIL','TRACKER']
+roamingTag='#ROAM'
+
+# parseTrackName: return False if not a track, or [assignment,team,suffix] if a track
+def parseTrackName(t):
+    tparse=re.split(r'(\d+)',t.upper().replace(' ',''))
+    if len(tparse)==3:
+        return tparse
+    else:
+        return False
+
+def outingTitleForTrack(tparse):
+    return tparse[0]+' '+tparse[1]
+
+def trackTitle(tparse):
+    return tparse[0].upper()+tparse[1]+tparse[2].lower()
+
+# isRoaming - True if the tracks of this source assignment's outings should be cropped by distance
+def isRoaming(f):
+    p=f['properties']
+    return p.get('class','')=='Assignment' and (str(p.get('resourceType','')).upper() in roamingResourceTypes or
+        roamingTag in str(p.get('description','')).upper())
+
+# isDuplicateTrack - True if source track f duplicates source track of (see sartopo_bg.findDuplicateTrack):
+#  both tracks belong to the same outing, and f is an exact copy of of, or (if duplicateTracks is
+#  'near') a near-identical one
+def isDuplicateTrack(f,of,duplicateTracks):
+    if duplicateTracks not in ['exact','near'] or not isTrack(f) or not isTrack(of):
+        return False
+    if outingTitleForTrack(parseTrackName(f['properties']['title']))!=outingTitleForTrack(parseTrackName(of['properties']['title'])):
+        return False
+    return TrackFingerprint(f['geometry']['coordinates']).matches(TrackFingerprint(of['geometry']['coordinates']),duplicateTracks=='near')
+
+# cropBoundaryFor - the boundary that tracks are cropped to: a bit beyond the assignment boundary,
+#  or, if roamingDistance is specified, that many meters from the assignment shape
+def cropBoundaryFor(geometry,cropBeyond,roamingDistance=None):
+    if roamingDistance:
+        return DistanceBoundary(geometry,roamingDistance)
+    return CropBoundary(geometry,cropBeyond)
+
+def isTrack(f):
+    p=f['properties']
+    g=f.get('geometry',None)
+    return p.get('class','')=='Shape' and bool(g) and g['type']=='LineString' and bool(parseTrackName(p.get('title','')))
+
+# projectedProperties - the target map properties that DMG derives from the source feature;
+#  any other source properties are never copied to the target map, so changes to them don't matter
+def projectedProperties(f,trackColorDict):
+    p=f['properties']
+    c=p.get('class','')
+    if c=='Assignment':
+        return {'title':p.get('title','').upper()}
+    if c=='Clue':
+        return {
+            'title':p.get('title',''),
+            'description':p.get('description',''),
+            'marker-symbol':'clue'}
+    if c=='Marker':
+        return {
+            'title':p.get('title',''),
+            'description':p.get('description',''),
+            'marker-color':p.get('marker-color',None),
+            'marker-rotation':p.get('marker-rotation',None),
+            'marker-size':p.get('marker-size',1),
+            'marker-symbol':p.get('marker-symbol',None)}
+    if c=='Shape':
+        gt=f['geometry']['type'] if f.get('geometry',None) else None
+        if gt=='LineString':
+            tparse=parseTrackName(p.get('title',''))
+            if tparse:
+                return {
+                    'title':trackTitle(tparse),
+                    'stroke':trackColorDict.get(tparse[2].lower(),'#444444')}
+            return {
+                'title':p.get('title',''),
+                'stroke':p.get('stroke',None),
+                'description':p.get('description',''),
+                'stroke-opacity':p.get('stroke-opacity',None),
+                'stroke-width':p.get('stroke-width',None),
+                'pattern':p.get('pattern',None)}
+        if gt=='Polygon':
+            return {
+                'title':p.get('title',''),
+                'stroke':p.get('stroke',None),
+                'stroke-width':p.get('stroke-width',None),
+                'stroke-opacity':p.get('stroke-opacity',None),
+                'fill-opacity':p.get('fill-opacity',None),
+                'description':p.get('description','')}
+    return {}
+
+# propertyFingerprint - everything about the source feature's properties that affects the target
+#  map: class, track name parse result, and projected properties; a property update that doesn't
+#  change the fingerprint doesn't need any target map changes
+def propertyFingerprint(f,trackColorDict):
+    p=f['properties']
+    tparse=parseTrackName(p.get('title','')) if isTrack(f) else False
+    props=projectedProperties(f,trackColorDict)
+    if p.get('class','')=='Assignment':
+        props['roaming']=isRoaming(f)
+    return (p.get('class',''),tuple(tparse) if tparse else None,tuple(sorted((k,str(v)) for (k,v) in props.items())))
+
+def roundCoords(coords):
+    return [(round(c[0],coordDigits),round(c[1],coordDigits)) for c in coords]
+
+# geometryKey - comparable version of a geometry (2D, rounded)
+def geometryKey(g):
+    if not g:
+        return None
+    gt=g['type']
+    gc=g['coordinates']
+    if gt=='Point':
+        return (gt,tuple(roundCoords([gc])))
+    if gt=='LineString':
+        return (gt,tuple(roundCoords(gc)))
+    if gt=='Polygon':
+        return (gt,tuple(roundCoords(gc[0])))
+    return (gt,repr(gc))
+
+def propertiesDiffer(desired,actual):
+    return any(str(v)!=str(actual.get(k,None)) for (k,v) in desired.items())
+
+# planReconcile - return the ordered list of operations that would make the target map match the
+#  source map
+#   sourceFeatures - list of source map features (sts1.mapData['state']['features'])
+#   targetFeatures - dictionary of target map features, key = id
+#   dmd - Debrief Map Data (outings and corr)
+#   trackColorDict, cropBeyond - as used by sartopo_bg
+#   sids - if specified, only consider these source feature ids (plus deletions of any of them);
+#           otherwise consider every source feature and every correspondence entry
+#   writeKey - function(feature) that returns the operation key
+#   roamingDistance - crop distance (meters) for tracks of roaming outings (see isRoaming); if not
+#           specified, every track is cropped to its boundary
+#   simplifyTolerance, quantizeDigits - if simplifyTolerance is specified, tracks are simplified
+#           before cropping, as sartopo_bg does (see dmg_geometry.simplifyLine)
+#   duplicateTracks - 'exact' or 'near': a track in dmd['dups'] is left alone as long as it is still
+#           a duplicate of its imported original (see isDuplicateTrack)
+def planReconcile(sourceFeatures,targetFeatures,dmd,trackColorDict,cropBeyond,writeKey,sids=None,roamingDistance=None,
+        simplifyTolerance=None,quantizeDigits=None,duplicateTracks=None):
+    outings=dmd['outings']
+    corr=dmd['corr']
+    dups=dmd.get('dups',{})
+    sourceById={f['id']:f for f in sourceFeatures}
+    if sids is None:
+        sids=set(sourceById.keys())|set(corr.keys())
+    else:
+        sids=set(sids)
+    sidToOutings={}
+    for (ot,o) in outings.items():
+        sidToOutings.setdefault(o['sid'],[]).append(ot)
+
+    outingOps=[]
+    boundaryOps=[]
+    trackOps=[]
+    otherOps=[]
+    deleteOps=[]
+
+    # boundary geometry that each outing will have after the plan is applied: key = outing title
+    boundaries={ot:targetFeatures[o['bid']]['geometry'] for (ot,o) in outings.items() if o['bid'] in targetFeatures}
+    # crop mode of each outing: True if its tracks are cropped by distance; key = outing title
+    roaming={ot:isRoaming(sourceById[o['sid']]) for (ot,o) in outings.items() if o['sid'] in sourceById}
+
+    # outings that were created for tracks before their assignment existed, and that will be
+    #  adopted by the assignment (see sartopo_bg.addOuting); their tracks are cropped when that happens
+    adopted=set()
+
+    # 1. assignments / outings: same rules as sartopo_bg.addOuting and propertyUpdateCallback;
+    #  every assignment is checked (even if not in sids) since its boundary is needed for tracks
+    for f in sourceFeatures:
+        if f['properties'].get('class','')!='Assignment':
+            continue
+        sid=f['id']
+        t=f['properties'].get('title','').upper()
+        ots=sidToOutings.get(sid,[])
+        current=None
+        for ot in ots:
+            if t==ot or 'NOTITLE' in ot:
+                current=ot
+                break
+        hasNumber=any(char.isdigit() for char in t)
+        if current is None:
+            if not ots or hasNumber:
+                if sid in sids:
+                    outingOps.append({'op':'addOuting','key':writeKey(f),'f':f})
+                    if t in outings and outings[t]['sid'] is None:
+                        adopted.add(t)
+                boundaries[t or 'NOTITLE']=f['geometry']
+                roaming[t or 'NOTITLE']=isRoaming(f)
+            continue
+        if current!=t and hasNumber and not any(char.isdigit() for char in current):
+            # blank or letter-only outing title gained a number
+            if sid in sids:
+                outingOps.append({'op':'retitleOuting','key':writeKey(f),'outing':current,'title':t})
+            boundaries[t]=boundaries.pop(current,None)
+            roaming[t]=roaming.pop(current,False)
+            current=t
+        if current==t:
+            o=outings.get(current if current in outings else ots[0])
+            if sid in sids and o['bid'] in targetFeatures and geometryKey(targetFeatures[o['bid']]['geometry'])!=geometryKey(f['geometry']):
+                boundaryOps.append({'op':'editBoundary','key':writeKey(f),'outing':current,'bid':o['bid'],'geometry':f['geometry']})
+            boundaries[current]=f['geometry']
+            roaming[current]=isRoaming(f)
+
+    # 2. all other source features
+    cropBoundaries={} # cache, key = outing title
+    for sid in sorted(sids&set(sourceById.keys())):
+        f=sourceById[sid]
+        c=f['properties'].get('class','')
+        if c=='Assignment' or c not in ['Shape','Marker','Clue']:
+            continue
+        tids=corr.get(sid,[])
+        complete=bool(tids) and all(tid in targetFeatures for tid in tids)
+        props=projectedProperties(f,trackColorDict)
+        if isTrack(f):
+            ops=trackOps
+            osid=dups.get(sid,None)
+            if osid in corr and osid in sourceById and isDuplicateTrack(f,sourceById[osid],duplicateTracks):
+                continue
+            tparse=parseTrackName(f['properties']['title'])
+            at=outingTitleForTrack(tparse)
+            if at in adopted and tids and set(tids)<=set(outings[at]['utids']):
+                continue
+            bg=boundaries.get(at,None)
+            coords=f['geometry']['coordinates']
+            if simplifyTolerance:
+                coords=simplifyLine(coords,simplifyTolerance,quantizeDigits)
+            if bg:
+                cb=cropBoundaries.get(at,None)
+                if cb is None:
+                    cb=cropBoundaryFor(bg,cropBeyond,roamingDistance if roaming.get(at,False) else None)
+                    cropBoundaries[at]=cb
+                pieces=cropLine(coords,cb)
+                desiredPieces=[tuple(roundCoords(piece)) for piece in pieces]
+            else: # no boundary yet: the track is uncropped
+                pieces=None
+                desiredPieces=[tuple(roundCoords(coords))]
+            if not desiredPieces and not tids: # no part of the track is inside the boundary
+                continue
+            if not complete:
+                ops.append({'op':'replaceFeature' if tids else 'addFeature','key':writeKey(f),'f':f,'tids':tids,'pieces':pieces})
+                continue
+            actualPieces=[tuple(roundCoords(targetFeatures[tid]['geometry']['coordinates'])) for tid in tids]
+            actualFolders={targetFeatures[tid]['properties'].get('folderId',None) for tid in tids}
+            o=outings.get(at,None)
+            if desiredPieces!=actualPieces or o is None or actualFolders!={o['fid']}:
+                ops.append({'op':'replaceFeature','key':writeKey(f),'f':f,'tids':tids,'pieces':pieces})
+            else:
+                for tid in tids:
+                    if propertiesDiffer(props,targetFeatures[tid]['properties']):
+                        ops.append({'op':'editFeature','key':writeKey(f),'f':f,'tid':tid,'properties':props,'geometry':None})
+        else:
+            ops=otherOps
+            if not complete or len(tids)!=1:
+                ops.append({'op':'replaceFeature' if tids else 'addFeature','key':writeKey(f),'f':f,'tids':tids})
+                continue
+            tf=targetFeatures[tids[0]]
+            geometry=None
+            if geometryKey(tf.get('geometry',None))!=geometryKey(f['geometry']):
+                geometry=f['geometry']
+            if geometry or propertiesDiffer(props,tf['properties']):
+                ops.append({'op':'editFeature','key':writeKey(f),'f':f,'tid':tids[0],'properties':props,'geometry':geometry})
+
+    # 3. correspondences whose source feature no longer exists
+    for sid in sorted(sids-set(sourceById.keys())):
+        tids=[tid for tid in corr.get(sid,[]) if tid in targetFeatures]
+        if sid in corr:
+            deleteOps.append({'op':'deleteFeatures','key':sid,'sid':sid,'tids':tids})
+
+    return outingOps+boundaryOps+trackOps+otherOps+deleteOps
+
+# summarizePlan - count of operations of each type
+def summarizePlan(plan):
+    summary={}
+    for op in plan:
+        summary[op['op']]=summary.get(op['op'],0)+1
+    return summary
@@ -0,0 +1,593 @@
+import logging
+import json
+import gzip
+import math
+import os
+import re
+import time
+import heapq
+import hashlib
+import threading
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from os import path
+import numpy as np
+from dmg_geometry import CropBoundary,GridIndex
+
+# debrief PDF rendering
+#
+# one PDF per outing, showing (per README.md) the assignment boundary, the outing's cropped
+#  tracks, and the clues located by the team, zoomed and positioned to fill the page with a
+#  buffer; other clues and markers, and lines that don't belong to any outing, are drawn only if
+#  they are inside that print area
+#
+# render jobs are plain dictionaries (so they can be sent to a worker process):
+#   title - outing title
+#   fileName - output PDF file name
+#   layout - from choosePrintLayout
+#   boundary - {'coordinates':[[lon,lat],...],'stroke':color,'closed':bool} or None
+#   tracks - list of {'title','stroke','coordinates'}
+#   clues - list of {'title','coordinates':[lon,lat]} (this outing's clues)
+#   markers - list of {'title','coordinates':[lon,lat],'symbol','color'} (other clues and markers)
+#   lines - list of {'title','stroke','coordinates'} (lines and polygon outlines that don't belong
+#      to any outing, or the parts of them that are near the print area)
+#   tileDir - optional local tile cache: <tileDir>/<zoom>/<x>/<y>.jpg (web mercator, 256 pixels);
+#      tiles that aren't in the cache are left blank, and with no tile cache at all, the map area
+#      gets a plain background with a 1 km grid instead (stand-in renderer)
+#   contentHash - see contentHash; returned in the render result, so that the caller knows which
+#      version of the outing was rendered (see dmg_readiness.py)
+#
+# RenderQueue renders jobs in a process pool, highest priority first; see sartopo_bg.requestPdf
+
+papers={'letter':(612,792),'legal':(612,1008),'tabloid':(792,1224),'a4':(595,842),'a3':(842,1191)} # points
+
+earthRadius=6378137.0
+tileSize=256
+maxZoom=17
+
+# merc - web mercator projection of lon,lat (degrees; numpy arrays or scalars) to meters
+def merc(lon,lat):
+    lat=np.clip(lat,-85.0511,85.0511)
+    x=np.radians(lon)*earthRadius
+    y=np.log(np.tan(np.pi/4+np.radians(lat)/2))*earthRadius
+    return (x,y)
+
+def unmerc(x,y):
+    return (np.degrees(x/earthRadius),np.degrees(2*np.arctan(np.exp(y/earthRadius))-np.pi/2))
+
+# computePrintExtent - lon/lat bounding box (minLon,minLat,maxLon,maxLat) of the coordinate lists
+#  (each a list of [lon,lat,...] vertices, or a single [lon,lat,...] point); None if empty
+def computePrintExtent(coordLists):
+    boxes=[]
+    for coords in coordLists:
+        if not coords:
+            continue
+        a=np.asarray([coords] if not isinstance(coords[0],(list,tuple)) else coords,dtype=float)[:,:2]
+        boxes.append([a[:,0].min(),a[:,1].min(),a[:,0].max(),a[:,1].max()])
+    if not boxes:
+        return None
+    b=np.array(boxes)
+    return (b[:,0].min(),b[:,1].min(),b[:,2].max(),b[:,3].max())
+
+# choosePrintLayout - pick the paper orientation that best fits the extent, expand the extent by
+#  buffer (fraction of its size on each side, at least minSpan meters overall) and then to the
+#  aspect ratio of the map area of the page, and pick the tile zoom level that gives at least dpi
+#  dots per inch; returns a dictionary:
+#   orientation - 'portrait' or 'landscape'
+#   pageSize - (width,height) in points
+#   mapBox - (x0,y0,x1,y1) map area of the page, in points
+#   mercBox - (x0,y0,x1,y1) web mercator meters shown in the map area
+#   extent - (minLon,minLat,maxLon,maxLat) shown in the map area
+#   zoom - tile zoom level
+#   scale - approximate ground scale denominator (1:scale) at the center latitude
+def choosePrintLayout(extent,paper='letter',buffer=0.1,margin=36,header=40,dpi=150,minSpan=500):
+    (w,h)=papers.get(paper.lower(),papers['letter'])
+    (x0,y0)=merc(extent[0],extent[1])
+    (x1,y1)=merc(extent[2],extent[3])
+    (cx,cy)=((x0+x1)/2,(y0+y1)/2)
+    # ground distance in mercator meters is stretched by 1/cos(lat)
+    stretch=1/math.cos(math.radians((extent[1]+extent[3])/2))
+    minSpan*=stretch
+    ew=max(x1-x0,minSpan)*(1+2*buffer)
+    eh=max(y1-y0,minSpan)*(1+2*buffer)
+    best=None
+    for (orientation,pw,ph) in [('portrait',w,h),('landscape',h,w)]:
+        mw=pw-2*margin
+        mh=ph-2*margin-header
+        metersPerPoint=max(ew/mw,eh/mh)
+        if best is None or metersPerPoint<best[0]:
+            best=(metersPerPoint,orientation,pw,ph,mw,mh)
+    (metersPerPoint,orientation,pw,ph,mw,mh)=best
+    mercBox=(cx-mw*metersPerPoint/2,cy-mh*metersPerPoint/2,cx+mw*metersPerPoint/2,cy+mh*metersPerPoint/2)
+    metersPerPixel=metersPerPoint*72/dpi
+    zoom=int(math.ceil(math.log2(2*math.pi*earthRadius/tileSize/metersPerPixel)))
+    (lon0,lat0)=unmerc(mercBox[0],mercBox[1])
+    (lon1,lat1)=unmerc(mercBox[2],mercBox[3])
+    return {'orientation':orientation,'pageSize':(pw,ph),
+        'mapBox':(margin,margin,margin+mw,margin+mh),
+        'mercBox':mercBox,'extent':(float(lon0),float(lat0),float(lon1),float(lat1)),
+        'zoom':max(0,min(maxZoom,zoom)),
+        'scale':int(round(metersPerPoint/stretch*72/0.0254))}
+
+# printTolerance - ground distance (meters) of one printer dot at the specified map scale
+#  (e.g. 24000 for 1:24000); track detail smaller than this can't be seen on a debrief printout
+def printTolerance(scale,dpi=150):
+    return scale*0.0254/dpi
+
+# inPrintArea - True if any vertex of the coordinate list (or the single point) is inside the
+#  lon/lat extent of the layout
+def inPrintArea(layout,coords):
+    if not coords:
+        return False
+    a=np.asarray([coords] if not isinstance(coords[0],(list,tuple)) else coords,dtype=float)[:,:2]
+    e=layout['extent']
+    return bool(np.any((a[:,0]>=e[0])&(a[:,0]<=e[2])&(a[:,1]>=e[1])&(a[:,1]<=e[3])))
+
+# PdfPage - minimal single-page PDF writer (vector paths, Helvetica text, and JPEG images), so
+#  that rendering needs no additional packages
+class PdfPage():
+    def __init__(self,width,height):
+        self.width=width
+        self.height=height
+        self.ops=[]
+        self.images=[] # list of (name,jpeg bytes,pixel width,pixel height)
+        self.opacities=[] # one graphics state per distinct opacity
+
+    def color(self,c,stroke=True):
+        (r,g,b)=parseColor(c)
+        self.ops.append('%.3f %.3f %.3f %s'%(r,g,b,'RG' if stroke else 'rg'))
+
+    def path(self,pts,close=False,width=1,color='#000000',fill=None,opacity=None,dash=None):
+        if len(pts)<1:
+            return
+        self.ops.append('q')
+        if opacity is not None:
+            self.ops.append('/GS%d gs'%self.opacityState(opacity))
+        self.color(color)
+        if fill:
+            self.color(fill,stroke=False)
+        self.ops.append('%.2f w 1 J 1 j'%width)
+        if dash:
+            self.ops.append('[%s] 0 d'%' '.join(str(d) for d in dash))
+        self.ops.append('%.2f %.2f m '%tuple(pts[0])+' '.join('%.2f %.2f l'%tuple(p) for p in pts[1:]))
+        self.ops.append(('b' if fill else 's') if close else 'S')
+        self.ops.append('Q')
+
+    def opacityState(self,opacity):
+        if opacity not in self.opacities:
+            self.opacities.append(opacity)
+        return self.opacities.index(opacity)
+
+    def rect(self,x0,y0,x1,y1,color='#000000',fill=None,width=1):
+        self.path([(x0,y0),(x1,y0),(x1,y1),(x0,y1)],close=True,color=color,fill=fill,width=width)
+
+    def text(self,x,y,s,size=10,color='#000000'):
+        s=str(s).encode('latin-1','replace').decode('latin-1')
+        s=s.replace('\\','\\\\').replace('(','\\(').replace(')','\\)')
+        self.ops.append('q')
+        self.color(color,stroke=False)
+        self.ops.append('BT /F1 %.1f Tf %.2f %.2f Td (%s) Tj ET'%(size,x,y,s))
+        self.ops.append('Q')
+
+    def clip(self,x0,y0,x1,y1):
+        self.ops.append('%.2f %.2f %.2f %.2f re W n'%(x0,y0,x1-x0,y1-y0))
+
+    def image(self,jpeg,x,y,w,h):
+        size=jpegSize(jpeg)
+        if size is None:
+            return
+        name='Im%d'%len(self.images)
+        self.images.append((name,jpeg,size[0],size[1]))
+        self.ops.append('q %.3f 0 0 %.3f %.3f %.3f cm /%s Do Q'%(w,h,x,y,name))
+
+    def save(self,fileName):
+        objects=[]
+        def add(body):
+            objects.append(body)
+            return len(objects)
+        catalog=add(None)
+        pages=add(None)
+        page=add(None)
+        font=add(b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>')
+        content=' \n'.join(self.ops).encode('latin-1')
+        contentObj=add(b'<< /Length %d >>\nstream\n'%len(content)+content+b'\nendstream')
+        xobjects=[]
+        for (name,jpeg,pw,ph) in self.images:
+            n=add(b'<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /DCTDecode /Length %d >>\nstream\n'%(pw,ph,len(jpeg))+jpeg+b'\nendstream')
+            xobjects.append('/%s %d 0 R'%(name,n))
+        states=' '.join('/GS%d << /CA %.2f /ca %.2f >>'%(i,o,o) for (i,o) in enumerate(self.opacities))
+        objects[catalog-1]=b'<< /Type /Catalog /Pages %d 0 R >>'%pages
+        objects[pages-1]=b'<< /Type /Pages /Kids [%d 0 R] /Count 1 >>'%page
+        objects[page-1]=('<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %d %d] /Contents %d 0 R /Resources << /Font << /F1 %d 0 R >> /XObject << %s >> /ExtGState << %s >> >> >>'%(
+            pages,self.width,self.height,contentObj,font,' '.join(xobjects),states)).encode('latin-1')
+        out=bytearray(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        offsets=[]
+        for (i,body) in enumerate(objects):
+            offsets.append(len(out))
+            out+=b'%d 0 obj\n'%(i+1)+body+b'\nendobj\n'
+        xref=len(out)
+        out+=b'xref\n0 %d\n0000000000 65535 f \n'%(len(objects)+1)
+        for o in offsets:
+            out+=b'%010d 00000 n \n'%o
+        out+=b'trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n'%(len(objects)+1,catalog,xref)
+        tmpFileName=fileName+'.tmp'
+        with open(tmpFileName,'wb') as f:
+            f.write(out)
+        os.replace(tmpFileName,fileName)
+        return len(out)
+
+def parseColor(c):
+    m=re.match(r'#?([0-9a-fA-F]{6})$',str(c or ''))
+    if not m:
+        return (1.0,0.0,0.0)
+    v=m.group(1)
+    return tuple(int(v[i:i+2],16)/255 for i in (0,2,4))
+
+# jpegSize - (width,height) from the SOF marker of a JPEG file, or None
+def jpegSize(data):
+    i=2
+    while i+9<len(data):
+        if data[i]!=0xFF:
+            return None
+        marker=data[i+1]
+        length=int.from_bytes(data[i+2:i+4],'big')
+        if marker in (0xC0,0xC1,0xC2):
+            return (int.from_bytes(data[i+7:i+9],'big'),int.from_bytes(data[i+5:i+7],'big'))
+        i+=2+length
+    return None
+
+# renderDebriefPdf - render one job (see the top of this file) to its fileName; this runs in a
+#  worker process; returns a result dictionary
+def renderDebriefPdf(job):
+    t0=time.time()
+    layout=job['layout']
+    (pw,ph)=layout['pageSize']
+    (mx0,my0,mx1,my1)=layout['mapBox']
+    (bx0,by0,bx1,by1)=layout['mercBox']
+    k=(mx1-mx0)/(bx1-bx0)
+    def toPage(coords):
+        a=np.asarray(coords,dtype=float)[:,:2]
+        (x,y)=merc(a[:,0],a[:,1])
+        return np.column_stack([mx0+(x-bx0)*k,my0+(y-by0)*k])
+    page=PdfPage(pw,ph)
+    page.ops.append('q')
+    page.clip(mx0,my0,mx1,my1)
+    tiles=drawTiles(page,layout,job.get('tileDir'),toPage) if job.get('tileDir') else 0
+    if not tiles:
+        drawGrid(page,layout,k)
+    for line in job.get('lines',[]):
+        page.path(toPage(line['coordinates']),width=1.5,color=line.get('stroke') or '#404040',opacity=0.7)
+    b=job.get('boundary')
+    if b:
+        page.path(toPage(b['coordinates']),close=b.get('closed',True),width=4,color=b.get('stroke') or '#FF0000',opacity=0.5)
+    for track in job.get('tracks',[]):
+        page.path(toPage(track['coordinates']),width=2,color=track.get('stroke') or '#FF0000')
+    for m in job.get('markers',[]):
+        (x,y)=toPage([m['coordinates']])[0]
+        drawMarker(page,x,y,m.get('symbol'),m.get('color') or '#808080',m.get('title',''),size=5,labelColor='#404040')
+    for c in job.get('clues',[]):
+        (x,y)=toPage([c['coordinates']])[0]
+        drawMarker(page,x,y,'clue','#FFFF00',c.get('title',''),size=7,labelColor='#000000')
+    page.ops.append('Q')
+    page.rect(mx0,my0,mx1,my1,width=0.75)
+    page.text(mx0,my1+16,job['title'],size=16)
+    page.text(mx0,my1+4,'1:'+format(layout['scale'],',')+'   '+str(len(job.get('tracks',[])))+' track(s), '+
+        str(len(job.get('clues',[])))+' clue(s)   generated '+time.strftime('%Y-%m-%d %H:%M'),size=8)
+    drawScaleBar(page,mx1,my0-14,k,(layout['extent'][1]+layout['extent'][3])/2)
+    size=page.save(job['fileName'])
+    return {'title':job['title'],'fileName':job['fileName'],'bytes':size,'tiles':tiles,'seconds':round(time.time()-t0,3),
+        'contentHash':job.get('contentHash')}
+
+def drawMarker(page,x,y,symbol,color,title,size=5,labelColor='#000000'):
+    if symbol=='clue':
+        page.path([(x-size,y-size*0.8),(x+size,y-size*0.8),(x,y+size)],close=True,width=1,color='#000000',fill=color)
+    else:
+        page.rect(x-size/2,y-size/2,x+size/2,y+size/2,color='#000000',fill=color,width=0.5)
+    if title:
+        page.text(x+size+2,y-3,title,size=8,color=labelColor)
+
+# drawTiles - draw the cached tiles that cover the map area; returns the number of tiles drawn
+def drawTiles(page,layout,tileDir,toPage):
+    z=layout['zoom']
+    n=2**z
+    (lon0,lat0,lon1,lat1)=layout['extent']
+    def tileXY(lon,lat):
+        (x,y)=merc(lon,lat)
+        return (int((x/(2*math.pi*earthRadius)+0.5)*n),int((0.5-y/(2*math.pi*earthRadius))*n))
+    (tx0,ty1)=tileXY(lon0,lat0)
+    (tx1,ty0)=tileXY(lon1,lat1)
+    count=0
+    for tx in range(tx0,tx1+1):
+        for ty in range(ty0,ty1+1):
+            fileName=path.join(tileDir,str(z),str(tx),str(ty)+'.jpg')
+            if not path.exists(fileName):
+                continue
+            with open(fileName,'rb') as f:
+                jpeg=f.read()
+            # tile corners in lon/lat, then in page points
+            (wlon,nlat)=unmerc((tx/n-0.5)*2*math.pi*earthRadius,(0.5-ty/n)*2*math.pi*earthRadius)
+            (elon,slat)=unmerc(((tx+1)/n-0.5)*2*math.pi*earthRadius,(0.5-(ty+1)/n)*2*math.pi*earthRadius)
+            ((x0,y0),(x1,y1))=toPage([[wlon,slat],[elon,nlat]])
+            page.image(jpeg,x0,y0,x1-x0,y1-y0)
+            count+=1
+    return count
+
+# drawGrid - stand-in background: light 1 km grid (approximate, at the center latitude)
+def drawGrid(page,layout,k):
+    (mx0,my0,mx1,my1)=layout['mapBox']
+    (lon0,lat0,lon1,lat1)=layout['extent']
+    step=1000/math.cos(math.radians((lat0+lat1)/2))*k # points per km
+    if step<8:
+        return
+    x=mx0
+    while x<=mx1:
+        page.path([(x,my0),(x,my1)],width=0.3,color='#C0C0C0')
+        x+=step
+    y=my0
+    while y<=my1:
+        page.path([(mx0,y),(mx1,y)],width=0.3,color='#C0C0C0')
+        y+=step
+
+def drawScaleBar(page,xRight,y,k,lat):
+    pointsPerMeter=k/math.cos(math.radians(lat))
+    target=100/pointsPerMeter # meters in about 100 points
+    meters=max(m for m in [10,20,50,100,200,500,1000,2000,5000,10000,20000,50000] if m<=target) if target>=10 else 10
+    length=meters*pointsPerMeter
+    page.path([(xRight-length,y),(xRight,y)],width=2)
+    page.text(xRight-length,y-10,(str(meters//1000)+' km') if meters>=1000 else (str(meters)+' m'),size=8)
+
+# RenderQueue - background queue of debrief PDF requests, rendered in a process pool
+#
+# buildJob(title) is called (in the dispatcher thread, when a worker is free) to build the render
+#  job for an outing from the current map data, so a request that waits in the queue still gets
+#  the latest tracks; it returns None if there is nothing to render
+# requesting an outing that is already queued just raises its priority (lower number = sooner;
+#  the default priority is the request time, i.e. first come first served); requesting an outing
+#  that is being rendered queues it again, so the PDF is rendered again with the latest data
+class RenderQueue():
+    def __init__(self,buildJob,workers=4,render=renderDebriefPdf,resultCallback=None):
+        self.buildJob=buildJob
+        self.render=render
+        self.resultCallback=resultCallback
+        self.workers=workers
+        self.pool=None
+        self.lock=threading.Condition()
+        self.heap=[] # (priority,seq,title)
+        self.queued={} # key = title, val = priority
+        self.active=set()
+        self.seq=0
+        self.stopping=False
+        self.thread=None
+        self.stats={'requested':0,'rendered':0,'failed':0,'skipped':0}
+        self.results={} # key = title, val = latest result dictionary
+
+    def start(self):
+        self.pool=ProcessPoolExecutor(self.workers)
+        self.thread=threading.Thread(target=self.run,name='RenderQueue',daemon=True)
+        self.thread.start()
+
+    def request(self,title,priority=None):
+        if priority is None:
+            priority=time.time()
+        with self.lock:
+            self.stats['requested']+=1
+            if title in self.queued and self.queued[title]<=priority:
+                return
+            self.queued[title]=priority
+            self.seq+=1
+            heapq.heappush(self.heap,(priority,self.seq,title))
+            self.lock.notify_all()
+
+    def getStats(self):
+        with self.lock:
+            s=dict(self.stats)
+            s['queued']=len(self.queued)
+            s['active']=len(self.active)
+            return s
+
+    def run(self):
+        while True:
+            with self.lock:
+                while True:
+                    if self.stopping:
+                        return
+                    title=self.nextTitle() if len(self.active)<self.workers else None
+                    if title:
+                        break
+                    self.lock.wait()
+                del self.queued[title]
+                self.active.add(title)
+            try:
+                job=self.buildJob(title)
+            except Exception:
+                logging.exception('debrief PDF job for '+title+' could not be built')
+                job=None
+            if job is None:
+                with self.lock:
+                    self.stats['skipped']+=1
+                    self.active.discard(title)
+                    self.lock.notify_all()
+                continue
+            future=self.pool.submit(self.render,job)
+            future.add_done_callback(lambda fut,title=title:self.done(title,fut))
+
+    # nextTitle - pop the highest priority queued outing that is not being rendered right now;
+    #  call this with the lock held
+    def nextTitle(self):
+        deferred=[]
+        title=None
+        while self.heap:
+            entry=heapq.heappop(self.heap)
+            if self.queued.get(entry[2])!=entry[0]:
+                continue # stale entry: the priority was raised since
+            if entry[2] in self.active:
+                deferred.append(entry)
+                continue
+            title=entry[2]
+            break
+        for entry in deferred:
+            heapq.heappush(self.heap,entry)
+        return title
+
+    def done(self,title,future):
+        try:
+            result=future.result()
+            logging.info('debrief PDF rendered: '+str(result))
+            key='rendered'
+        except Exception as e:
+            result={'title':title,'error':str(e)}
+            logging.error('debrief PDF for '+title+' failed: '+str(e))
+            key='failed'
+        with self.lock:
+            self.stats[key]+=1
+            self.results[title]=result
+            self.active.discard(title)
+            self.lock.notify_all()
+        if self.resultCallback:
+            self.resultCallback(result)
+
+    # wait - block until nothing is queued or rendering; returns False on timeout
+    def wait(self,timeout=None):
+        deadline=None if timeout is None else time.time()+timeout
+        with self.lock:
+            while self.queued or self.active:
+                remaining=None if deadline is None else deadline-time.time()
+                if remaining is not None and remaining<=0:
+                    return False
+                self.lock.wait(remaining)
+        return True
+
+    def stop(self,wait=True):
+        with self.lock:
+            self.stopping=True
+            self.lock.notify_all()
+        if self.thread:
+            self.thread.join()
+        if self.pool:
+            self.pool.shutdown(wait=wait)
+
+# outingContent - the parts of an outing's debrief that belong to the outing itself, from dmd and the
+#  target map: getFeature(id) returns a target map feature (or None), and printIndex is a
+#  dmg_geometry.GridIndex of the target map features that don't belong to any outing (markers, clues,
+#  and other lines and polygons); clues located by the team are the clues inside the crop area of
+#  the assignment boundary (since target map clues are not linked to outings); returns
+#  (boundary,tracks,clues,clueIds), in render job format (see the top of this file)
+def outingContent(outing,getFeature,printIndex,cropBeyond=0.001):
+    b=getFeature(outing['bid']) if outing.get('bid') else None
+    tracks=[]
+    for tidList in outing['tids']:
+        for tid in tidList:
+            f=getFeature(tid)
+            if f and f['geometry'] and f['geometry'].get('coordinates'):
+                tracks.append({'title':f['properties'].get('title',''),'stroke':f['properties'].get('stroke'),
+                    'coordinates':f['geometry']['coordinates']})
+    boundary=None
+    clues=[]
+    clueIds=set()
+    if b and b['geometry']:
+        g=b['geometry']
+        closed=g['type']=='Polygon'
+        boundary={'coordinates':g['coordinates'][0] if closed else g['coordinates'],
+            'stroke':b['properties'].get('stroke'),'closed':closed}
+        cropBoundary=CropBoundary(g,cropBeyond)
+        e=computePrintExtent([boundary['coordinates']])
+        for (id,piece) in printIndex.query((e[0]-cropBeyond,e[1]-cropBeyond,e[2]+cropBeyond,e[3]+cropBeyond)):
+            if isinstance(piece[0],(list,tuple)) or not (id in outing.get('cids',[]) or cropBoundary.containsPoint(piece)):
+                continue
+            f=getFeature(id)
+            if f and f['properties'].get('marker-symbol')=='clue':
+                clues.append({'title':f['properties'].get('title',''),'coordinates':piece[:2]})
+                clueIds.add(id)
+    return (boundary,tracks,clues,clueIds)
+
+# contentHash - hash of the outing's own debrief content (boundary, tracks and clues) of a render job
+#  or anything else with those keys; None if there is no content; two debriefs of an outing with the
+#  same content hash show the same thing, apart from features that don't belong to any outing
+def contentHash(content):
+    if not (content['boundary'] or content['tracks'] or content['clues']):
+        return None
+    s=json.dumps([content['boundary'],content['tracks'],content['clues']],sort_keys=True,separators=(',',':'))
+    return hashlib.sha1(s.encode()).hexdigest()
+
+# buildDebriefJob - build the render job for an outing (see outingContent for the arguments); the job
+#  also gets the outing's contentHash, which is returned in the render result; returns None if the
+#  outing has nothing to show
+def buildDebriefJob(title,outing,getFeature,printIndex,fileName,cropBeyond=0.001,paper='letter',tileDir=None):
+    (boundary,tracks,clues,clueIds)=outingContent(outing,getFeature,printIndex,cropBeyond)
+    extent=computePrintExtent([boundary['coordinates'] if boundary else None]+[t['coordinates'] for t in tracks]+[c['coordinates'] for c in clues])
+    if extent is None:
+        return None
+    layout=choosePrintLayout(extent,paper)
+    # everything else that is inside the print area; a line may be returned as several pieces
+    markers=[]
+    lines=[]
+    for (id,piece) in printIndex.query(layout['extent']):
+        if id in clueIds:
+            continue
+        f=getFeature(id)
+        if f is None:
+            continue
+        p=f['properties']
+        if not isinstance(piece[0],(list,tuple)):
+            markers.append({'title':p.get('title',''),'coordinates':piece[:2],'symbol':p.get('marker-symbol'),'color':p.get('marker-color')})
+        elif lines and lines[-1]['id']==id and lines[-1]['coordinates'][-1]==piece[0]:
+            lines[-1]['coordinates']=lines[-1]['coordinates']+piece[1:] # rejoin consecutive pieces
+        else:
+            lines.append({'id':id,'title':p.get('title',''),'stroke':p.get('stroke'),'coordinates':piece})
+    job={'title':title,'fileName':fileName,'layout':layout,'boundary':boundary,'tracks':tracks,'clues':clues,
+        'markers':markers,'lines':lines,'tileDir':tileDir}
+    job['contentHash']=contentHash(job)
+    return job
+
+# outingTargetIds - all target map ids that belong to any outing (folders, boundaries, tracks)
+def outingTargetIds(dmd):
+    ids=set()
+    for o in dmd['outings'].values():
+        ids.update([o['bid'],o['fid']])
+        ids.update(sum(o['tids'],[]))
+        ids.update(o['utids'])
+    return ids
+
+def pdfFileName(pdfDir,title):
+    return path.join(pdfDir,re.sub(r'[^A-Za-z0-9_. -]','_',title)+'.pdf')
+
+# offline rendering, from the dmd files and the map cache of a stopped (or running) instance
+#  (see dmg_mapcache.py):
+#   python dmg_render.py V80_0SD --pdf-dir pdf [--outings "AA 101" "AB 102"] [--tile-dir tiles]
+def main():
+    from dmg_store import openDmdStore
+    parser=argparse.ArgumentParser(description='render debrief PDFs from the dmd files and map cache of a source/target map pair')
+    parser.add_argument('fileNameBase',help='<sourceMapID>_<targetMapID>')
+    parser.add_argument('--pdf-dir',default='.',help='output directory')
+    parser.add_argument('--outings',nargs='*',default=None,help='outing titles (default: all outings)')
+    parser.add_argument('--tile-dir',default=None,help='local tile cache directory (<zoom>/<x>/<y>.jpg)')
+    parser.add_argument('--paper',default='letter',choices=sorted(papers))
+    parser.add_argument('--workers',type=int,default=os.cpu_count())
+    parser.add_argument('--dmd-store',choices=['json','sqlite'],default='json',help='dmd persistence used by sartopo_bg')
+    args=parser.parse_args()
+    logging.basicConfig(level=logging.INFO,format='%(asctime)s [%(levelname)s] %(message)s')
+    dmd=openDmdStore(args.fileNameBase,args.dmd_store).load()
+    if dmd is None:
+        parser.error('no dmd files found for '+args.fileNameBase)
+    with gzip.open(args.fileNameBase+'_maps.json.gz','rt') as f:
+        targetFeatures={f['id']:f for f in json.load(f)['target']['mapData']['state']['features']}
+    os.makedirs(args.pdf_dir,exist_ok=True)
+    outingIds=outingTargetIds(dmd)
+    printIndex=GridIndex()
+    for (id,f) in targetFeatures.items():
+        if id not in outingIds and f.get('geometry') and f['properties'].get('class') in ['Marker','Shape']:
+            printIndex.insert(id,f['geometry'])
+    def buildJob(title):
+        return buildDebriefJob(title,dmd['outings'][title],targetFeatures.get,printIndex,pdfFileName(args.pdf_dir,title),
+            paper=args.paper,tileDir=args.tile_dir)
+    q=RenderQueue(buildJob,workers=args.workers)
+    q.start()
+    t0=time.time()
+    for title in (args.outings if args.outings is not None else sorted(dmd['outings'])):
+        q.request(title)
+    q.wait()
+    q.stop()
+    logging.info(str(q.getStats())+' in '+str(round(time.time()-t0,3))+' seconds')
+
+if __name__=='__main__':
+    main()
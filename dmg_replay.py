@@ -0,0 +1,150 @@
+import argparse
+import gzip
+import json
+import logging
+import os
+import tempfile
+import time
+from functools import partial
+import dmg_fakesession
+from dmg_fakesession import FakeSession
+from dmg_bench import LatencyRecorder,percentiles
+from sartopo_bg import sartopo_bg
+
+# record and replay of source map event streams
+#
+# recording: sartopo_bg(...,recordFile='incident.dmgrec.gz') writes the source map features that
+#  exist at startup, followed by every source map event that sartopo_bg receives, with the time it
+#  was received (see dmg_events.EventRecorder for the file format)
+#
+# replay: the recorded features and events are fed to a new sartopo_bg instance through an
+#  in-memory source map, with an in-memory target map (see dmg_fakesession.py), either at the
+#  recorded pace (speed 1), N times faster (speed N), or as fast as possible (speed 0); the report
+#  says how far behind the (scaled) recorded time the processing of each event finished
+#
+# usage example:
+#   python dmg_replay.py incident.dmgrec.gz --speed 20 --latency 0.05
+
+# readRecording - return (start record, list of event records)
+def readRecording(fileName):
+    start=None
+    events=[]
+    with gzip.open(fileName,'rt') as f:
+        for line in f:
+            try:
+                r=json.loads(line)
+            except ValueError:
+                logging.warning('event recording: ignoring incomplete record at end of file')
+                break
+            if r['k']=='start':
+                start=r
+            else:
+                events.append(r)
+    if start is None:
+        raise ValueError(fileName+' is not an event recording (no start record)')
+    return (start,events)
+
+# replay - feed a recording into a new sartopo_bg instance; speed=0 means as fast as possible;
+#  returns a report dictionary
+def replay(fileName,speed=1.0,latency=0.0,writeWorkers=4,coalesceWindow=1.0,localCrop=True,workDir=None,options=None):
+    (start,events)=readRecording(fileName)
+    dmg_fakesession.clearMaps()
+    sourceMapID='REPLAY_'+str(start.get('map','SRC'))
+    targetMapID='REPLAY_TGT'
+    src=FakeSession(mapID=sourceMapID)
+    for f in start['features']:
+        src.put(f)
+    oldDir=os.getcwd()
+    os.chdir(workDir or tempfile.mkdtemp(prefix='dmg_replay_'))
+    try:
+        t0=time.time()
+        bg=sartopo_bg(sourceMapID,targetMapID,options,localCrop=localCrop,coalesceWindow=coalesceWindow,
+            writeWorkers=writeWorkers,logLevel=logging.WARNING,
+            sessionClass=partial(FakeSession,latency=latency))
+        bg.start()
+        coldStart=time.time()-t0
+        coldWrites=dict(bg.sts2.calls)
+        recorder=LatencyRecorder()
+        for kind in list(bg.sourceEventHandlers.keys()):
+            bg.sourceEventHandlers[kind]=recorder.wrap(kind,bg.sourceEventHandlers[kind])
+        # lag is measured from the time that each event is due (its recorded time, scaled by
+        #  speed) rather than from when it was actually injected, so that falling behind in
+        #  injecting events also counts
+        recordT0=events[0]['t'] if events else 0
+        replayT0=time.time()
+        injectLate=[]
+        for r in events:
+            due=replayT0+((r['t']-recordT0)/speed if speed else 0)
+            now=time.time()
+            if due>now:
+                time.sleep(due-now)
+            elif speed and now-due>0.01:
+                injectLate.append(now-due)
+            with recorder.lock:
+                recorder.pending.setdefault(r['f']['id'],due if speed else time.time())
+            bg.sts1.simulateEvent(r['k'],r['f'])
+        injected=time.time()
+        if bg.eventQueue:
+            # let pending events come due on their own (flush would dispatch them early)
+            while bg.eventQueue.getDepth():
+                time.sleep(0.01)
+            bg.eventQueue.flush()
+        bg.writer.drain()
+        done=time.time()
+        bg.stop()
+    finally:
+        os.chdir(oldDir)
+    recordedSpan=(events[-1]['t']-recordT0) if events else 0
+    wall=done-replayT0
+    liveWrites={k:n-coldWrites.get(k,0) for (k,n) in bg.sts2.calls.items() if n-coldWrites.get(k,0)}
+    allLags=[lag for lags in recorder.latencies.values() for lag in lags]
+    return {
+        'recording':{'file':fileName,'startFeatures':len(start['features']),'events':len(events),'recordedSeconds':round(recordedSpan,3)},
+        'settings':{'speed':speed or 'max','latency':latency,'writeWorkers':writeWorkers,'coalesceWindow':coalesceWindow,'localCrop':localCrop,'options':options or {}},
+        'coldStart':{'seconds':round(coldStart,3),'totalTargetWrites':sum(coldWrites.values())},
+        'replay':{'wallSeconds':round(wall,3),'effectiveSpeed':round(recordedSpan/wall,2) if wall>0 else None,
+            'drainSeconds':round(done-injected,3), # time after the last event was injected until everything was handled
+            'lag':percentiles(allLags),
+            'lagByKind':{k:percentiles(v) for (k,v) in recorder.latencies.items()},
+            'injectionLate':percentiles(injectLate),
+            'targetWrites':liveWrites,'totalTargetWrites':sum(liveWrites.values())},
+        'dmd':{'outings':len(bg.dmd['outings']),'corr':len(bg.dmd['corr'])}}
+
+def printReport(r):
+    rec=r['recording']
+    print('recording: %s, %d features at start, %d events over %.1f s'%(rec['file'],rec['startFeatures'],rec['events'],rec['recordedSeconds']))
+    print('settings: '+', '.join(k+'='+str(v) for (k,v) in r['settings'].items()))
+    print('cold start: %.3f s, %d target writes'%(r['coldStart']['seconds'],r['coldStart']['totalTargetWrites']))
+    p=r['replay']
+    print('replay: %.3f s wall time (%sx recorded time), %.3f s to drain after the last event, %d target writes %s'%(
+        p['wallSeconds'],p['effectiveSpeed'],p['drainSeconds'],p['totalTargetWrites'],p['targetWrites']))
+    lag=p['lag']
+    if lag['count']:
+        print('  lag behind recorded time: n=%d p50=%.3f p90=%.3f p99=%.3f max=%.3f'%(lag['count'],lag['p50'],lag['p90'],lag['p99'],lag['max']))
+    for (kind,k) in sorted(p['lagByKind'].items()):
+        print('    %-9s n=%d p50=%.3f p99=%.3f max=%.3f'%(kind,k['count'],k['p50'],k['p99'],k['max']))
+    if p['injectionLate']['count']:
+        print('  events injected late (replayer could not keep up): n=%d max=%.3f'%(p['injectionLate']['count'],p['injectionLate']['max']))
+    print('dmd: '+str(r['dmd']))
+
+def main():
+    parser=argparse.ArgumentParser(description='replay a recorded source map event stream into the debrief map generator')
+    parser.add_argument('recording',help='file written by sartopo_bg with recordFile=...')
+    parser.add_argument('--speed',default='1',help='replay speed: 1 = as recorded, N = N times faster, max = as fast as possible')
+    parser.add_argument('--latency',type=float,default=0.0,help='simulated seconds per target map write')
+    parser.add_argument('--workers',type=int,default=4)
+    parser.add_argument('--coalesce',type=float,default=1.0,help='event coalescing window in seconds (negative: no coalescing)')
+    parser.add_argument('--server-crop',action='store_true',help='crop with (simulated) sts2.crop instead of locally')
+    parser.add_argument('--options',type=json.loads,default=None,help='other sartopo_bg options, as a json object (e.g. \'{"simplifyScale":24000}\')')
+    parser.add_argument('--json',action='store_true',help='print the report as json')
+    args=parser.parse_args()
+    speed=0 if args.speed=='max' else float(args.speed)
+    r=replay(args.recording,speed=speed,latency=args.latency,writeWorkers=args.workers,
+        coalesceWindow=None if args.coalesce<0 else args.coalesce,localCrop=not args.server_crop,options=args.options)
+    if args.json:
+        print(json.dumps(r,indent=3))
+    else:
+        printReport(r)
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,313 @@
+import logging
+import json
+import os
+import sqlite3
+import threading
+from os import path
+
+# DmdJournal - append-only persistence for the Debrief Map Data (dmd) dictionary
+#
+# Rewriting the entire dmd json file after every change makes each new feature cost time
+#  proportional to everything already imported.  Instead, each change to a top-level entry of
+#  dmd['corr'], dmd['outings'] or dmd['dups'] is appended to a journal file as one compact json line:
+#     {"s":"corr","k":<source id>,"v":<new value, or null if the entry was deleted>}
+#     {"s":"outings","k":<outing title>,"v":<new value, or null if the entry was deleted>}
+#     {"s":"dups","k":<source id>,"v":<source id of the original track, or null>}
+#  and the whole dictionary is only written out (as a snapshot) every so often.
+#
+# snapshot file = <source>_<target>.json (same file name and format as before, so that
+#   older dmd files are still read correctly on restart)
+# journal file = <source>_<target>_journal.jsonl
+#
+# crash safety:
+#  - the snapshot is written to a temporary file, flushed to disk, and then moved into place
+#     with os.replace, so there is always one complete snapshot on disk
+#  - the journal is only truncated after the new snapshot is in place; since each journal record
+#     sets an entry to its full current value, replaying a journal on top of a snapshot that
+#     already includes some of its records gives the same result
+#  - each record is written to disk (os.fsync) before record() returns, so a crash or power loss
+#     can only lose the record being written at the time; with batched=True, the records are
+#     written to disk by flush(), so a crash can lose the records of the current batch (the target
+#     map changes of one sync pass), which are then redone by the reconcile on the next start
+#  - a partially written final journal line (crash during append) is ignored on replay, and cut
+#     off the journal so that the next record starts on a new line
+#
+# batched=True (sartopo_bg sync-cycle batching): records are only flushed to disk by flush(), which
+#  is called once per batch of changes, and the need for a snapshot is reported by flush() instead
+#  of record()
+class DmdJournal():
+    def __init__(self,fileNameBase,compactEvery=500,batched=False):
+        self.snapshotFileName=fileNameBase+'.json'
+        self.journalFileName=fileNameBase+'_journal.jsonl'
+        self.compactEvery=compactEvery # number of journal records that triggers a new snapshot
+        self.batched=batched
+        self.recordCount=0
+        self.journalFile=None
+
+    # load - read the snapshot (if any) then replay the journal (if any) on top of it;
+    #  returns the resulting dmd dictionary, or None if neither file exists
+    def load(self):
+        dmd=None
+        if path.exists(self.snapshotFileName):
+            with open(self.snapshotFileName,'r') as snapshotFile:
+                logging.info('reading dmd snapshot file '+self.snapshotFileName)
+                dmd=json.load(snapshotFile)
+        if path.exists(self.journalFileName):
+            if dmd is None:
+                dmd={'outings':{},'corr':{},'dups':{}}
+            n=0
+            size=0 # bytes up to the end of the last complete line
+            with open(self.journalFileName,'rb') as journalFile:
+                for line in journalFile:
+                    try:
+                        r=json.loads(line)
+                    except ValueError:
+                        logging.warning('dmd journal: ignoring incomplete record (probably written during a crash): '+line.decode(errors='replace').strip())
+                    else:
+                        self.apply(dmd,r)
+                        n+=1
+                    if line.endswith(b'\n'):
+                        size+=len(line)
+            if size<path.getsize(self.journalFileName):
+                os.truncate(self.journalFileName,size)
+            logging.info('replayed '+str(n)+' dmd journal records from '+self.journalFileName)
+        return dmd
+
+    def exists(self):
+        return path.exists(self.snapshotFileName) or path.exists(self.journalFileName)
+
+    def apply(self,dmd,r):
+        section=dmd.setdefault(r['s'],{})
+        if r['v'] is None:
+            section.pop(r['k'],None)
+        else:
+            section[r['k']]=r['v']
+
+    # record - append the current value of dmd[section][key] (or its deletion) to the journal;
+    #  returns True if enough records have accumulated that the caller should write a snapshot
+    def record(self,dmd,section,key):
+        if self.journalFile is None:
+            self.journalFile=open(self.journalFileName,'a')
+        r={'s':section,'k':key,'v':dmd[section].get(key,None)}
+        self.journalFile.write(json.dumps(r,separators=(',',':'))+'\n')
+        self.recordCount+=1
+        if self.batched:
+            return False
+        self.journalFile.flush()
+        os.fsync(self.journalFile.fileno())
+        return self.recordCount>=self.compactEvery
+
+    # writeSnapshot - atomically replace the snapshot with the entire dmd, then start a new journal
+    def writeSnapshot(self,dmd):
+        tmpFileName=self.snapshotFileName+'.tmp'
+        with open(tmpFileName,'w') as tmpFile:
+            tmpFile.write(json.dumps(dmd,indent=3))
+            tmpFile.flush()
+            os.fsync(tmpFile.fileno())
+        os.replace(tmpFileName,self.snapshotFileName)
+        # the journal is now redundant; truncate it
+        if self.journalFile is not None:
+            self.journalFile.close()
+        self.journalFile=open(self.journalFileName,'w')
+        self.recordCount=0
+
+    def close(self):
+        if self.journalFile is not None:
+            self.journalFile.close()
+            self.journalFile=None
+
+    # flush - write the records so far to disk (unless batched, they already are); returns True if
+    #  enough records have accumulated that the caller should write a snapshot
+    def flush(self):
+        if self.journalFile is not None:
+            self.journalFile.flush()
+            os.fsync(self.journalFile.fileno())
+        return self.recordCount>=self.compactEvery
+
+# DmdDatabase - SQLite alternative to DmdJournal, with the same methods
+#
+# the journal's periodic snapshots rewrite the whole dmd, so they get slower as the incident
+#  grows, and the journal is replayed in full on every start; instead, each dmd entry is kept as
+#  rows of indexed tables, so recording a change only touches the rows of that one entry:
+#     outings(title,sid,bid,fid,extra) - one row per outing; extra = json of any other keys (cids)
+#     outingTracks(title,line,pos,tid) - dmd['outings'][title]['tids'][line][pos]
+#     uncropped(title,pos,tid) - dmd['outings'][title]['utids'][pos] (tracks waiting for a boundary)
+#     corr(sid,pos,tid) - dmd['corr'][sid][pos]
+#     dups(sid,osid) - dmd['dups']
+#     entries(section,key,value) - any other dmd section (json value)
+#  an empty list (a line of tids with no tracks, or a correspondence with no target features) is
+#  stored as one row with pos=-1 and tid=NULL, so that it is still there after load
+#  with indexes on sid, tid and outing title, so the tables can also be queried directly while
+#  sartopo_bg is running (e.g. with the sqlite3 command line tool: which source feature does
+#  target map line <tid> come from?)
+#
+# database file = <source>_<target>.sqlite, in WAL mode, so that readers don't block the writer
+#
+# changes are committed in batches: at most commitInterval seconds after the first uncommitted
+#  change (from a timer thread), after commitEvery changes, or when flush is called; with
+#  batched=True (sartopo_bg sync-cycle batching), only when flush is called; a crash loses at most
+#  the last batch, and since each batch is one transaction, the database is never left with a
+#  partly recorded entry
+#
+# if the database doesn't exist yet but DmdJournal files do, load() reads those instead, so
+#  switching an existing source/target map pair to this backend keeps its dmd
+class DmdDatabase():
+    schema=[
+        'CREATE TABLE IF NOT EXISTS outings(title TEXT PRIMARY KEY,sid TEXT,bid TEXT,fid TEXT,extra TEXT)',
+        'CREATE INDEX IF NOT EXISTS outingsSid ON outings(sid)',
+        'CREATE TABLE IF NOT EXISTS outingTracks(title TEXT,line INTEGER,pos INTEGER,tid TEXT)',
+        'CREATE INDEX IF NOT EXISTS outingTracksTitle ON outingTracks(title)',
+        'CREATE INDEX IF NOT EXISTS outingTracksTid ON outingTracks(tid)',
+        'CREATE TABLE IF NOT EXISTS uncropped(title TEXT,pos INTEGER,tid TEXT)',
+        'CREATE INDEX IF NOT EXISTS uncroppedTitle ON uncropped(title)',
+        'CREATE INDEX IF NOT EXISTS uncroppedTid ON uncropped(tid)',
+        'CREATE TABLE IF NOT EXISTS corr(sid TEXT,pos INTEGER,tid TEXT)',
+        'CREATE INDEX IF NOT EXISTS corrSid ON corr(sid)',
+        'CREATE INDEX IF NOT EXISTS corrTid ON corr(tid)',
+        'CREATE TABLE IF NOT EXISTS dups(sid TEXT PRIMARY KEY,osid TEXT)',
+        'CREATE INDEX IF NOT EXISTS dupsOsid ON dups(osid)',
+        'CREATE TABLE IF NOT EXISTS entries(section TEXT,key TEXT,value TEXT,PRIMARY KEY(section,key))']
+
+    def __init__(self,fileNameBase,commitInterval=1.0,commitEvery=1000,batched=False):
+        self.fileNameBase=fileNameBase
+        self.fileName=fileNameBase+'.sqlite'
+        self.commitInterval=commitInterval
+        self.commitEvery=commitEvery
+        self.batched=batched
+        self.db=None
+        self.lock=threading.Lock() # protects db, pendingCount and timer (the commit timer is a separate thread)
+        self.pendingCount=0 # changes since the last commit
+        self.timer=None
+
+    def open(self):
+        if self.db is None:
+            # isolation_level=None: transactions are started and committed explicitly
+            self.db=sqlite3.connect(self.fileName,isolation_level=None,check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL') # WAL mode: a commit is still atomic after a crash
+            for statement in self.schema:
+                self.db.execute(statement)
+        return self.db
+
+    def exists(self):
+        return path.exists(self.fileName) or DmdJournal(self.fileNameBase).exists()
+
+    def load(self):
+        if not path.exists(self.fileName):
+            journal=DmdJournal(self.fileNameBase)
+            if journal.exists():
+                logging.info('dmd database '+self.fileName+' does not exist yet; reading the dmd journal files instead')
+                return journal.load()
+            return None
+        with self.lock:
+            db=self.open()
+            dmd={'outings':{},'corr':{},'dups':{}}
+            for (title,sid,bid,fid,extra) in db.execute('SELECT title,sid,bid,fid,extra FROM outings'):
+                o=json.loads(extra) if extra else {}
+                o.update({'sid':sid,'bid':bid,'fid':fid,'tids':[],'utids':[]})
+                dmd['outings'][title]=o
+            for (title,line,tid) in db.execute('SELECT title,line,tid FROM outingTracks ORDER BY title,line,pos'):
+                tids=dmd['outings'][title]['tids']
+                while len(tids)<=line:
+                    tids.append([])
+                if tid is not None:
+                    tids[line].append(tid)
+            for (title,tid) in db.execute('SELECT title,tid FROM uncropped ORDER BY title,pos'):
+                dmd['outings'][title]['utids'].append(tid)
+            for (sid,tid) in db.execute('SELECT sid,tid FROM corr ORDER BY sid,pos'):
+                tids=dmd['corr'].setdefault(sid,[])
+                if tid is not None:
+                    tids.append(tid)
+            dmd['dups']=dict(db.execute('SELECT sid,osid FROM dups'))
+            for (section,key,value) in db.execute('SELECT section,key,value FROM entries'):
+                dmd.setdefault(section,{})[key]=json.loads(value)
+        logging.info('read dmd database '+self.fileName+': '+str(len(dmd['outings']))+' outings, '+str(len(dmd['corr']))+' correspondences')
+        return dmd
+
+    # writeEntry - replace the rows of one dmd entry (value None: delete them); the caller holds
+    #  the lock and has started a transaction
+    def writeEntry(self,db,section,key,value):
+        if section=='outings':
+            db.execute('DELETE FROM outings WHERE title=?',(key,))
+            db.execute('DELETE FROM outingTracks WHERE title=?',(key,))
+            db.execute('DELETE FROM uncropped WHERE title=?',(key,))
+            if value is not None:
+                extra={k:v for (k,v) in value.items() if k not in ['sid','bid','fid','tids','utids']}
+                db.execute('INSERT INTO outings VALUES (?,?,?,?,?)',(key,value['sid'],value['bid'],value['fid'],json.dumps(extra) if extra else None))
+                db.executemany('INSERT INTO outingTracks VALUES (?,?,?,?)',
+                    [(key,line,pos,tid) for (line,tids) in enumerate(value['tids']) for (pos,tid) in (enumerate(tids) if tids else [(-1,None)])])
+                db.executemany('INSERT INTO uncropped VALUES (?,?,?)',[(key,pos,tid) for (pos,tid) in enumerate(value['utids'])])
+        elif section=='corr':
+            db.execute('DELETE FROM corr WHERE sid=?',(key,))
+            if value is not None:
+                db.executemany('INSERT INTO corr VALUES (?,?,?)',[(key,pos,tid) for (pos,tid) in (enumerate(value) if value else [(-1,None)])])
+        elif section=='dups':
+            db.execute('DELETE FROM dups WHERE sid=?',(key,))
+            if value is not None:
+                db.execute('INSERT INTO dups VALUES (?,?)',(key,value))
+        else:
+            db.execute('DELETE FROM entries WHERE section=? AND key=?',(section,key))
+            if value is not None:
+                db.execute('INSERT INTO entries VALUES (?,?,?)',(section,key,json.dumps(value)))
+
+    # record - write the current value of dmd[section][key] (or its deletion) as part of the current
+    #  batch; always returns False, since there is never a need for a snapshot
+    def record(self,dmd,section,key):
+        with self.lock:
+            db=self.open()
+            if not db.in_transaction:
+                db.execute('BEGIN')
+            self.writeEntry(db,section,key,dmd[section].get(key,None))
+            self.pendingCount+=1
+            if self.batched:
+                pass
+            elif self.pendingCount>=self.commitEvery:
+                self.commit()
+            elif self.timer is None:
+                self.timer=threading.Timer(self.commitInterval,self.flush)
+                self.timer.daemon=True
+                self.timer.start()
+        return False
+
+    # commit - the caller holds the lock
+    def commit(self):
+        if self.db is not None and self.db.in_transaction:
+            self.db.execute('COMMIT')
+        self.pendingCount=0
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer=None
+
+    # flush - commit; returns False, like record
+    def flush(self):
+        with self.lock:
+            self.commit()
+        return False
+
+    # writeSnapshot - replace the entire contents of the database with dmd, in one transaction
+    def writeSnapshot(self,dmd):
+        with self.lock:
+            db=self.open()
+            if not db.in_transaction:
+                db.execute('BEGIN')
+            for table in ['outings','outingTracks','uncropped','corr','dups','entries']:
+                db.execute('DELETE FROM '+table)
+            for (section,entries) in dmd.items():
+                for (key,value) in entries.items():
+                    self.writeEntry(db,section,key,value)
+            self.commit()
+
+    def close(self):
+        with self.lock:
+            self.commit()
+            if self.db is not None:
+                self.db.close()
+                self.db=None
+
+# openDmdStore - DmdJournal ('json') or DmdDatabase ('sqlite')
+def openDmdStore(fileNameBase,backend='json',batched=False):
+    if backend=='sqlite':
+        return DmdDatabase(fileNameBase,batched=batched)
+    if backend=='json':
+        return DmdJournal(fileNameBase,batched=batched)
+    raise ValueError('unknown dmd store: '+str(backend))
@@ -0,0 +1,266 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import queue
+import signal
+import sys
+import time
+from functools import partial
+from sartopo_python import SartopoSession
+from dmg_logging import setupLogging,stopLogging
+from sartopo_bg import sartopo_bg,defaultOptions
+
+# supervisor for running several debrief map generators (source/target map pairs) at once
+#
+# each pair runs in its own process, so that one pair's logging setup, crash, or CPU-heavy work
+#  (cropping, json) can't affect the others; each pair writes its own log file
+#  (<source>_<target>_bg.log) and dmd files (<source>_<target>.json and _journal.jsonl) as usual
+#
+# all pairs share a limit on the number of simultaneous requests to the SARTopo / CalTopo
+#  Desktop server (maxRequests), so that many busy pairs can't overload the local server; this
+#  takes the place of a shared connection pool, which can't be shared between processes
+#
+# a pair whose process fails (non-zero exit code, e.g. a crash or failure to connect at startup,
+#  or killed by a signal) is restarted after a delay that doubles with each consecutive failure (up
+#  to maxRestartDelay); a pair that has run for longer than maxRestartDelay is considered healthy
+#  again; a pair whose process exits cleanly (exit code 0: it was stopped, e.g. with SIGTERM sent
+#  to that process) is not restarted
+#
+# every statsInterval seconds, each pair sends its sartopo_bg.getStats() to the supervisor,
+#  which logs one line per pair: state, restarts, lag (age of the oldest unhandled source map
+#  event) and throughput (source map events handled and target map writes per second)
+#
+# usage example:
+#   python dmg_supervisor.py 9B1:UG1 V80:0SD --max-requests 8
+#   python dmg_supervisor.py --config pairs.json
+#      (pairs.json: [{"source":"9B1","target":"UG1"},{"source":"V80","target":"0SD","workers":2}])
+#
+# each pair's config entries other than source, target and logLevel are sartopo_bg options (see
+#  sartopo_bg.defaultOptions and pairOptions), e.g. {"source":"9B1","target":"UG1","pdfDir":"pdf",
+#  "autoPdf":true,"simplifyScale":24000}
+
+writeMethods=['addFolder','addLine','addPolygon','addMarker','editObject','delObject','crop']
+
+# pairAliases - pair config names of sartopo_bg options, where they differ from the option names
+pairAliases={'workers':'writeWorkers','domain':'domainAndPort','record':'recordFile','dmdStore':'dmdBackend'}
+# options that are set by runPair, or that can't be specified in a json config
+pairFixedOptions=['sessionClass','logLevel','readinessCallback']
+
+# pairOptions - the sartopo_bg options from a pair config; raises ValueError for an unknown entry, so
+#  that a misspelled option isn't silently replaced by its default
+def pairOptions(pair):
+    options={}
+    for (name,value) in pair.items():
+        if name in ['source','target','logLevel']:
+            continue
+        option=pairAliases.get(name,name)
+        if option not in defaultOptions or option in pairFixedOptions:
+            raise ValueError('pair '+str(pair.get('source'))+':'+str(pair.get('target'))+': unknown config entry "'+name+'"')
+        options[option]=value
+    return options
+
+# limitedSession - open a session, and make each of its map-changing calls wait for one of the
+#  shared server request slots
+def limitedSession(domainAndPort,mapID,slots=None,sessionClass=SartopoSession,**kwargs):
+    session=sessionClass(domainAndPort,mapID,**kwargs)
+    if slots is not None:
+        for name in writeMethods:
+            method=getattr(session,name,None)
+            if method:
+                setattr(session,name,partial(callWithSlot,slots,method))
+    return session
+
+def callWithSlot(slots,method,*args,**kwargs):
+    with slots:
+        return method(*args,**kwargs)
+
+# runPair - body of each pair's process
+def runPair(pair,slots,statsQueue,statsInterval,sessionClass):
+    name=pair['source']+'_'+pair['target']
+    listener=setupLogging(name,getattr(logging,pair.get('logLevel','INFO').upper()),console=False)
+    bg=sartopo_bg(pair['source'],pair['target'],pairOptions(pair),
+        logLevel=None,
+        sessionClass=partial(limitedSession,slots=slots,sessionClass=sessionClass))
+    signal.signal(signal.SIGTERM,bg.requestStop)
+    signal.signal(signal.SIGINT,signal.SIG_IGN) # ctrl-c is handled by the supervisor
+    if hasattr(signal,'SIGUSR2'):
+        signal.signal(signal.SIGUSR2,bg.profiler.request) # profile capture: kill -USR2 <pair pid>
+    bg.start()
+    while not bg.stopRequested.wait(statsInterval):
+        bg.logStats()
+        statsQueue.put((name,time.time(),bg.getStats()))
+    bg.stop()
+    statsQueue.put((name,time.time(),bg.getStats()))
+    stopLogging(listener)
+
+class PairProcess():
+    def __init__(self,pair):
+        self.pair=pair
+        self.name=pair['source']+'_'+pair['target']
+        self.process=None
+        self.startTime=None
+        self.restarts=0
+        self.failures=0 # consecutive
+        self.restartAt=None # time at which to restart after a failure
+        self.stats=None # latest stats from the pair
+        self.statsTime=None
+        self.rates={} # per-second rates computed from the last two stats reports
+
+class Supervisor():
+    def __init__(self,pairs,maxRequests=8,statsInterval=10,maxRestartDelay=300,sessionClass=SartopoSession):
+        self.pairs=[PairProcess(p) for p in pairs]
+        names=[p.name for p in self.pairs]
+        if len(set(names))!=len(names):
+            raise ValueError('each source/target map pair can only be run once')
+        for pp in self.pairs:
+            pairOptions(pp.pair) # check the config before starting anything
+        self.slots=multiprocessing.BoundedSemaphore(maxRequests)
+        self.statsQueue=multiprocessing.Queue()
+        self.statsInterval=statsInterval
+        self.maxRestartDelay=maxRestartDelay
+        self.sessionClass=sessionClass
+        self.stopping=False
+
+    def startPair(self,pp):
+        pp.process=multiprocessing.Process(target=runPair,name='dmg_'+pp.name,
+            args=(pp.pair,self.slots,self.statsQueue,self.statsInterval,self.sessionClass))
+        pp.process.start()
+        pp.startTime=time.time()
+        pp.restartAt=None
+        logging.info(pp.name+': started (pid '+str(pp.process.pid)+')')
+
+    def start(self):
+        for pp in self.pairs:
+            self.startPair(pp)
+
+    def requestStop(self,*args):
+        self.stopping=True
+
+    # check - restart pairs whose process has failed, and collect stats; call this periodically
+    def check(self):
+        now=time.time()
+        for pp in self.pairs:
+            if pp.process is not None and not pp.process.is_alive():
+                code=pp.process.exitcode
+                if code==0:
+                    logging.info(pp.name+': process stopped (exit code 0); not restarting it')
+                    pp.process=None
+                    continue
+                if now-pp.startTime>self.maxRestartDelay:
+                    pp.failures=0
+                pp.failures+=1
+                delay=min(self.maxRestartDelay,2**(pp.failures-1))
+                logging.error(pp.name+': process failed (exit code '+str(code)+'); restarting in '+str(delay)+' seconds')
+                pp.process=None
+                pp.restartAt=now+delay
+            if pp.process is None and pp.restartAt is not None and now>=pp.restartAt:
+                pp.restarts+=1
+                self.startPair(pp)
+        self.readStats()
+
+    def readStats(self):
+        byName={pp.name:pp for pp in self.pairs}
+        while True:
+            try:
+                (name,t,stats)=self.statsQueue.get_nowait()
+            except queue.Empty:
+                return
+            pp=byName.get(name)
+            if pp is None:
+                continue
+            if pp.stats is not None and t>pp.statsTime:
+                dt=t-pp.statsTime
+                pp.rates={
+                    'eventsPerSecond':max(0,stats['eventsHandled']-pp.stats['eventsHandled'])/dt,
+                    'writesPerSecond':max(0,stats['writesCompleted']-pp.stats['writesCompleted'])/dt}
+            pp.stats=stats
+            pp.statsTime=t
+
+    # getReport - one entry per pair
+    def getReport(self):
+        report=[]
+        for pp in self.pairs:
+            if pp.process is not None and pp.process.is_alive():
+                state='running'
+            elif pp.restartAt is not None:
+                state='restarting'
+            else:
+                state='stopped'
+            s=pp.stats or {}
+            report.append({'pair':pp.name,'state':state,'pid':pp.process.pid if pp.process else None,
+                'restarts':pp.restarts,'lag':s.get('lag',None),'queueDepth':s.get('queueDepth',None),
+                'eventsHandled':s.get('eventsHandled',None),'writesCompleted':s.get('writesCompleted',None),
+                'eventsPerSecond':pp.rates.get('eventsPerSecond',None),'writesPerSecond':pp.rates.get('writesPerSecond',None),
+                'outings':s.get('outings',None)})
+        return report
+
+    def logReport(self):
+        def fmt(v,f='%.1f'):
+            return '-' if v is None else f%v
+        for r in self.getReport():
+            logging.info('%-20s %-10s restarts=%d lag=%ss depth=%s events/s=%s writes/s=%s outings=%s'%(
+                r['pair'],r['state'],r['restarts'],fmt(r['lag']),fmt(r['queueDepth'],'%d'),
+                fmt(r['eventsPerSecond']),fmt(r['writesPerSecond']),fmt(r['outings'],'%d')))
+
+    # stop - ask every pair to stop gracefully (see sartopo_bg.stop), and wait for them
+    def stop(self,timeout=60):
+        for pp in self.pairs:
+            pp.restartAt=None
+            if pp.process is not None and pp.process.is_alive():
+                pp.process.terminate() # SIGTERM: graceful stop
+        deadline=time.time()+timeout
+        for pp in self.pairs:
+            if pp.process is not None:
+                pp.process.join(max(0,deadline-time.time()))
+                if pp.process.is_alive():
+                    logging.error(pp.name+': did not stop within '+str(timeout)+' seconds; killing')
+                    pp.process.kill()
+                    pp.process.join()
+        self.readStats()
+
+    # runForever - supervise until SIGINT / SIGTERM, or until every pair has stopped, then stop all pairs
+    def runForever(self,checkInterval=1.0):
+        signal.signal(signal.SIGINT,self.requestStop)
+        signal.signal(signal.SIGTERM,self.requestStop)
+        lastReport=time.time()
+        while not self.stopping:
+            time.sleep(checkInterval)
+            self.check()
+            if all(pp.process is None and pp.restartAt is None for pp in self.pairs):
+                logging.info('all pairs have stopped')
+                break
+            if time.time()-lastReport>=self.statsInterval:
+                self.logReport()
+                lastReport=time.time()
+        logging.info('stopping all pairs')
+        self.stop()
+        self.logReport()
+
+def main():
+    parser=argparse.ArgumentParser(description='run several debrief map generators (source/target map pairs) at once')
+    parser.add_argument('pairs',nargs='*',help='SOURCE:TARGET map ID pairs')
+    parser.add_argument('--config',default=None,help='json file with a list of pairs: {"source":..., "target":..., optional "logLevel", "workers", "domain", "record", "dmdStore", and any other sartopo_bg option by name (see sartopo_bg.defaultOptions), e.g. "coalesceWindow", "localCrop", "warmStart", "syncBatching", "pdfDir", "autoPdf", "readySettle", "roamingDistance", "simplifyScale", "duplicateTracks", "metricsPort"}')
+    parser.add_argument('--domain',default='localhost:8080',help='default domain and port of the SARTopo / CalTopo Desktop server')
+    parser.add_argument('--max-requests',type=int,default=8,help='maximum simultaneous server requests, for all pairs together')
+    parser.add_argument('--stats-interval',type=float,default=10)
+    args=parser.parse_args()
+    pairs=[]
+    if args.config:
+        with open(args.config,'r') as configFile:
+            pairs=json.load(configFile)
+    for p in args.pairs:
+        (source,target)=p.split(':')
+        pairs.append({'source':source,'target':target})
+    if not pairs:
+        parser.error('no map pairs specified')
+    for p in pairs:
+        if 'domainAndPort' not in p:
+            p.setdefault('domain',args.domain)
+    logging.basicConfig(level=logging.INFO,format='%(asctime)s [%(levelname)s] %(message)s',stream=sys.stdout)
+    supervisor=Supervisor(pairs,maxRequests=args.max_requests,statsInterval=args.stats_interval)
+    supervisor.start()
+    supervisor.runForever()
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,118 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor,Future
+
+# TargetWriter - runs target map work on a pool of threads, so that independent target map
+#  operations (each of which is mostly waiting on an http round trip) can overlap
+#
+# every task is submitted with a key; tasks with the same key run one at a time, in the order
+#  they were submitted, and tasks with different keys run concurrently (up to maxWorkers at once).
+#  sartopo_bg uses the outing title as the key for assignments and tracks, so that within an outing
+#  the folder is created before the boundary, the boundary before any track is cropped to it, and
+#  so on; features that don't belong to an outing are keyed by their own source id.
+#
+# with maxWorkers of 1 or less, tasks are run immediately in the calling thread (no pool).
+class TargetWriter():
+    def __init__(self,maxWorkers=4):
+        self.maxWorkers=maxWorkers
+        self.executor=None
+        if maxWorkers>1:
+            self.executor=ThreadPoolExecutor(max_workers=maxWorkers,thread_name_prefix='TargetWriter')
+        self.lock=threading.Condition()
+        self.chains={} # key = task key, val = deque of (future,fn,args,kwargs) waiting to run
+        self.outstanding=0 # tasks submitted but not yet finished
+        self.submitTimes={} # key = future of an unfinished task, val = time it was submitted
+        self.stats={
+            'submitted':0,
+            'completed':0,
+            'failed':0,
+            'maxOutstanding':0}
+
+    # submit - run fn(*args,**kwargs) after all previously submitted tasks with the same key;
+    #  returns a Future whose result is the return value of fn
+    def submit(self,key,fn,*args,**kwargs):
+        return self.submitAfter(None,key,fn,*args,**kwargs)
+
+    # submitAfter - like submit, but the task is only queued for its key once the 'after' Future
+    #  (a task submitted earlier, possibly with a different key) has finished; this keeps the
+    #  order of the work for something whose key changes (e.g. a track moved to another outing)
+    #  without holding a worker while it waits
+    def submitAfter(self,after,key,fn,*args,**kwargs):
+        future=Future()
+        with self.lock:
+            self.stats['submitted']+=1
+            self.outstanding+=1
+            self.stats['maxOutstanding']=max(self.stats['maxOutstanding'],self.outstanding)
+            self.submitTimes[future]=time.time()
+        if after is None:
+            self.enqueue(key,future,fn,args,kwargs)
+        else: # called right away if after has already finished
+            after.add_done_callback(lambda f:self.enqueue(key,future,fn,args,kwargs))
+        return future
+
+    # enqueue - add a submitted task to the chain for its key, or run it now if there is no pool
+    def enqueue(self,key,future,fn,args,kwargs):
+        with self.lock:
+            if self.executor is None:
+                runNow=True
+            else:
+                runNow=False
+                chain=self.chains.get(key,None)
+                if chain is None: # nothing running for this key: start a new chain
+                    self.chains[key]=deque([(future,fn,args,kwargs)])
+                    self.executor.submit(self.runChain,key)
+                else: # will be run by the chain that is already running for this key
+                    chain.append((future,fn,args,kwargs))
+        if runNow:
+            self.runTask(future,fn,args,kwargs)
+
+    # runChain - run the tasks for one key, in order, until there are none left
+    def runChain(self,key):
+        while True:
+            with self.lock:
+                chain=self.chains[key]
+                if not chain:
+                    del self.chains[key]
+                    return
+                (future,fn,args,kwargs)=chain.popleft()
+            self.runTask(future,fn,args,kwargs)
+
+    def runTask(self,future,fn,args,kwargs):
+        try:
+            future.set_result(fn(*args,**kwargs))
+            failed=False
+        except Exception as e:
+            logging.exception('target map write task failed: '+getattr(fn,'__name__',str(fn)))
+            future.set_exception(e)
+            failed=True
+        with self.lock:
+            self.outstanding-=1
+            self.submitTimes.pop(future,None)
+            self.stats['failed' if failed else 'completed']+=1
+            self.lock.notify_all()
+
+    # drain - block until every task submitted so far has finished; returns False on timeout
+    def drain(self,timeout=None):
+        deadline=None if timeout is None else time.time()+timeout
+        with self.lock:
+            while self.outstanding>0:
+                remaining=None if deadline is None else deadline-time.time()
+                if remaining is not None and remaining<=0:
+                    return False
+                self.lock.wait(remaining)
+        return True
+
+    def getStats(self):
+        with self.lock:
+            stats=dict(self.stats)
+            stats['outstanding']=self.outstanding
+            stats['activeKeys']=len(self.chains)
+            stats['oldestAge']=time.time()-min(self.submitTimes.values()) if self.submitTimes else 0 # seconds
+        return stats
+
+    def shutdown(self,timeout=None):
+        self.drain(timeout)
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
@@ -1,13 +1,78 @@
 from sartopo_python import SartopoSession
 import logging
-import re
 import time
-import sys
 import json
+import threading
+import signal
+import argparse
+import os
+import concurrent.futures
+from functools import partial
 from os import path
-
+from dmg_store import openDmdStore
+from dmg_mapcache import MapCache,warmSessionClass
+from dmg_geometry import cropLine,coordsHash,GridIndex,simplifyLine,TrackFingerprint
+from dmg_events import CoalescingQueue,EventRecorder,syncCycleSessionClass
+from dmg_writer import TargetWriter
+from dmg_logging import setupLogging,stopLogging,LazyJson,logEvent
+from dmg_reconcile import planReconcile,summarizePlan,parseTrackName,propertyFingerprint,projectedProperties,isRoaming,cropBoundaryFor,roundCoords,isTrack
+from dmg_render import RenderQueue,buildDebriefJob,pdfFileName,printTolerance,outingContent,contentHash
+from dmg_readiness import ReadinessTracker
+from dmg_metrics import Metrics,MetricsServer,ProfileCapture,instrumentSession
+
+# target map session methods whose calls are timed (see dmg_metrics.py)
+targetSessionMethods=['addFolder','addLine','addPolygon','addMarker','editObject','delObject','crop','getFeature']
+
+# defaultOptions - every sartopo_bg option and its default; pass options to sartopo_bg as a
+#  dictionary (e.g. from a configuration file, see dmg_supervisor.py) and/or as keyword arguments
+defaultOptions={
+    'localCrop':True, # crop tracks in this process, instead of with sts2.crop
+    'coalesceWindow':1.0, # seconds to wait for more events for the same feature (None: no coalescing)
+    'writeWorkers':4, # number of concurrent target map writers
+    'logLevel':logging.INFO, # None: leave logging setup to the caller
+    'domainAndPort':'localhost:8080', # SARTopo / CalTopo Desktop server
+    'sessionClass':SartopoSession,
+    'recordFile':None, # record source map events to this file (see dmg_replay.py)
+    'statsInterval':5, # seconds between stats log messages in runForever
+    'warmStart':True, # use the map cache from the previous run, if there is one
+    'pdfDir':None, # directory for debrief PDFs (None: no PDFs)
+    'pdfWorkers':4, # number of debrief PDF rendering processes
+    'tileDir':None, # local tile cache for debrief PDFs
+    'paper':'letter',
+    'roamingDistance':10000, # meters; crop distance for tracks of roaming teams
+    'simplifyScale':None, # simplify tracks to the detail visible at this print scale (None: no simplification)
+    'quantizeDigits':6, # decimal places of simplified track coordinates
+    'duplicateTracks':'exact', # 'exact', 'near', or anything else to import every track
+    'dmdBackend':'json', # dmd persistence: 'json' or 'sqlite'
+    'syncBatching':False, # handle the source map changes of each sync pass as one batch
+    'readySettle':300, # seconds without changes before an outing is ready for debrief
+    'autoPdf':False, # render the debrief PDF of each outing when it is ready
+    'readinessCallback':None, # readinessCallback(title,event,state), for each readiness event
+    'metricsPort':None, # serve metrics at http://localhost:<metricsPort>/metrics
+    'profileSeconds':30} # length of the profile capture started by SIGUSR2
+
+# service API:
+#   bg=sartopo_bg(sourceMapID,targetMapID,options) - set up only; no map sessions are opened yet
+#   bg.start() - open the map sessions, bring the target map up to date, then start handling source
+#      map events (in other threads); returns when the initial import is done; if the previous
+#      run stopped cleanly, this only downloads and reconciles the changes since then (warm start,
+#      see dmg_mapcache.py)
+#   bg.runForever() - block until stop is requested (bg.requestStop(), SIGINT or SIGTERM), then stop
+#   bg.stop() - stop receiving source map events, finish handling the ones already received,
+#      wait for all target map writes to finish, and write a dmd snapshot and map cache
+# several instances can run in the same process, as long as their source/target map pairs are
+#  different; in that case, pass logLevel=None and set up logging in the caller, since otherwise
+#  each instance redirects all logging to its own log file
 class sartopo_bg():
-    def __init__(self,sourceMapID,targetMapID):
+    def __init__(self,sourceMapID,targetMapID,options=None,**kwargs):
+        # options: see defaultOptions; a dictionary of options, and/or options as keyword arguments
+        #  (keyword arguments take precedence)
+        o=dict(defaultOptions)
+        for (name,value) in list((options or {}).items())+list(kwargs.items()):
+            if name not in defaultOptions:
+                raise TypeError('unknown sartopo_bg option: '+str(name))
+            o[name]=value
+        self.options=o
         # do not register the callbacks until after the initial processing; that way we
         #  can be sure to process existing assignments first
 
@@ -36,22 +101,61 @@ class sartopo_bg():
         self.dmdFileName=self.fileNameBase+'.json'
         # assignmentsFileName=fileNameBase+'_assignments.json'
 
-        # To redefine basicConfig, per stackoverflow.com/questions/12158048
-        # Remove all handlers associated with the root logger object.
-        for handler in logging.root.handlers[:]:
-            logging.root.removeHandler(handler)
-        logging.basicConfig(
-            level=logging.INFO,
-            format='%(asctime)s [%(levelname)s] %(message)s',
-            handlers=[
-                logging.FileHandler(self.fileNameBase+'_bg.log','w'),
-                logging.StreamHandler(sys.stdout)
-            ]
-        )
-
-        # different logging level for different modules:
-        # https://stackoverflow.com/a/7243225/3577105
-        logging.getLogger('sartopo_python').setLevel(logging.DEBUG)
+        # log to file and stdout from a separate thread (see dmg_logging.py); full dumps of dmd and
+        #  map data are only produced with logLevel=logging.DEBUG
+        self.logListener=None
+        if o['logLevel'] is not None:
+            self.logListener=setupLogging(self.fileNameBase,o['logLevel'])
+
+            # different logging level for different modules:
+            # https://stackoverflow.com/a/7243225/3577105
+            logging.getLogger('sartopo_python').setLevel(logging.DEBUG)
+
+        self.domainAndPort=o['domainAndPort']
+        self.sessionClass=o['sessionClass'] # SartopoSession, except for offline benchmarking or replay (see dmg_fakesession.py)
+        self.coalesceWindow=o['coalesceWindow']
+        # sync-cycle batching: the source map events from each sync pass are handled as one batch,
+        #  in dependency order (see cycleOrder), and dmd is persisted once at the end of the batch
+        #  (see endSyncCycle); coalesceWindow is then only the longest time an event waits for the
+        #  end of its sync pass
+        self.syncBatching=o['syncBatching']
+        self.recordFile=o['recordFile']
+        self.statsInterval=o['statsInterval'] # seconds between stats log messages in runForever
+        self.warmStart=o['warmStart'] # use the map cache from the previous run, if there is one
+        self.mapCache=MapCache(self.fileNameBase)
+        # debrief PDFs: if pdfDir is specified, requestPdf renders outings in the background, in a
+        #  pool of pdfWorkers processes (see dmg_render.py)
+        self.pdfDir=o['pdfDir']
+        self.pdfWorkers=o['pdfWorkers']
+        self.tileDir=o['tileDir']
+        self.paper=o['paper']
+        self.renderQueue=None
+        # debrief readiness (see dmg_readiness.py): the outings affected by each source map event
+        #  are described again every few seconds; an outing whose debrief content has been complete
+        #  and unchanged for readySettle seconds, and has not been rendered in that version, is
+        #  'ready': with autoPdf, its debrief PDF is then rendered; readinessCallback(title,event,state),
+        #  if specified, is called for every readiness event (e.g. for a UI)
+        self.autoPdf=o['autoPdf']
+        self.readinessCallback=o['readinessCallback']
+        self.readiness=ReadinessTracker(self.describeOuting,self.readinessEvent,settle=o['readySettle'])
+        # instrumentation (see dmg_metrics.py): counters and latency histograms of the hot paths,
+        #  logged as one line with the stats, and served at http://localhost:<metricsPort>/metrics
+        #  if metricsPort is specified; SIGUSR2 (see runForever) captures a cProfile of source
+        #  map event handling for profileSeconds seconds
+        self.metrics=Metrics()
+        self.metricsPort=o['metricsPort']
+        self.metricsServer=None
+        self.profiler=ProfileCapture(self.fileNameBase,duration=o['profileSeconds'])
+        self.sts1=None
+        self.sts2=None
+        self.eventQueue=None
+        self.eventRecorder=None
+        self.running=False
+        self.stopRequested=threading.Event()
+        self.statsLock=threading.Lock()
+        self.eventCounts={'submitted':0,'handled':0} # source map events passed to / finished by the target writer
+        self.sourceTaskLock=threading.Lock()
+        self.lastSourceTasks={} # key = source id, val = (write key, Future) of its latest unfinished event
 
         # rotate track colors: red, green, blue, orange, cyan, purple, then darker versions of each
         self.trackColorDict={
@@ -71,61 +175,691 @@ class sartopo_bg():
         self.dmd={} # master map data and correspondence dictionary - short for 'Debrief Map Data'
         self.dmd['outings']={}
         self.dmd['corr']={}
+        # duplicate tracks: key = source id of a track that was not imported because it duplicates
+        #  another imported track of the same outing, val = source id of that track
+        self.dmd['dups']={}
 
         self.outingSuffixDict={} # index numbers for duplicate-named assignments
+
+        # track cropping: tracks are cropped to a bit beyond the assignment boundary;
+        #  if localCrop is True, tracks are cropped in this process (see dmg_geometry.py) and only
+        #  the cropped lines are uploaded to the target map; otherwise, the uncropped track is
+        #  uploaded and then cropped with sts2.crop
+        self.localCrop=o['localCrop']
+        self.cropBeyond=0.001 # degrees; about 100 meters
+        self.cropBoundaries={} # key = boundary id (target map), val = CropBoundary or DistanceBoundary
+        # roaming outings (see dmg_reconcile.isRoaming): tracks are cropped to roamingDistance meters
+        #  from the assignment shape instead; this is always done locally, since sts2.crop can only
+        #  crop to a boundary
+        self.roamingDistance=o['roamingDistance']
+        self.roamingBoundaries={} # cache, key = boundary id, val = True if the outing is roaming
+        # track simplification: if simplifyScale is specified (e.g. 24000 for 1:24000), tracks are
+        #  simplified to the detail that can be seen on a printout at that scale, and their
+        #  coordinates are rounded to quantizeDigits decimal places (6: about 10cm), before they
+        #  are cropped and uploaded; elevation and time of the remaining vertices are kept
+        self.simplifyTolerance=printTolerance(o['simplifyScale']) if o['simplifyScale'] else None # meters
+        self.quantizeDigits=o['quantizeDigits']
+        self.simplifyCounts={'tracks':0,'verticesIn':0,'verticesOut':0}
+        # duplicate track detection (see findDuplicateTrack): 'exact' skips tracks that are exact
+        #  copies of an imported track of the same outing, 'near' also skips near-identical tracks
+        #  (e.g. from two devices carried by the same searcher), and None imports every track
+        self.duplicateTracks=o['duplicateTracks']
+        self.trackFingerprints={} # cache, key = source track id, val = TrackFingerprint
+        # trackCropState - what part of each source track has already been cropped and imported, so
+        #  that geometry updates which only append vertices (growing live tracks) can be handled by
+        #  cropping just the new vertices; key = source track id, val = dictionary:
+        #     at - outing title
+        #     bid - boundary id that the track was cropped to
+        #     n - number of source vertices that have been processed
+        #     hash - hash of those n vertices (to detect edits of existing vertices)
+        #     open - True if the last processed vertex is inside the boundary, i.e. the last
+        #              cropped line can be extended
+        self.trackCropState={}
+
+        # propertyFingerprints - key = source feature id, val = fingerprint of the source feature
+        #  properties that affect the target map (see dmg_reconcile.propertyFingerprint); property
+        #  updates that don't change the fingerprint are ignored
+        self.propertyFingerprints={}
+
+        # dmd persistence (see dmg_store.py): dmdBackend='json' writes one journal record per change,
+        #  with periodic snapshots; 'sqlite' keeps dmd in indexed SQLite tables, committed in batches
+        self.dmdStore=openDmdStore(self.fileNameBase,o['dmdBackend'],batched=o['syncBatching'])
+        # dmdLock must be held while adding or removing dmd entries, since source map events for
+        #  different outings are handled concurrently (see writeWorkers below)
+        self.dmdLock=threading.RLock()
+
+        # target map work for each source map event is run by a pool of writeWorkers threads;
+        #  events for the same outing are handled in order (see writeKey and dmg_writer.py)
+        self.writer=TargetWriter(o['writeWorkers'])
+        self.sourceEventHandlers={
+            'new':self.newFeatureCallback,
+            'property':self.propertyUpdateCallback,
+            'geometry':self.geometryUpdateCallback,
+            'deleted':self.deletedFeatureCallback}
+
+        # sets of ids of all features that currently exist in the source and target maps;
+        #  built in initDmd, then maintained incrementally as features are added and deleted,
+        #  so that membership checks don't need to rebuild a list of every id in the map
+        self.sourceIds=set()
+        self.targetIds=set()
+        # unverifiedSids - source ids whose dmd entries were trimmed or discarded by initDmd because
+        #  target features are missing; these are always reconciled, even on a warm start
+        self.unverifiedSids=set()
+
+        # reverse lookups into dmd, so that callbacks don't need to scan every outing or every
+        #  correspondence entry; rebuilt by initDmd and kept up to date by the dmd mutation methods
+        #  (addCorrespondence, removeCorrespondence, addOutingTracks, removeOutingTracks, etc.)
+        #  tidToSid - key = target map feature id, val = corresponding source map feature id (from dmd['corr'])
+        #  sidToOutings - key = source map assignment id, val = list of outing titles for that assignment
+        #  tidToOuting - key = target map track id (cropped or uncropped), val = outing title
+        self.tidToSid={}
+        self.sidToOutings={}
+        self.tidToOuting={}
+        # printIndex - spatial index of the target map features that don't belong to any outing
+        #  (markers, clues, other lines and polygons), so that the features inside an outing's
+        #  print area can be found without scanning the whole map (see dmg_geometry.GridIndex);
+        #  rebuilt by initDmd, then updated as those features are added, moved and deleted
+        self.printIndex=GridIndex()
         # def writeAssignmentsFile():
         #     # write the correspondence file
         #     with open(assignmentsFileName,'w') as assignmentsFile:
         #         assignmentsFile.write(json.dumps(assignments,indent=3))
 
+    # start - open the map sessions, bring the target map up to date with the source map, then
+    #  register the source map callbacks; returns once the initial import is done
+    def start(self):
+        # warm start: if the previous run stopped cleanly, start each session from the cached map
+        #  data, so that only the changes since then are downloaded; the ids of the features
+        #  that changed are collected by temporary callbacks, and only those are reconciled
+        sessionClass=self.sessionClass
+        cache=None
+        if self.warmStart and self.dmdStore.exists():
+            cache=self.mapCache.load(self.sourceMapID,self.targetMapID)
+            if cache:
+                sessionClass=warmSessionClass(self.sessionClass)
+                if sessionClass is None:
+                    logging.info('warm start is not supported by '+str(self.sessionClass)+'; doing a full sync instead')
+                    sessionClass=self.sessionClass
+                    cache=None
+        changed={'source':set(),'target':set()}
+        def warmArgs(side):
+            if not cache:
+                return {}
+            note=partial(self.noteChangedId,changed[side])
+            return {'warmMapCache':cache[side],
+                'newFeatureCallback':note,'propertyUpdateCallback':note,
+                'geometryUpdateCallback':note,'deletedFeatureCallback':note}
+        t0=time.time()
+
         # open a session on the target map first, since nocb definition checks for it
         try:
-            self.sts2=SartopoSession('localhost:8080',self.targetMapID,
+            self.sts2=sessionClass(self.domainAndPort,self.targetMapID,
                 sync=False,
                 syncTimeout=10,
-                syncDumpFile='../../'+self.targetMapID+'.txt')
-        except:
-            sys.exit()
+                syncDumpFile='../../'+self.targetMapID+'.txt',
+                **warmArgs('target'))
+        except Exception:
+            logging.exception('could not open a session on target map '+self.targetMapID)
+            raise
+        instrumentSession(self.sts2,self.metrics,'sts2',targetSessionMethods)
 
-            
         try:
-            self.sts1=SartopoSession('localhost:8080',self.sourceMapID,
+            self.sts1=(syncCycleSessionClass(sessionClass) if self.syncBatching else sessionClass)(self.domainAndPort,self.sourceMapID,
                 syncDumpFile='../../'+self.sourceMapID+'.txt',
                 # newFeatureCallback=self.initialNewFeatureCallback,
                 # propertyUpdateCallback=self.propertyUpdateCallback,
                 # geometryUpdateCallback=self.geometryUpdateCallback,
                 # deletedFeatureCallback=self.deletedFeatureCallback,
-                syncTimeout=10)
-        except:
-            sys.exit()
+                syncTimeout=10,
+                **warmArgs('source'))
+        except Exception:
+            logging.exception('could not open a session on source map '+self.sourceMapID)
+            raise
 
         # wait for the source map sync to complete before trying to read an existing dmd file,
         #  otherwise all correspondences will be invalid because the sid's are not yet in
         #  the source cache
         self.sts1.refresh() # this should do a blocking refresh
         self.initDmd()
-
-        # now that dmd is generated, all source map features should be passed to newFeatureCallback,
-        #  which is what would happen if the callback were registered when sts1 was created - but
-        #  that would be too early, since the feature creation functions rely on dmd
-        for f in self.sts1.mapData['state']['features']:
-            self.newFeatureCallback(f)
+        logging.info(('warm' if cache else 'cold')+' start: map sessions opened and dmd loaded in '+str(round(time.time()-t0,3))+' seconds')
+
+        # optionally record the source map events, for offline replay (see dmg_replay.py)
+        if self.recordFile:
+            self.eventRecorder=EventRecorder(self.recordFile)
+            self.eventRecorder.start(self.sourceMapID,self.sts1.mapData['state']['features'])
+
+        # now that dmd is generated, bring the target map up to date with the source map: this
+        #  imports any source features that are not yet on the target map, and also applies any
+        #  edits or deletions that happened on the source map while this program was not running
+        #  (see reconcile and dmg_reconcile.py); on a warm start, only the source features affected
+        #  by changes since the previous run need to be checked
+        if cache:
+            sids=self.getWarmStartSids(changed)
+            logging.info('warm start: '+str(len(changed['source']))+' source and '+str(len(changed['target']))+
+                ' target map changes since '+time.strftime('%Y-%m-%d %H:%M:%S',time.localtime(cache['saved']))+
+                '; reconciling '+str(len(sids))+' source feature(s)')
+            self.reconcile(sids=sids)
+        else:
+            self.reconcile()
+        self.flushDmd()
+        self.readiness.touchAll(list(self.dmd['outings'].keys()))
+        self.readiness.start()
 
         # don't register the callbacks until after the initial refresh dmd file processing,
-        #  to prevent duplicate feature creation in the target map on restart
-        self.sts1.newFeatureCallback=self.newFeatureCallback
-        self.sts1.propertyUpdateCallback=self.propertyUpdateCallback
-        self.sts1.geometryUpdateCallback=self.geometryUpdateCallback
-        self.sts1.deletedFeatureCallback=self.deletedFeatureCallback
-    
-        # need to run this program in a loop - it's not a background/daemon process
-        while True:
-            time.sleep(5)
-            logging.info('dmd:\n'+str(json.dumps(self.dmd,indent=3)))
+        #  to prevent duplicate feature creation in the target map on restart;
+        # unless coalesceWindow is None, source map events go through a queue that combines
+        #  bursts of events for the same feature (see dmg_events.py); the handlers are then called
+        #  from the queue's worker thread rather than from the sartopo_python sync thread; with
+        #  syncBatching, the queue also collects the events of each sync pass into one batch
+        if self.syncBatching:
+            self.eventQueue=CoalescingQueue({kind:partial(self.submitSourceEvent,kind) for kind in self.sourceEventHandlers},
+                window=1.0 if self.coalesceWindow is None else self.coalesceWindow,
+                order=self.cycleOrder,batchCallback=self.endSyncCycle)
+            self.eventQueue.start()
+            self.sts1.syncCycleCallback=self.eventQueue.endCycle
+        elif self.coalesceWindow is None:
+            self.eventQueue=None
+            callbacks={kind:partial(self.submitSourceEvent,kind) for kind in self.sourceEventHandlers}
+        else:
+            self.eventQueue=CoalescingQueue({kind:partial(self.submitSourceEvent,kind) for kind in self.sourceEventHandlers},
+                window=self.coalesceWindow)
+            self.eventQueue.start()
+        if self.eventQueue:
+            callbacks={
+                'new':self.eventQueue.newFeatureCallback,
+                'property':self.eventQueue.propertyUpdateCallback,
+                'geometry':self.eventQueue.geometryUpdateCallback,
+                'deleted':self.eventQueue.deletedFeatureCallback}
+        if self.eventRecorder:
+            callbacks={kind:self.eventRecorder.wrap(kind,callback) for (kind,callback) in callbacks.items()}
+        self.setSourceCallbacks(callbacks)
+        if self.metricsPort is not None:
+            self.metricsServer=MetricsServer(self.metrics,self.getGauges,self.getMetrics,self.metricsPort)
+            self.metricsServer.start()
+        if self.pdfDir:
+            os.makedirs(self.pdfDir,exist_ok=True)
+            self.renderQueue=RenderQueue(self.buildPdfJob,workers=self.pdfWorkers,resultCallback=self.pdfRendered)
+            self.renderQueue.start()
+        self.stopRequested.clear()
+        self.running=True
+        logging.info('started: source map '+self.sourceMapID+' --> target map '+self.targetMapID)
+
+    def setSourceCallbacks(self,callbacks):
+        self.sts1.newFeatureCallback=callbacks['new']
+        self.sts1.propertyUpdateCallback=callbacks['property']
+        self.sts1.geometryUpdateCallback=callbacks['geometry']
+        self.sts1.deletedFeatureCallback=callbacks['deleted']
+
+    # noteChangedId - temporary callback during a warm start: collect the id of each feature that
+    #  changed since the map cache was saved (deletedFeatureCallback is called with the id and
+    #  class instead of the feature, in newer sartopo_python versions)
+    def noteChangedId(self,ids,f,*args):
+        ids.add(f['id'] if isinstance(f,dict) else f)
+
+    # getWarmStartSids - source feature ids that need to be reconciled after a warm start: the
+    #  source features that changed, the source features whose target features changed, the
+    #  tracks of changed assignments (their crop boundary may have changed), and any correspondence
+    #  or outing that initDmd could not verify
+    def getWarmStartSids(self,changed):
+        sids=set(changed['source'])|self.unverifiedSids
+        sids|=set(self.dmd['corr'].keys())-self.sourceIds
+        for tid in changed['target']:
+            if tid in self.tidToSid:
+                sids.add(self.tidToSid[tid])
+        outingTitles=set()
+        for (ot,o) in self.dmd['outings'].items():
+            if o['bid'] in changed['target'] or o['fid'] in changed['target']:
+                sids.add(o['sid'])
+            if o['sid'] in sids:
+                outingTitles.add(ot)
+        for sid in changed['source']:
+            f=self.sts1.getFeature(id=sid)
+            if f and f['properties'].get('class','')=='Assignment':
+                outingTitles.add(f['properties'].get('title','').upper())
+        for (ot,o) in self.dmd['outings'].items():
+            if ot in outingTitles or ot.split(':')[0] in outingTitles:
+                for tid in sum(o['tids'],[])+o['utids']:
+                    if tid in self.tidToSid:
+                        sids.add(self.tidToSid[tid])
+        sids|={dsid for (dsid,osid) in self.dmd['dups'].items() if osid in sids}
+        sids.discard(None)
+        return sids
+
+    # requestStop - make runForever return (after stopping); safe to call from any thread or
+    #  from a signal handler
+    def requestStop(self,*args):
+        self.stopRequested.set()
+
+    # requestPdf - queue debrief PDF rendering for the specified outing titles (default: all
+    #  outings); lower priority numbers are rendered first (default: first come first served);
+    #  with changedOnly, outings whose debrief content has not changed since their PDF was last
+    #  rendered are skipped (unless the PDF file is missing)
+    def requestPdf(self,titles=None,priority=None,changedOnly=False):
+        if not self.renderQueue:
+            logging.warning('debrief PDFs were requested, but no PDF directory was specified')
+            return
+        with self.dmdLock:
+            titles=list(self.dmd['outings'].keys()) if titles is None else titles
+        if changedOnly:
+            self.readiness.check()
+            n=len(titles)
+            titles=[title for title in titles if self.readiness.isChanged(title) or not path.exists(pdfFileName(self.pdfDir,title))]
+            logging.info('debrief PDFs: '+str(len(titles))+' of '+str(n)+' outing(s) changed since they were last rendered')
+        for title in titles:
+            self.renderQueue.request(title,priority)
+
+    # requestChangedPdfs - requestPdf(changedOnly=True) in a new thread; safe to call from a signal
+    #  handler, since the readiness check it runs could otherwise block the interrupted thread
+    def requestChangedPdfs(self,*args):
+        threading.Thread(target=self.requestPdf,kwargs={'changedOnly':True},name='RequestPdf',daemon=True).start()
+
+    # buildPdfJob - called by the render queue when a worker is free (see dmg_render.RenderQueue)
+    def buildPdfJob(self,title):
+        with self.dmdLock:
+            outing=self.dmd['outings'].get(title)
+            if outing is None:
+                return None
+            outing=json.loads(json.dumps(outing))
+        return buildDebriefJob(title,outing,lambda id:self.sts2.getFeature(id=id),self.printIndex,pdfFileName(self.pdfDir,title),
+            cropBeyond=self.cropBeyond,paper=self.paper,tileDir=self.tileDir)
+
+    # pdfRendered - called by the render queue with each result: remember which version of the
+    #  outing's content was rendered, in dmd so that it is still known after a restart
+    def pdfRendered(self,result):
+        if 'seconds' in result:
+            self.metrics.observe('pdf.render',result['seconds'])
+        if result.get('error') or not result.get('contentHash'):
+            return
+        title=result['title']
+        with self.dmdLock:
+            o=self.dmd['outings'].get(title)
+            if o is None:
+                return
+            o['rendered']=result['contentHash']
+            self.journalDmd('outings',title)
+        self.readiness.touch(title)
+
+    # describeOuting - current debrief readiness description of the outing (see dmg_readiness.py),
+    #  or None if it no longer exists
+    def describeOuting(self,title):
+        with self.dmdLock:
+            outing=self.dmd['outings'].get(title)
+            if outing is None:
+                return None
+            outing=json.loads(json.dumps(outing))
+        (boundary,tracks,clues,clueIds)=outingContent(outing,lambda id:self.sts2.getFeature(id=id),self.printIndex,self.cropBeyond)
+        return {
+            'tracks':sum(1 for tidList in outing['tids'] if tidList),
+            'uncropped':len(outing['utids']),
+            'clues':len(clues),
+            'boundary':boundary is not None,
+            'hash':contentHash({'boundary':boundary,'tracks':tracks,'clues':clues}),
+            'rendered':outing.get('rendered')}
+
+    def readinessEvent(self,title,event,state):
+        if event=='ready' and self.autoPdf and self.renderQueue:
+            self.requestPdf([title])
+        if self.readinessCallback:
+            self.readinessCallback(title,event,state)
+
+    # affectedOutings - titles of the outings whose debrief may change when the source feature f
+    #  changes: the outings of an assignment, and the outing that a track belongs to (by its
+    #  title) and the outing(s) that its cropped lines are in; None (all outings) for a clue, since
+    #  a clue is shown on the debrief of whichever outing's area it is in
+    def affectedOutings(self,f):
+        p=f.get('properties',{})
+        c=p.get('class','')
+        if c=='Clue':
+            return None
+        sid=f['id']
+        with self.dmdLock:
+            ots=set(self.sidToOutings.get(sid,[]))
+            ots.update(self.tidToOuting[tid] for tid in self.dmd['corr'].get(sid,[]) if tid in self.tidToOuting)
+        tparse=self.parseTrackName(p.get('title',''))
+        if c=='Shape' and tparse:
+            ots.add(tparse[0]+' '+tparse[1])
+        return ots
+
+    def touchOutings(self,ots):
+        if ots is None:
+            with self.dmdLock:
+                self.readiness.touchAll(list(self.dmd['outings'].keys()))
+        else:
+            for ot in ots:
+                self.readiness.touch(ot)
+
+    # runForever - wait until stop is requested, logging stats every statsInterval seconds, then
+    #  stop; SIGINT (ctrl-c) and SIGTERM request a stop, and SIGUSR1 requests debrief PDFs of all
+    #  outings that changed since they were last rendered, and SIGUSR2 starts (or ends) a profile
+    #  capture (see dmg_metrics.ProfileCapture), if this is called from the main thread
+    def runForever(self):
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT,self.requestStop)
+            signal.signal(signal.SIGTERM,self.requestStop)
+            if hasattr(signal,'SIGUSR1'):
+                signal.signal(signal.SIGUSR1,self.requestChangedPdfs)
+            if hasattr(signal,'SIGUSR2'):
+                signal.signal(signal.SIGUSR2,self.profiler.request)
+        while not self.stopRequested.wait(self.statsInterval):
+            self.logStats()
+        logging.info('stop requested')
+        self.stop()
+
+    # getStats - summary of how far behind the source map this instance is, and how much work it
+    #  has done; lag is the age (seconds) of the oldest source map event that has been received but
+    #  not yet completely handled
+    def getStats(self):
+        queueStats=self.eventQueue.getStats() if self.eventQueue else {}
+        writerStats=self.writer.getStats()
+        with self.dmdLock:
+            outings=len(self.dmd['outings'])
+            corr=len(self.dmd['corr'])
+            dups=len(self.dmd['dups'])
+            uncropped=sum(len(o['utids']) for o in self.dmd['outings'].values())
+        with self.statsLock:
+            eventCounts=dict(self.eventCounts)
+        return {
+            'running':self.running,
+            'eventsReceived':queueStats.get('events',eventCounts['submitted']),
+            'eventsHandled':eventCounts['handled'],
+            'queueDepth':queueStats.get('depth',0),
+            'writesSubmitted':writerStats['submitted'],
+            'writesCompleted':writerStats['completed'],
+            'writesFailed':writerStats['failed'],
+            'writesOutstanding':writerStats['outstanding'],
+            'lag':max(self.eventQueue.getLag() if self.eventQueue else 0,writerStats['oldestAge']),
+            'outings':outings,
+            'corr':corr,
+            'uncropped':uncropped,
+            'duplicateTracks':dups,
+            'pdf':self.renderQueue.getStats() if self.renderQueue else None,
+            'readiness':self.readiness.getStats(),
+            'simplify':self.getSimplifyStats()}
+
+    # getGauges - the numeric values of getStats, for the metrics endpoint
+    def getGauges(self):
+        return {k:v for (k,v) in self.getStats().items() if isinstance(v,(int,float)) and not isinstance(v,bool)}
+
+    # getMetrics - everything, for the metrics endpoint's json
+    def getMetrics(self):
+        return {'stats':self.getStats(),'metrics':self.metrics.snapshot()}
+
+    def getSimplifyStats(self):
+        with self.statsLock:
+            s=dict(self.simplifyCounts)
+        s['ratio']=s['verticesIn']/s['verticesOut'] if s['verticesOut'] else None
+        return s
+
+    def logStats(self):
+        logging.debug('dmd:\n%s',LazyJson(self.dmd))
+        if self.eventQueue:
+            logging.info('event queue: '+str(self.eventQueue.getStats()))
+        logging.info('target writer: '+str(self.writer.getStats()))
+        if self.renderQueue:
+            logging.info('debrief PDFs: '+str(self.renderQueue.getStats()))
+        logging.info('debrief readiness: '+str(self.readiness.getStats()))
+        stats=self.getStats()
+        logging.info('metrics: '+self.metrics.statsLine({k:stats[k] for k in ['lag','queueDepth','writesOutstanding','outings','corr','uncropped']}))
+        if self.simplifyTolerance:
+            logging.info('track simplification: '+str(self.getSimplifyStats()))
+        if self.eventRecorder:
+            self.eventRecorder.flush()
+
+    # stop - graceful shutdown: stop receiving source map events, handle the events already
+    #  received (unless drain is False), wait for target map writes to finish, then write a dmd
+    #  snapshot so that the next start doesn't need to replay the journal; returns False if the
+    #  pending work did not finish within timeout seconds (the snapshot is written anyway);
+    #  a stopped instance can't be started again - create a new one instead
+    def stop(self,drain=True,timeout=None):
+        if not self.running:
+            return True
+        self.running=False
+        self.stopRequested.set()
+        deadline=None if timeout is None else time.time()+timeout
+        def remaining():
+            return None if deadline is None else max(0,deadline-time.time())
+        self.setSourceCallbacks({kind:None for kind in self.sourceEventHandlers})
+        syncStopped=self.stopSourceSync()
+        if self.eventQueue:
+            self.eventQueue.stop(drain=drain,timeout=remaining())
+        finished=self.writer.drain(remaining())
+        if finished:
+            self.writer.shutdown()
+        else:
+            logging.warning('stop: target map writes did not finish within '+str(timeout)+' seconds')
+        self.readiness.stop(remaining())
+        if self.renderQueue:
+            if drain and not self.renderQueue.wait(remaining()):
+                logging.warning('stop: debrief PDFs did not finish within '+str(timeout)+' seconds')
+            self.renderQueue.stop()
+        with self.dmdLock:
+            self.writeDmdFile()
+            self.dmdStore.close()
+        # the map cache is only valid if every source map change in it has been handled
+        self.mapCache.discard()
+        if syncStopped and finished:
+            try:
+                if self.mapCache.save(self.sts1,self.sts2):
+                    logging.info('map cache written: '+self.mapCache.fileName)
+            except Exception:
+                logging.exception('map cache could not be written; the next start will do a full sync')
+                self.mapCache.discard()
+        if self.eventRecorder:
+            self.eventRecorder.close()
+        self.profiler.finish()
+        if self.metricsServer:
+            self.metricsServer.stop()
+        self.logStats()
+        logging.info('stopped: source map '+self.sourceMapID+' --> target map '+self.targetMapID)
+        if self.logListener:
+            stopLogging(self.logListener)
+            self.logListener=None
+        return finished
+
+    # stopSourceSync - stop the source map sync thread, if the session supports it, and wait for
+    #  a sync that is in progress to finish; returns True if syncing has stopped
+    def stopSourceSync(self,timeout=15):
+        stopMethod=getattr(self.sts1,'stop',None) or getattr(self.sts1,'_stop',None)
+        if stopMethod is None:
+            return False
+        stopMethod()
+        deadline=time.time()+timeout
+        while getattr(self.sts1,'syncing',False):
+            if time.time()>deadline:
+                return False
+            time.sleep(0.1)
+        return True
+
+    # writeKey - key for ordering target map work: source events with the same key are handled
+    #  one at a time in the order received, and events with different keys may be handled
+    #  concurrently; assignments and tracks are keyed by outing title, so that everything for
+    #  one outing (folder, boundary, tracks, crops) happens in order; other features are keyed
+    #  by their source id
+    def writeKey(self,f):
+        p=f['properties']
+        c=p.get('class','')
+        t=p.get('title','')
+        tparse=self.parseTrackName(t)
+        if c=='Assignment':
+            if tparse: # 'AA 101' and 'AA101' both give the same key as track 'AA101a'
+                return tparse[0]+' '+tparse[1]
+            return t.upper() or 'NOTITLE'
+        if c=='Shape' and f['geometry'] and f['geometry']['type']=='LineString' and tparse:
+            return tparse[0]+' '+tparse[1]
+        return f['id']
+
+    # submitSourceEvent - hand a source map event ('new','property','geometry','deleted') to the
+    #  target writer; returns a Future; if the feature's write key changed (e.g. a track was
+    #  retitled to another outing) while an earlier event for the same feature is still pending
+    #  under its old key, this event waits for that one, so that the events of each feature are
+    #  still handled one at a time in order
+    def submitSourceEvent(self,kind,f):
+        key=self.writeKey(f)
+        sid=f['id']
+        with self.statsLock:
+            self.eventCounts['submitted']+=1
+        with self.sourceTaskLock:
+            last=self.lastSourceTasks.get(sid,None)
+        after=last[1] if last and last[0]!=key else None
+        future=self.writer.submitAfter(after,key,self.handleSourceEvent,kind,f,key)
+        if not future.done():
+            with self.sourceTaskLock:
+                self.lastSourceTasks[sid]=(key,future)
+            future.add_done_callback(partial(self.sourceTaskDone,sid))
+        return future
+
+    def sourceTaskDone(self,sid,future):
+        with self.sourceTaskLock:
+            last=self.lastSourceTasks.get(sid,None)
+            if last and last[1] is future:
+                del self.lastSourceTasks[sid]
+
+    # handleSourceEvent - call the handler for the event, and log one record with the result and duration,
+    #  and mark the outings that it may have changed for the readiness tracker
+    def handleSourceEvent(self,kind,f,key):
+        t0=time.time()
+        ok=False
+        before=self.affectedOutings(f)
+        try:
+            self.profiler.call(self.sourceEventHandlers[kind],f)
+            ok=True
+        finally:
+            with self.statsLock:
+                self.eventCounts['handled']+=1
+            logEvent(kind,f['id'],None if key==f['id'] else key,time.time()-t0,ok)
+            self.metrics.observe('event.'+kind,time.time()-t0)
+            if not ok:
+                self.metrics.count('events.failed')
+            after=self.affectedOutings(f)
+            self.touchOutings(None if before is None or after is None else before|after)
+
+    # cycleOrder - dispatch order within one sync-cycle batch: assignments first, so that each
+    #  outing exists before its tracks are handled, then tracks, then everything else
+    def cycleOrder(self,f):
+        p=f.get('properties',{})
+        c=p.get('class','')
+        if c=='Assignment':
+            return 0
+        if c=='Shape' and f.get('geometry') and f['geometry']['type']=='LineString' and self.parseTrackName(p.get('title','')):
+            return 1
+        return 2
+
+    # endSyncCycle - called by the event queue after it has submitted one sync-cycle batch: wait
+    #  for the target map work of the batch to finish, then persist dmd once for the whole batch
+    def endSyncCycle(self,futures):
+        concurrent.futures.wait([f for f in futures if f is not None])
+        self.flushDmd()
+        logging.debug('dmd after sync cycle:\n%s',LazyJson(self.dmd))
+
+    # reconcile - compare the entire target map (or just the parts corresponding to the source
+    #  feature ids in sids) to what it should be based on the source map and dmd, and apply the
+    #  operations needed to make them match; with dryRun, the plan is only logged; returns the plan
+    #  (see dmg_reconcile.py for the plan format)
+    # this should only be called when no source events are being handled (at startup, before the
+    #  callbacks are registered, or after the event queue and target writer have been drained)
+    def reconcile(self,sids=None,dryRun=False):
+        targetFeatures={f['id']:f for f in self.sts2.mapData['state']['features']}
+        with self.dmdLock:
+            plan=planReconcile(self.sts1.mapData['state']['features'],targetFeatures,self.dmd,
+                self.trackColorDict,self.cropBeyond,self.writeKey,sids,self.roamingDistance,
+                self.simplifyTolerance,self.quantizeDigits,self.duplicateTracks)
+        logging.info('reconcile'+(' (dry run)' if dryRun else '')+': '+str(len(plan))+' operation(s): '+str(summarizePlan(plan)))
+        for op in plan:
+            logging.info('  '+op['op']+' key='+str(op['key'])+' '+str({k:v for (k,v) in op.items() if k in ['sid','tid','tids','outing','title']}))
+        if dryRun:
+            return plan
+        futures=[self.writer.submit(op['key'],self.applyPlanOp,op) for op in plan]
+        self.writer.drain()
+        for f in self.sts1.mapData['state']['features']:
+            if sids is None or f['id'] in sids:
+                self.recordFingerprint(f)
+        self.touchOutings(None)
+        failed=[op for (op,future) in zip(plan,futures) if future.exception() is not None]
+        if failed:
+            logging.error('reconcile: '+str(len(failed))+' operation(s) failed; they will be attempted again on the next reconcile')
+        self.restoreTrackCropStates({op['f']['id'] for op in failed if 'f' in op})
+        return plan
+
+    # applyPlanOp - apply one reconcile plan operation to the target map, and update dmd to match;
+    #  dmd is only changed after the corresponding target map write succeeds
+    def applyPlanOp(self,op):
+        t0=time.time()
+        ok=False
+        sid=op['f']['id'] if 'f' in op else op.get('sid',None)
+        try:
+            self.profiler.call(self.applyPlanOpNow,op)
+            ok=True
+        finally:
+            logEvent('reconcile:'+op['op'],sid,None if op['key']==sid else op['key'],time.time()-t0,ok)
+            self.metrics.observe('reconcile.'+op['op'],time.time()-t0)
+            if not ok:
+                self.metrics.count('reconcile.failed')
+
+    def applyPlanOpNow(self,op):
+        kind=op['op']
+        if kind=='addOuting':
+            self.addOuting(op['f'])
+        elif kind=='retitleOuting':
+            self.retitleOuting(op['outing'],op['title'])
+        elif kind=='editBoundary':
+            self.sts2.editObject(id=op['bid'],geometry=op['geometry'])
+            self.forgetCropBoundary(op['bid'])
+        elif kind=='addFeature':
+            self.newFeatureCallback(op['f'],op.get('pieces',None))
+        elif kind=='replaceFeature':
+            self.removeTargetFeatures(op['f']['id'],op['tids'],self.targetClass(op['f']))
+            self.newFeatureCallback(op['f'],op.get('pieces',None))
+        elif kind=='editFeature':
+            tp=dict(self.sts2.getFeature(id=op['tid'])['properties'])
+            tp.update(op['properties'])
+            self.sts2.editObject(id=op['tid'],properties=tp,geometry=op['geometry'])
+            if op['geometry'] and op['tid'] in self.printIndex:
+                self.printIndex.insert(op['tid'],op['geometry'])
+        elif kind=='deleteFeatures':
+            self.removeTargetFeatures(op['sid'],op['tids'])
+        else:
+            logging.error('unknown reconcile operation '+str(kind))
+
+    def recordFingerprint(self,f):
+        self.propertyFingerprints[f['id']]=propertyFingerprint(f,self.trackColorDict)
+
+    # targetClass - class of the target map feature(s) that correspond to the source feature
+    def targetClass(self,f):
+        return 'Marker' if f['properties'].get('class','') in ['Marker','Clue'] else 'Shape'
+
+    # removeTargetFeatures - delete the target map features that correspond to the source feature,
+    #  and remove them from dmd
+    def removeTargetFeatures(self,sid,tids,className=None):
+        self.trackCropState.pop(sid,None)
+        for tid in tids:
+            if tid in self.targetIds:
+                if className:
+                    c=className
+                else:
+                    c=self.sts2.getFeature(id=tid)['properties'].get('class','Shape')
+                self.delTargetFeature(c,tid)
+        self.removeOutingTracks(tids)
+        self.removeCorrespondence(sid)
 
+    # writeDmdFile - write a full snapshot of dmd (and start a new journal); this is only needed
+    #  at startup and when the journal gets long, since each individual change is journaled
     def writeDmdFile(self):
-        with open(self.dmdFileName,'w') as dmdFile:
-            dmdFile.write(json.dumps(self.dmd,indent=3))
+        with self.dmdLock,self.metrics.timer('dmd.snapshot'):
+            self.dmdStore.writeSnapshot(self.dmd)
+
+    # flushDmd - make sure that all dmd changes so far are on disk (see dmg_store.py)
+    def flushDmd(self):
+        with self.dmdLock,self.metrics.timer('dmd.flush'):
+            if self.dmdStore.flush():
+                self.writeDmdFile()
+
+    # journalDmd - persist the current value of dmd[section][key] (or its deletion if the key
+    #  no longer exists); call this after every change to an entry of dmd['corr'], dmd['outings']
+    #  or dmd['dups']
+    def journalDmd(self,section,key):
+        with self.dmdLock,self.metrics.timer('dmd.journal'):
+            if self.dmdStore.record(self.dmd,section,key):
+                self.writeDmdFile()
 
     # assignments={} # assignments dictionary
     # assignments_init={} # pre-filtered assignments dictionary (read from file on startup)
@@ -155,18 +889,18 @@ class sartopo_bg():
 
     def initDmd(self):
         logging.info('initDmd called')
-        if path.exists(self.dmdFileName):
-            with open(self.dmdFileName,'r') as dmdFile:
-                logging.info('reading correlation file')
-                dmd_init=json.load(dmdFile)
-                logging.info(json.dumps(dmd_init,indent=3))
+        self.sourceIds=set().union(*self.sts1.mapData['ids'].values())
+        self.targetIds=set().union(*self.sts2.mapData['ids'].values())
+        dmd_init=self.dmdStore.load() # snapshot plus journal replay
+        if dmd_init:
+            logging.debug('dmd read from file:\n%s',LazyJson(dmd_init))
 
             # build the real dmd dict, by only using the parts of dmd_init that still exist
             # (do not edit an object while iterating over it - that always gives bizarre results)
-            sids=sum(self.sts1.mapData['ids'].values(),[])
-            logging.info('list of all sts1 ids:'+str(sids))
-            tids=sum(self.sts2.mapData['ids'].values(),[])
-            logging.info('list of all sts2 ids:'+str(tids))
+            sids=self.sourceIds
+            logging.info('number of sts1 ids:'+str(len(sids)))
+            tids=self.targetIds
+            logging.info('number of sts2 ids:'+str(len(tids)))
         # # sidsToRemove=[]
         # # for sid in corr.keys():
         # #     logging.info('checking sid '+sid+':'+str(corr[sid]))
@@ -178,12 +912,21 @@ class sartopo_bg():
         # #     if corr[sid]==[]:
         # #         logging.info(' sid '+sid+' no longer has any correspondence; will be removed from correlation dictionary')
         # #         sidsToRemove.append(sid)
+            # correspondences are kept even if the source feature no longer exists, so that
+            #  reconcile can delete the target features of source features that were deleted
+            #  while this program was not running
             corr_init=dmd_init['corr']
             for sid in corr_init.keys():
-                if sid in sids:
-                    idListToAdd=[id for id in corr_init[sid] if id in tids]
-                    if idListToAdd!=[]:
-                        self.dmd['corr'][sid]=idListToAdd
+                idListToAdd=[id for id in corr_init[sid] if id in tids]
+                if idListToAdd!=[]:
+                    self.dmd['corr'][sid]=idListToAdd
+                if len(idListToAdd)!=len(corr_init[sid]):
+                    self.unverifiedSids.add(sid)
+            for (dsid,osid) in dmd_init.get('dups',{}).items():
+                if dsid in sids and osid in self.dmd['corr']:
+                    self.dmd['dups'][dsid]=osid
+                else:
+                    self.unverifiedSids.add(dsid)
             outings_init=dmd_init['outings']
             for ot in outings_init.keys():
                 # preserve the outing if the sid, tid, and fid all exist
@@ -194,12 +937,17 @@ class sartopo_bg():
                     self.dmd['outings'][ot]=o
                 else:
                     logging.info('initial outing discarded: '+ot)
+                    # the assignment and the outing's tracks need to be imported again
+                    self.unverifiedSids.add(o['sid'])
+                    otids=set(sum(o['tids'],[])+o['utids'])
+                    self.unverifiedSids|={sid for (sid,ctids) in corr_init.items() if otids.intersection(ctids)}
             # for sidToRemove in sidsToRemove:
             #     del corr[sidToRemove]
+        self.rebuildDmdIndex()
+        self.rebuildPrintIndex()
         # write the correspondence file
         self.writeDmdFile()
-        logging.info('dmd after filtering:')
-        logging.info(json.dumps(self.dmd,indent=3))
+        logging.debug('dmd after filtering:\n%s',LazyJson(self.dmd))
 
     # restart handling: read the assignments file (if any)
     # if path.exists(assignmentsFileName):
@@ -276,6 +1024,46 @@ class sartopo_bg():
     #         logging.info('Detected existing folder '+t+' with id '+fid)
     #         fids[t]=fid
 
+    # indexTargetIds - call this with the return value of every sts2 call that creates features
+    #  (a single id, or a list of ids from crop); a failed call returns False or None, which is ignored
+    def indexTargetIds(self,idOrList):
+        if not isinstance(idOrList,list):
+            idOrList=[idOrList]
+        for tid in idOrList:
+            if tid:
+                self.targetIds.add(tid)
+        return idOrList
+
+    # delTargetFeature - delete a target map feature and remove it from the target id index
+    def delTargetFeature(self,className,tid):
+        self.sts2.delObject(className,existingId=tid)
+        self.targetIds.discard(tid)
+        self.printIndex.remove(tid)
+
+    # rebuildDmdIndex - rebuild all of the reverse lookup dictionaries from scratch
+    def rebuildDmdIndex(self):
+        self.tidToSid={}
+        self.sidToOutings={}
+        self.tidToOuting={}
+        for sid,tids in self.dmd['corr'].items():
+            for tid in tids:
+                self.tidToSid[tid]=sid
+        for ot,o in self.dmd['outings'].items():
+            self.sidToOutings.setdefault(o['sid'],[]).append(ot)
+            for tidList in o['tids']:
+                for tid in tidList:
+                    self.tidToOuting[tid]=ot
+            for utid in o['utids']:
+                self.tidToOuting[utid]=ot
+
+    # rebuildPrintIndex - index the geometry of every target map feature that corresponds to a
+    #  source feature but is not part of an outing
+    def rebuildPrintIndex(self):
+        self.printIndex=GridIndex()
+        for f in self.sts2.mapData['state']['features']:
+            if f['id'] in self.tidToSid and f['id'] not in self.tidToOuting and f.get('geometry'):
+                self.printIndex.insert(f['id'],f['geometry'])
+
     # addCorrespondence - don't call this for assignments
     def addCorrespondence(self,sid,tidOrList):
         sf=self.sts1.getFeature(id=sid)
@@ -291,11 +1079,96 @@ class sartopo_bg():
             tidOrList=[tidOrList]
 
         # create or add the correspondence entry
-        for tid in tidOrList:
-            self.dmd['corr'].setdefault(sid,[]).append(tid)
-
-        # write the correspondence file
-        self.writeDmdFile()
+        with self.dmdLock:
+            for tid in tidOrList:
+                self.dmd['corr'].setdefault(sid,[]).append(tid)
+                self.tidToSid[tid]=sid
+
+            # journal the correspondence change
+            self.journalDmd('corr',sid)
+
+    # removeCorrespondence - remove the entire correspondence entry for the source map feature;
+    #  returns the list of target map ids that it contained
+    def removeCorrespondence(self,sid):
+        with self.dmdLock:
+            tids=self.dmd['corr'].pop(sid,[])
+            for tid in tids:
+                self.tidToSid.pop(tid,None)
+            self.journalDmd('corr',sid)
+            return tids
+
+    # addOutingTracks - add a list of (cropped) target map track ids to the outing
+    def addOutingTracks(self,ot,tidList):
+        with self.dmdLock:
+            self.dmd['outings'][ot]['tids'].append(tidList)
+            for tid in tidList:
+                self.tidToOuting[tid]=ot
+            self.journalDmd('outings',ot)
+
+    # addOutingUncroppedTrack - add an uncropped target map track id to the outing
+    def addOutingUncroppedTrack(self,ot,utid):
+        with self.dmdLock:
+            self.dmd['outings'][ot]['utids'].append(utid)
+            self.tidToOuting[utid]=ot
+            self.journalDmd('outings',ot)
+
+    # extendOutingTracks - add more target map track ids to the outing's existing list of
+    #  cropped lines that contains existingTid
+    def extendOutingTracks(self,ot,existingTid,newTids):
+        with self.dmdLock:
+            for tidList in self.dmd['outings'][ot]['tids']:
+                if existingTid in tidList:
+                    tidList.extend(newTids)
+                    break
+            else:
+                self.dmd['outings'][ot]['tids'].append(newTids)
+            for tid in newTids:
+                self.tidToOuting[tid]=ot
+            self.journalDmd('outings',ot)
+
+    # removeOutingTracks - remove the specified target map track ids from whichever outing(s) they
+    #  belong to; since crop results are stored as a list per source track, a tids entry is removed
+    #  if it contains any of the specified ids
+    def removeOutingTracks(self,tids):
+        with self.dmdLock:
+            tids=set(tids)
+            for ot in {self.tidToOuting[tid] for tid in tids if tid in self.tidToOuting}:
+                o=self.dmd['outings'].get(ot)
+                if o is None:
+                    continue
+                # don't modify list while iterating!
+                o['tids']=[tidList for tidList in o['tids'] if tids.isdisjoint(tidList)]
+                o['utids']=[utid for utid in o['utids'] if utid not in tids]
+                self.journalDmd('outings',ot)
+            for tid in tids:
+                self.tidToOuting.pop(tid,None)
+
+    # renameOuting - move the outing dict entry from oldTitle to newTitle
+    def renameOuting(self,oldTitle,newTitle):
+        with self.dmdLock:
+            o=self.dmd['outings'].pop(oldTitle)
+            self.dmd['outings'][newTitle]=o
+            otList=self.sidToOutings.get(o['sid'],[])
+            self.sidToOutings[o['sid']]=[newTitle if ot==oldTitle else ot for ot in otList]
+            for tidList in o['tids']:
+                for tid in tidList:
+                    self.tidToOuting[tid]=newTitle
+            for utid in o['utids']:
+                self.tidToOuting[utid]=newTitle
+            self.journalDmd('outings',newTitle)
+            self.journalDmd('outings',oldTitle)
+
+    # retitleOuting - change the title of the outing's target map folder and boundary, and move
+    #  the outing dict entry to the new title
+    def retitleOuting(self,oldTitle,newTitle):
+        o=self.dmd['outings'][oldTitle]
+        for tid in [o['bid'],o['fid']]:
+            tf=self.sts2.getFeature(id=tid)
+            if tf:
+                tp=tf['properties']
+                tp['title']=newTitle
+                self.sts2.editObject(id=tid,properties=tp)
+        self.renameOuting(oldTitle,newTitle)
 
     def getOutingSuffixIndex(self,t):
         n=self.outingSuffixDict.get(t,2)
@@ -328,17 +1201,14 @@ class sartopo_bg():
 
         logging.info('checking to see if this outing (title='+t+' id='+str(id)+') already exists...')
         alreadyExists=False
-        for ot in self.dmd['outings'].keys():
-            o=self.dmd['outings'][ot]
-            logging.info('  checking: outing title = '+ot+', sid='+o['sid']+', id='+id)
-            if o['sid']==id:
-                logging.info('  an outing with the same sid was found...')
-                if t==ot or 'NOTITLE' in ot:
-                    logging.info('    and the title is a match or contains NOTITLE')
-                    alreadyExists=True
-                    break
-                else:
-                    logging.info('    but the title is not a match, so it must be an old outing')
+        for ot in self.sidToOutings.get(id,[]):
+            logging.info('  an outing with the same sid was found: '+ot)
+            if t==ot or 'NOTITLE' in ot:
+                logging.info('    and the title is a match or contains NOTITLE')
+                alreadyExists=True
+                break
+            else:
+                logging.info('    but the title is not a match, so it must be an old outing')
         if alreadyExists:
             logging.info('yes, a correpsonding outing already exists on the target map; skipping')
             return False
@@ -350,26 +1220,52 @@ class sartopo_bg():
         #  append an incrementing suffix
         if t=='':
             t='NOTITLE'
-        if t in self.dmd['outings'].keys():
-            t=t+':'+str(self.getOutingSuffixIndex(t))
-            logging.info('   assignment entry with the same name already exists; setting this assignment title to '+t)
-
-        # createOuting(t,id)
-        self.dmd['outings'][t]={
-            'bid':None,
-            'fid':None,
-            'sid':id,
-            'cids':[],
-            'tids':[],
-            'utids':[]}
-        fid=self.sts2.addFolder(t)
-        # fids[t]=fid
-        self.dmd['outings'][t]['fid']=fid
-        # fid=dmd['outings'][t]['fid']
-        self.dmd['outings'][t]['sid']=id # assignment feature id in source map
+        # if a track of this outing was processed before its assignment, an outing with no
+        #  assignment was created for it (see addShape): the assignment adopts that outing, and its
+        #  uncropped tracks are cropped once the boundary is drawn, instead of adding a second
+        #  outing with a suffixed title
+        adopt=False
+        with self.dmdLock:
+            o=self.dmd['outings'].get(t,None)
+            if id and o is not None and o['sid'] is None and o['bid'] is None:
+                logging.info('   outing '+t+' was already created for its tracks; adopting it')
+                adopt=True
+                o['sid']=id
+                self.sidToOutings[None].remove(t)
+                self.sidToOutings.setdefault(id,[]).append(t)
+            else:
+                if o is not None:
+                    t=t+':'+str(self.getOutingSuffixIndex(t))
+                    logging.info('   assignment entry with the same name already exists; setting this assignment title to '+t)
+
+                # createOuting(t,id)
+                self.dmd['outings'][t]={
+                    'bid':None,
+                    'fid':None,
+                    'sid':id,
+                    'cids':[],
+                    'tids':[],
+                    'utids':[]}
+                self.sidToOutings.setdefault(id,[]).append(t)
+        if not adopt:
+            fid=self.sts2.addFolder(t)
+            if not fid:
+                # don't record an outing that has no folder; it will be attempted again next time
+                #  a feature for this outing is processed
+                logging.error('folder could not be created for outing '+t+'; outing not recorded')
+                with self.dmdLock:
+                    del self.dmd['outings'][t]
+                    self.sidToOutings[id].remove(t)
+                return False
+            self.indexTargetIds(fid)
+            # fids[t]=fid
+            self.dmd['outings'][t]['fid']=fid
+            # fid=dmd['outings'][t]['fid']
+            self.dmd['outings'][t]['sid']=id # assignment feature id in source map
         # logging.info('fids.keys='+str(fids.keys()))
 
         if id:
+            fid=self.dmd['outings'][t]['fid']
             g=ft['geometry']
             gc=g['coordinates']
             gt=g['type']
@@ -380,16 +1276,23 @@ class sartopo_bg():
                 bid=self.sts2.addLine(gc,title=t,folderId=fid,width=8,opacity=0.4)
             else:
                 logging.error('newly detected assignment '+t+' has an unhandled geometry type '+gt)
+                self.journalDmd('outings',t)
                 return
-            self.dmd['outings'][t]['bid']=bid
-            # addCorrespondence(id,bid)
-            logging.info('boundary created for assingment '+t+': '+self.dmd['outings'][t]['bid'])
+            if bid:
+                self.indexTargetIds(bid)
+                self.dmd['outings'][t]['bid']=bid
+                # addCorrespondence(id,bid)
+                logging.info('boundary created for assingment '+t+': '+self.dmd['outings'][t]['bid'])
+            else:
+                logging.error('boundary could not be created for outing '+t)
         # since addLine adds the new feature to .mapData immediately, no new 'since' request is needed
+        self.journalDmd('outings',t)
         if self.dmd['outings'][t]['utids']!=[]:
-            self.cropUncroppedTracks()
-        self.writeDmdFile()
+            self.cropUncroppedTracks(t)
 
-    def addShape(self,f):
+    # addShape - pieces: the track's crop result, if the reconcile plan already computed it (see
+    #  dmg_reconcile.planReconcile); it is only used if the track is cropped locally
+    def addShape(self,f,pieces=None):
         p=f['properties']
         g=f['geometry']
         gt=g['type']
@@ -408,37 +1311,60 @@ class sartopo_bg():
                         opacity=p['stroke-opacity'],
                         width=p['stroke-width'],
                         pattern=p['pattern'])
-                self.addCorrespondence(sid,lineID)
+                if lineID:
+                    self.indexTargetIds(lineID)
+                    self.addCorrespondence(sid,lineID)
+                    self.printIndex.insert(lineID,g)
             else: # it's a track; crop it now if needed, since newFeatureCallback is called once per feature, not once per sync interval
                 at=tparse[0]+' '+tparse[1] # 'AA 101' - should match a folder name
-                logging.info('entire assignments dict:')
-                logging.info(json.dumps(self.dmd['outings'],indent=3))
                 a=self.dmd['outings'].get(at,None)
                 if a==None: # assignment entry hasn't been created yet
                     logging.info('processing line \''+t+'\' which appears to belong to assignment \''+at+'\' which has not been processed yet.  Creating the assignment dictionary and adding this track to the uncropped tracks list.')
                     self.addOuting(at)
-                    a=self.dmd['outings'][at]
+                    a=self.dmd['outings'].get(at,None)
+                    if a==None: # the outing's folder could not be created (see addOuting)
+                        logging.error('  outing '+at+' could not be created; track '+t+' not imported; it will be attempted again on the next reconcile')
+                        return
                 # add the line in the assignment folder, and crop to the assignment shape
                 logging.info('creating line \''+t+'\' in folder \''+at+'\'')
-                logging.info('  assignment fid='+a['fid'])
+                logging.info('  assignment fid='+str(a['fid']))
                 bid=a['bid']
                 # color=trackColorList[(len(a['tids'])+len(a['utids']))%len(trackColorList)]
                 color=self.trackColorDict.get(tparse[2].lower(),'#444444')
-                uncroppedTrack=self.sts2.addLine(gc,title=tparse[0].upper()+tparse[1]+tparse[2].lower(),color=color,folderId=a['fid'])
-                logging.info(' generated uncropped track '+uncroppedTrack)
+                trackTitle=tparse[0].upper()+tparse[1]+tparse[2].lower()
+                osid=self.findDuplicateTrack(sid,at,gc)
+                if osid:
+                    logging.info('  track '+t+' duplicates track '+self.sts1.getFeature(id=osid)['properties']['title']+
+                        ' which is already imported in outing '+at+'; not importing it')
+                    self.linkDuplicateTrack(sid,osid)
+                    return
+                tc=self.simplifyTrack(gc,trackTitle)
+                cropLocally=bid is not None and self.cropsLocally(bid)
+                if not cropLocally:
+                    uncroppedTrack=self.sts2.addLine(tc,title=trackTitle,color=color,folderId=a['fid'])
+                    if not uncroppedTrack:
+                        logging.error(' uncropped track could not be created')
+                        return
+                    self.indexTargetIds(uncroppedTrack)
+                    logging.info(' generated uncropped track '+uncroppedTrack)
                 if bid==None:
                     logging.info('   assignment boundary has not been processed yet; saving the uncropped track in utids')
-                    self.dmd['outings'][at]['utids'].append(uncroppedTrack)
+                    self.addOutingUncroppedTrack(at,uncroppedTrack)
                     self.addCorrespondence(sid,uncroppedTrack)
                     # logging.info('  utids:'+str(assignments[at]['utids']))
                 else:
                     logging.info('  assignment bid='+bid)
-                    croppedTrackList=self.sts2.crop(uncroppedTrack,a['bid'],beyond=0.001) # about 100 meters
-                    self.dmd['outings'][at]['tids'].append(croppedTrackList)
-                    self.addCorrespondence(sid,croppedTrackList)
+                    if cropLocally:
+                        croppedTrackList=self.addCroppedTrack(tc,bid,title=trackTitle,color=color,folderId=a['fid'],pieces=pieces)
+                    else:
+                        croppedTrackList=self.sts2.crop(uncroppedTrack,bid,beyond=self.cropBeyond)
+                        self.indexTargetIds(croppedTrackList)
+                    if croppedTrackList: # crop returns False or [] if no part of the track is inside the boundary
+                        self.addOutingTracks(at,croppedTrackList)
+                        self.addCorrespondence(sid,croppedTrackList)
+                    self.setTrackCropState(sid,at,gc,bid)
                     # sts2.doSync(once=True)
                     # sts2.crop(track,a['bid'],beyond=0.001) # about 100 meters
-                self.writeDmdFile()
         elif gt=='Polygon':
             logging.info('creating polygon \''+t+'\' in default folder')
             polygonID=self.sts2.addPolygon(gc[0],
@@ -448,8 +1374,10 @@ class sartopo_bg():
                 strokeOpacity=p['stroke-opacity'],
                 fillOpacity=p['fill-opacity'],
                 description=p['description'])
-            self.addCorrespondence(sid,polygonID)
-        logging.info('dmd:\n'+str(json.dumps(self.dmd,indent=3)))
+            if polygonID:
+                self.indexTargetIds(polygonID)
+                self.addCorrespondence(sid,polygonID)
+                self.printIndex.insert(polygonID,g)
 
     def addMarker(self,f):
         p=f['properties']
@@ -467,8 +1395,10 @@ class sartopo_bg():
                         size=p.get('marker-size',1),
                         description=p['description'],
                         symbol=p['marker-symbol'])
-        logging.info('sts2.mapData after addMarker:'+json.dumps(self.sts2.mapData,indent=3))
-        self.addCorrespondence(f['id'],markerID)
+        if markerID:
+            self.indexTargetIds(markerID)
+            self.addCorrespondence(f['id'],markerID)
+            self.printIndex.insert(markerID,g)
 
     def addClue(self,f):
         p=f['properties']
@@ -481,41 +1411,295 @@ class sartopo_bg():
         gc=g['coordinates']
         logging.info('creating clue \''+t+'\' in default folder')
         clueID=self.sts2.addMarker(gc[1],gc[0],title=t,symbol='clue',description=p['description'])
-        self.addCorrespondence(f['id'],clueID)
-
-    def cropUncroppedTracks(self):
+        if clueID:
+            self.indexTargetIds(clueID)
+            self.addCorrespondence(f['id'],clueID)
+            self.printIndex.insert(clueID,g)
+
+    # cropUncroppedTracks - crop the uncropped tracks of the specified outing; this is called when
+    #  the outing's boundary is drawn, so only that outing needs to be checked
+    def cropUncroppedTracks(self,a):
         # logging.info('inside cropUncroppedTracks:')
-        for a in self.dmd['outings']:
-            if len(self.dmd['outings'][a]['utids'])>0:
-                bid=self.dmd['outings'][a]['bid']
-                if bid is not None:
-                    logging.info('  Assignment '+a+': cropping '+str(len(self.dmd['outings'][a]['utids']))+' uncropped tracks:'+str(self.dmd['outings'][a]['utids']))
-                    for utid in self.dmd['outings'][a]['utids']:
-                        # since newly created features are immediately added to the local cache,
-                        #  the boundary feature should be available by this time
-                        croppedTrackLines=self.sts2.crop(utid,bid,beyond=0.001) # about 100 meters
-                        logging.info('crop return value:'+str(croppedTrackLines))
-                        self.dmd['outings'][a]['tids'].append(croppedTrackLines)
-                        # cropped track line(s) should correspond to the source map line, 
-                        #  not the source map assignment; source map line id will be
-                        #  the corr key whose val is the utid; also remove the utid
-                        #  from that corr val list
-                        # logging.info('    corr items:'+str(corr.items()))
-                        slidList=[list(i)[0] for i in self.dmd.items() if list(i)[1]==[utid]]
-                        if len(slidList)==1:
-                            slid=slidList[0]
-                            logging.info('    corresponding source line id:'+str(slid))
-                            self.dmd[slid]=[]
-                            self.addCorrespondence(slid,croppedTrackLines)
-                        else:
-                            logging.error('    corresponding source map line id could not be determined')
-                            logging.error('    corresponding source line id list:'+str(slidList))
-                        # assignments[a]['utids'].remove(utid)
-                    self.dmd['outings'][a]['utids']=[] # don't modify the list during iteration over the list!
-                    self.writeDmdFile()
-                else:
-                    logging.info('  Assignment '+a+' has '+str(len(self.dmd['outings'][a]['utids']))+' uncropped tracks, but the boundary has not been imported yet; skipping.')
+        if len(self.dmd['outings'][a]['utids'])>0:
+            bid=self.dmd['outings'][a]['bid']
+            if bid is not None:
+                logging.info('  Assignment '+a+': cropping '+str(len(self.dmd['outings'][a]['utids']))+' uncropped tracks:'+str(self.dmd['outings'][a]['utids']))
+                for utid in self.dmd['outings'][a]['utids']:
+                    # since newly created features are immediately added to the local cache,
+                    #  the boundary feature should be available by this time
+                    if self.cropsLocally(bid):
+                        croppedTrackLines=self.cropExistingTrack(utid,bid)
+                    else:
+                        croppedTrackLines=self.sts2.crop(utid,bid,beyond=self.cropBeyond)
+                        self.indexTargetIds(croppedTrackLines)
+                    logging.info('crop return value:'+str(croppedTrackLines))
+                    if not croppedTrackLines:
+                        croppedTrackLines=[]
+                    self.addOutingTracks(a,croppedTrackLines)
+                    # cropped track line(s) should correspond to the source map line, 
+                    #  not the source map assignment; source map line id will be
+                    #  the corr key whose val is the utid; also remove the utid
+                    #  from that corr val list
+                    slid=self.tidToSid.get(utid,None)
+                    if slid is not None:
+                        logging.info('    corresponding source line id:'+str(slid))
+                        self.removeCorrespondence(slid)
+                        self.addCorrespondence(slid,croppedTrackLines)
+                        sf=self.sts1.getFeature(id=slid)
+                        if sf:
+                            self.setTrackCropState(slid,a,sf['geometry']['coordinates'],bid)
+                    else:
+                        logging.error('    corresponding source map line id could not be determined')
+                    # assignments[a]['utids'].remove(utid)
+                self.dmd['outings'][a]['utids']=[] # don't modify the list during iteration over the list!
+                self.journalDmd('outings',a)
+            else:
+                logging.info('  Assignment '+a+' has '+str(len(self.dmd['outings'][a]['utids']))+' uncropped tracks, but the boundary has not been imported yet; skipping.')
+
+
+    # setTrackCropState - remember that the entire source track has been cropped and imported
+    def setTrackCropState(self,sid,at,coords,bid):
+        self.trackCropState[sid]={
+            'at':at,
+            'bid':bid,
+            'n':len(coords),
+            'hash':coordsHash(coords),
+            'open':self.cropsLocally(bid) and self.getCropBoundary(bid).containsPoint(coords[-1])}
+
+    # restoreTrackCropStates - after reconcile, set the crop state of every cropped track that
+    #  reconcile kept (trackCropState is not persisted, and is otherwise only set when a track is
+    #  imported), so that the first time such a track grows after a restart, only the new part
+    #  is cropped and imported; skipSids - source ids whose reconcile operations failed
+    def restoreTrackCropStates(self,skipSids=()):
+        with self.dmdLock:
+            for (sid,tids) in self.dmd['corr'].items():
+                if sid in self.trackCropState or sid in skipSids or not tids:
+                    continue
+                f=self.sts1.getFeature(id=sid)
+                if not f or not isTrack(f):
+                    continue
+                tparse=self.parseTrackName(f['properties']['title'])
+                at=tparse[0]+' '+tparse[1]
+                o=self.dmd['outings'].get(at,None)
+                if o is None or o['bid'] is None or not set(tids)<=set(sum(o['tids'],[])):
+                    continue # not (yet) cropped
+                self.setTrackCropState(sid,at,f['geometry']['coordinates'],o['bid'])
+
+    # extendCroppedTrack - handle a track geometry update incrementally, if the only change is that
+    #  vertices were appended (as happens every few seconds for a live AppTrack): crop only the new
+    #  part of the track, then extend the last cropped line and/or add new cropped lines (if
+    #  tracks are simplified, see editSimplifiedTrack instead); returns False if the update can't be handled incrementally, in which case the track
+    #  should be re-imported from scratch
+    def extendCroppedTrack(self,f):
+        sid=f['id']
+        gc=f['geometry']['coordinates']
+        state=self.trackCropState.get(sid,None)
+        if state is None or not self.cropsLocally(state['bid']):
+            return False
+        tparse=self.parseTrackName(f['properties']['title'])
+        at=tparse[0]+' '+tparse[1]
+        o=self.dmd['outings'].get(at,None)
+        n=state['n']
+        if at!=state['at'] or o is None or o['bid']!=state['bid'] or len(gc)<=n:
+            return False
+        if coordsHash(gc[:n])!=state['hash']:
+            logging.info('  existing track vertices were changed; incremental crop is not possible')
+            return False
+        tids=self.dmd['corr'].get(sid,[])
+        if self.simplifyTolerance:
+            pieces=self.editSimplifiedTrack(f,tids,state['bid'])
+            if pieces is None:
+                return False
+        else:
+            # crop from the last previously processed vertex, so that the segment joining the old
+            #  and new parts of the track is included
+            with self.metrics.timer('crop.local'):
+                pieces=cropLine(gc[n-1:],self.getCropBoundary(state['bid']))
+            if pieces and state['open'] and tids:
+                # the first piece starts with the last vertex of the last cropped line
+                lastTid=tids[-1]
+                lastCoords=self.sts2.getFeature(id=lastTid)['geometry']['coordinates']
+                logging.info('  extending cropped track '+lastTid+' by '+str(len(pieces[0])-1)+' vertices')
+                self.sts2.editObject(id=lastTid,geometry={'type':'LineString','coordinates':lastCoords+pieces[0][1:]})
+                pieces=pieces[1:]
+        newTids=[]
+        for piece in pieces:
+            newTids.append(self.sts2.addLine(piece,
+                    title=tparse[0].upper()+tparse[1]+tparse[2].lower(),
+                    color=self.trackColorDict.get(tparse[2].lower(),'#444444'),
+                    folderId=o['fid']))
+        newTids=[tid for tid in self.indexTargetIds(newTids) if tid]
+        if newTids:
+            logging.info('  adding '+str(len(newTids))+' new cropped track line(s)')
+            if tids:
+                self.extendOutingTracks(at,tids[-1],newTids)
+            else:
+                self.addOutingTracks(at,newTids)
+            self.addCorrespondence(sid,newTids)
+        self.setTrackCropState(sid,at,gc,state['bid'])
+        return True
+
+    # editSimplifiedTrack - extendCroppedTrack for simplified tracks: simplification is not
+    #  additive (appending vertices can change which of the earlier vertices are kept), so the
+    #  whole track is simplified and cropped again, the same way as by addShape and reconcile,
+    #  and only the cropped lines whose geometry changed are edited; returns the pieces that
+    #  need new lines, or None if the existing lines can't be reused
+    def editSimplifiedTrack(self,f,tids,bid):
+        coords=self.simplifyTrack(f['geometry']['coordinates'],f['properties']['title'])
+        with self.metrics.timer('crop.local'):
+            pieces=cropLine(coords,self.getCropBoundary(bid))
+        tfs=[self.sts2.getFeature(id=tid) for tid in tids]
+        if len(pieces)<len(tids) or not all(tfs):
+            return None
+        for (tid,tf,piece) in zip(tids,tfs,pieces):
+            if roundCoords(tf['geometry']['coordinates'])!=roundCoords(piece):
+                logging.info('  updating simplified cropped track '+tid+': '+str(len(piece))+' vertices')
+                self.sts2.editObject(id=tid,geometry={'type':'LineString','coordinates':piece})
+        return pieces[len(tids):]
+
+    # findDuplicateTrack - source id of an already imported track of outing at that the new track
+    #  duplicates (see dmg_geometry.TrackFingerprint), or None; this is checked before anything
+    #  is written to the target map, so a duplicate costs no uploads or crops
+    def findDuplicateTrack(self,sid,at,coords):
+        o=self.dmd['outings'].get(at,None)
+        if self.duplicateTracks not in ['exact','near'] or o is None:
+            return None
+        osids={self.tidToSid[tid] for tid in sum(o['tids'],[])+o['utids'] if tid in self.tidToSid}
+        osids.discard(sid)
+        if not osids:
+            return None
+        fp=TrackFingerprint(coords)
+        for osid in sorted(osids):
+            ofp=self.getTrackFingerprint(osid)
+            if ofp and fp.matches(ofp,self.duplicateTracks=='near'):
+                return osid
+        return None
+
+    def getTrackFingerprint(self,sid):
+        fp=self.trackFingerprints.get(sid,None)
+        if fp is None:
+            f=self.sts1.getFeature(id=sid)
+            if not f or not f.get('geometry',None):
+                return None
+            fp=TrackFingerprint(f['geometry']['coordinates'])
+            self.trackFingerprints[sid]=fp
+        return fp
+
+    def linkDuplicateTrack(self,sid,osid):
+        with self.dmdLock:
+            self.dmd['dups'][sid]=osid
+            self.journalDmd('dups',sid)
+
+    def unlinkDuplicateTrack(self,sid):
+        with self.dmdLock:
+            if self.dmd['dups'].pop(sid,None):
+                self.journalDmd('dups',sid)
+
+    # recheckDuplicatesOf - after the original track was deleted or changed, import its former
+    #  duplicates again (the first one to be imported becomes the original for the rest)
+    def recheckDuplicatesOf(self,osid):
+        with self.dmdLock:
+            dsids=sorted(dsid for (dsid,o) in self.dmd['dups'].items() if o==osid)
+        for dsid in dsids:
+            f=self.sts1.getFeature(id=dsid)
+            self.unlinkDuplicateTrack(dsid)
+            if f:
+                logging.info('  checking duplicate track '+f['properties']['title']+' again')
+                self.newFeatureCallback(f)
+
+    # simplifyTrack - simplified and quantized copy of the track coordinates, or the coordinates
+    #  themselves if simplification is off
+    def simplifyTrack(self,coords,title):
+        if not self.simplifyTolerance:
+            return coords
+        with self.metrics.timer('simplify'):
+            sc=simplifyLine(coords,self.simplifyTolerance,self.quantizeDigits)
+        logging.info('  simplified track '+title+' to '+('%.1f'%self.simplifyTolerance)+'m: '+str(len(coords))+' --> '+
+            str(len(sc))+' vertices (compression ratio '+('%.1f'%(len(coords)/len(sc)))+')')
+        with self.statsLock:
+            self.simplifyCounts['tracks']+=1
+            self.simplifyCounts['verticesIn']+=len(coords)
+            self.simplifyCounts['verticesOut']+=len(sc)
+        return sc
+
+    # getCropBoundary - oversized boundary for local cropping; cached per boundary id, since
+    #  every track in the outing is cropped to the same boundary
+    def getCropBoundary(self,bid):
+        cb=self.cropBoundaries.get(bid,None)
+        if cb is None:
+            cb=cropBoundaryFor(self.sts2.getFeature(id=bid)['geometry'],self.cropBeyond,
+                self.roamingDistance if self.isRoamingBoundary(bid) else None)
+            self.cropBoundaries[bid]=cb
+        return cb
+
+    # isRoamingBoundary - True if tracks are cropped by distance from this boundary, i.e. if the
+    #  source assignment of its outing is roaming
+    def isRoamingBoundary(self,bid):
+        roaming=self.roamingBoundaries.get(bid,None)
+        if roaming is None:
+            roaming=False
+            if self.roamingDistance:
+                o=next((o for o in self.dmd['outings'].values() if o['bid']==bid),None)
+                sf=o and self.sts1.getFeature(id=o['sid'])
+                roaming=bool(sf) and isRoaming(sf)
+            self.roamingBoundaries[bid]=roaming
+        return roaming
+
+    def cropsLocally(self,bid):
+        return self.localCrop or self.isRoamingBoundary(bid)
+
+    # forgetCropBoundary - call after the boundary geometry or the outing's crop mode changes
+    def forgetCropBoundary(self,bid):
+        self.cropBoundaries.pop(bid,None)
+        self.roamingBoundaries.pop(bid,None)
+
+    # recropOutingTracks - remove and re-import every track of the outing, e.g. after its crop
+    #  mode changed
+    def recropOutingTracks(self,ot):
+        o=self.dmd['outings'][ot]
+        sids={self.tidToSid[tid] for tids in o['tids'] for tid in tids if tid in self.tidToSid}
+        for sid in sorted(sids):
+            f=self.sts1.getFeature(id=sid)
+            if not f:
+                continue
+            logging.info('  re-cropping track '+f['properties']['title'])
+            self.trackCropState.pop(sid,None)
+            corrList=self.dmd['corr'].get(sid,[])
+            for ttid in corrList:
+                self.delTargetFeature('Shape',ttid)
+            self.removeOutingTracks(corrList)
+            self.removeCorrespondence(sid)
+            self.newFeatureCallback(f)
 
+    # addCroppedTrack - crop the track coordinates locally, and add only the resulting line(s) to
+    #  the target map; returns the list of new line ids (empty if no part of the track is inside
+    #  the boundary); pieces, if specified, is the already computed result of cropping the coordinates
+    def addCroppedTrack(self,coords,bid,title,color,folderId,pieces=None):
+        if pieces is None:
+            with self.metrics.timer('crop.local'):
+                pieces=cropLine(coords,self.getCropBoundary(bid))
+        croppedTrackList=[]
+        for piece in pieces:
+            croppedTrackList.append(self.sts2.addLine(piece,title=title,color=color,folderId=folderId))
+        return [tid for tid in self.indexTargetIds(croppedTrackList) if tid]
+
+    # cropExistingTrack - local equivalent of sts2.crop for a track that is already on the target
+    #  map: the existing line is edited to become the first cropped piece, and any other pieces are
+    #  added as new lines, so the return value is the same as that of sts2.crop; if no part of the
+    #  track is inside the boundary, the line is deleted and an empty list is returned
+    def cropExistingTrack(self,tid,bid):
+        tf=self.sts2.getFeature(id=tid)
+        tp=tf['properties']
+        with self.metrics.timer('crop.local'):
+            pieces=cropLine(tf['geometry']['coordinates'],self.getCropBoundary(bid))
+        if not pieces:
+            self.delTargetFeature('Shape',tid)
+            return []
+        self.sts2.editObject(id=tid,geometry={'type':'LineString','coordinates':pieces[0]})
+        croppedTrackList=[tid]
+        for piece in pieces[1:]:
+            croppedTrackList.append(self.sts2.addLine(piece,title=tp['title'],color=tp.get('stroke',None),folderId=tp.get('folderId',None)))
+        return [tid for tid in self.indexTargetIds(croppedTrackList) if tid]
 
     # initialNewFeatureCallback: since dmd must be generated before the add<Type> functions
     #  are called (since those functions check to see if the feature already exists on the
@@ -531,24 +1715,28 @@ class sartopo_bg():
     #   can be deleted, and the newly imported feature can be used instead
     #  folder: target title is identical to source title
     #  marker: 
-    def newFeatureCallback(self,f):
+    def newFeatureCallback(self,f,pieces=None):
         p=f['properties']
         c=p['class']
         t=p.get('title','')
         sid=f['id']
 
         logging.info('newFeatureCallback: class='+c+'  title='+t+'  id='+sid)
+        self.sourceIds.add(sid)
+        self.recordFingerprint(f)
+        # a duplicate track is checked again, in case it or its original changed
+        self.unlinkDuplicateTrack(sid)
 
-        # source id might have a corresponding target id; if all corresponding target ids still exist, skip    
-        tids=sum(self.sts2.mapData['ids'].values(),[])    
-        if sid in self.dmd.keys():
+        # source id might have a corresponding target id; if all corresponding target ids still exist, skip
+        if sid in self.dmd['corr']:
             logging.info(' source feature exists in correspondence dictionary')
-            if all(i in tids for i in self.dmd[sid]):
+            if all(i in self.targetIds for i in self.dmd['corr'][sid]):
                 logging.info('  all corresponding features exist in the target map; skipping')
                 # crop uncropped tracks even if the assignment already exists in the target;
                 #  this will crop any tracks that were imported anew on restart
                 if c=='Assignment':
-                    self.cropUncroppedTracks()
+                    for ot in self.sidToOutings.get(sid,[]):
+                        self.cropUncroppedTracks(ot)
                 return
             else:
                 logging.info('  but target map does not contain all of the specified features; adding the feature to the target map')
@@ -599,7 +1787,7 @@ class sartopo_bg():
     #     #   a. create a new polygon with the same geometry in the default folder
 
         if c=='Shape':
-            self.addShape(f)
+            self.addShape(f,pieces)
             # g=f['geometry']
             # gc=g['coordinates']
             # gt=g['type']
@@ -677,47 +1865,53 @@ class sartopo_bg():
         st=sp['title']
         sgt=sg['type']
         logging.info('propertyUpdateCallback called for '+sc+':'+st)
+        # skip updates that only changed properties which are never copied to the target map
+        fingerprint=propertyFingerprint(f,self.trackColorDict)
+        oldFingerprint=self.propertyFingerprints.get(sid,None)
+        if fingerprint==oldFingerprint:
+            logging.info('  none of the changed properties affect the target map; nothing edited')
+            return
+        self.propertyFingerprints[sid]=fingerprint
+        if sid in self.dmd['dups']:
+            logging.info('  edited feature is a duplicate track; checking it again')
+            self.newFeatureCallback(f)
+            return
         # determine which target-map feature, if any, corresponds to the edited source-map feature
-        if sid in self.dmd.keys(): # this means there's a match but it's not an outing
-            corrList=self.dmd[sid]
-            if sc=='Shape' and sgt=='LineString':
+        if sid in self.dmd['corr']: # this means there's a match but it's not an outing
+            corrList=self.dmd['corr'][sid]
+            if sc=='Shape' and sgt=='LineString' and oldFingerprint and oldFingerprint[1] and fingerprint[1] \
+                    and oldFingerprint[1][0:2]==fingerprint[1][0:2] and all(tid in self.targetIds for tid in corrList):
+                # still a track in the same outing (only the suffix changed): the cropped lines
+                #  don't change, so just edit their title and color
+                logging.info('  track is still in the same outing; editing title and color of '+str(len(corrList))+' target map line(s)')
+                for ttid in corrList:
+                    tp=self.sts2.getFeature(id=ttid)['properties']
+                    tp.update(projectedProperties(f,self.trackColorDict))
+                    self.sts2.editObject(id=ttid,properties=tp)
+            elif sc=='Shape' and sgt=='LineString':
                 for ttid in corrList:
-                    self.sts2.delObject('Shape',ttid)
+                    self.delTargetFeature('Shape',ttid)
                 # also delete from the assignments dict and correspondence dict, so that it will be added anew;
                 # we can't be sure here what assignment if any the line was previously a part of,
-                #  so scan all assignments for id(s)
-                # tparse=parseTrackName(st)
-                # if tparse:
-                for at in self.dmd['outings']:
-                    # at=tparse[0]+' '+tparse[1]
-                    # don't modify list while iterating!
-                    newTidList=[]
-                    for tidList in self.dmd['outings'][at]['tids']:
-                        if not all(elem in tidList for elem in corrList):
-                            newTidList.append(tidList)
-                    self.dmd['outings'][at]['tids']=newTidList
-                del self.dmd[sid]
+                #  so look up the outing(s) from the target ids
+                self.trackCropState.pop(sid,None)
+                self.removeOutingTracks(corrList)
+                self.removeCorrespondence(sid)
                 self.newFeatureCallback(f) # this will crop the track automatically
+                self.recheckDuplicatesOf(sid)
             elif len(corrList)==1: # exactly one correlating feature exists
                 logging.info('  exactly one target map feature corresponds to the source map feature; updating the target map feature properties')
                 tf=self.sts2.getFeature(id=corrList[0])
                 tp=tf['properties']
                 # map properties from source to target, based on source class; start with the existing target
                 #  map feature properties, and only copy the appropriate properties from the source feature
-                c=sp['class']
-                if c=='Clue':
-                    logging.info('  mapping properties from Clue to Marker')
-                    tp['title']=sp['title']
-                    tp['description']=sp['description']
-                elif c=='Assignment': # this may be dead code - if assignment, it should have two corr entries
-                    tp['title']=sp['title']
-                else:
-                    tp=sp # for other feature types, copy all properties from source
+                #  (see dmg_reconcile.projectedProperties)
+                tp.update(projectedProperties(f,self.trackColorDict))
                 self.sts2.editObject(id=corrList[0],properties=tp)
             else:
                 logging.error('  property change: more than one target map feature correspond to the source map feature, which is not a line; no changes made to target map')
         elif sp['class']=='Assignment': # assignment with folder and boundary already created
-            olist=[o for o in self.dmd['outings'] if self.dmd['outings'][o]['sid']==sid]
+            olist=self.sidToOutings.get(sid,[])
             if len(olist)==0:
                 logging.error('  source map assignment feature edited, but it has no corresponding target map feature')
                 return
@@ -742,7 +1936,6 @@ class sartopo_bg():
                 oldTitleHasNumber=any(char.isdigit() for char in oldTitle)
                 newTitleHasNumber=any(char.isdigit() for char in st)
                 logging.info('assignment name change: "'+oldTitle+'" --> "'+st+'"')
-                logging.info(json.dumps(self.dmd['outings'],indent=3))
 
                 # case 1:
                 if (oldTitle=='' or 'NOTITLE' in oldTitle) or (not oldTitleHasNumber and newTitleHasNumber):
@@ -751,16 +1944,7 @@ class sartopo_bg():
                 #         newFeatureCallback(f)
                 #     else: # case 1
                     logging.info('  existing target map assignment title will be updated...')
-                    o=self.dmd['outings'][oldTitle]
-                    for tid in [o['bid'],o['fid']]:
-                        tf=self.sts2.getFeature(id=tid)
-                        tp=tf['properties']
-                        tp['title']=sp['title'].upper()
-                        self.sts2.editObject(id=tid,properties=tp)
-                    self.dmd['outings'][tp['title']]=self.dmd['outings'][oldTitle]
-                    # fids[tp['title']]=fids[oldTitle]
-                    del self.dmd['outings'][oldTitle]
-                    # del fids[oldTitle]
+                    self.retitleOuting(oldTitle,sp['title'].upper())
 
                 # case 2:
                 elif (oldTitleHasNumber and newTitleHasNumber):
@@ -771,9 +1955,18 @@ class sartopo_bg():
                 else:
                     logging.info('  no change needed to existing target map assignments')
 
+                # crop mode change (roaming resource type or tag added or removed): re-crop the
+                #  tracks of the current outing
+                if oldFingerprint and dict(oldFingerprint[2]).get('roaming')!=dict(fingerprint[2]).get('roaming'):
+                    for ot in self.sidToOutings.get(sid,[]):
+                        o=self.dmd['outings'][ot]
+                        if ot==st.upper() and o['bid'] is not None:
+                            logging.info('  crop mode of outing '+ot+' changed to '+('distance from assignment' if isRoaming(f) else 'boundary'))
+                            self.forgetCropBoundary(o['bid'])
+                            self.recropOutingTracks(ot)
+
                 # logging.info('new assignments dict:')
                 # logging.info(json.dumps(dmd['outings'],indent=3))
-                self.writeDmdFile()
             else:
                 logging.info('  more than one existing target map outing corresponds to the source map assignment; nothing edited due to ambuguity')
         else:
@@ -781,19 +1974,13 @@ class sartopo_bg():
 
     # parseTrackName: return False if not a track, or [assignment,team,suffix] if a track
     def parseTrackName(self,t):
-        tparse=re.split('(\d+)',t.upper().replace(' ',''))
-        if len(tparse)==3:
-            return tparse
-        else:
-            return False
+        return parseTrackName(t)
 
     def geometryUpdateCallback(self,f):
         sid=f['id']
         sp=f['properties']
         st=sp['title']
         sg=f['geometry']
-        osids=[self.dmd['outings'][x]['sid'] for x in self.dmd['outings'].keys()] # list of sid of all outings
-        logging.info('osids:'+str(osids))
         # if the edited source feature is a track (a linestring with appropriate name format),
         #  delete all corresponding target map features (the crop operation could have resulted in
         #  multiple lines) then re-import the feature from scratch, which will also re-crop it;
@@ -805,36 +1992,43 @@ class sartopo_bg():
         #     but not the previous ones)
 
         logging.info('geometryUpdateCallback called for '+sp['class']+':'+sp['title'])
-        if sid in self.dmd.keys():
+        self.trackFingerprints.pop(sid,None)
+        if sid in self.dmd['dups']:
+            logging.info('  edited feature is a duplicate track; checking it again')
+            self.newFeatureCallback(f)
+        elif sid in self.dmd['corr'] or sid in self.trackCropState:
             tparse=self.parseTrackName(sp['title'])
             if sg['type']=='LineString' and sp['class']=='Shape' and tparse:
+                if self.extendCroppedTrack(f):
+                    logging.info('  edited feature '+sp['title']+' is a track with new vertices appended; only the new part of the track was cropped and imported')
+                    self.recheckDuplicatesOf(sid)
+                    return
                 logging.info('  edited feature '+sp['title']+' appears to be a track; correspoding previous imported and cropped tracks will be deleted, and the new track will be re-imported (and re-cropped)')
-                corrList=self.dmd[sid]
-                for ttid in self.dmd[sid]:
-                    self.sts2.delObject('Shape',ttid)
+                self.trackCropState.pop(sid,None)
+                corrList=self.dmd['corr'].get(sid,[])
+                for ttid in corrList:
+                    self.delTargetFeature('Shape',ttid)
                 # also delete from the assignments dict and correspondence dict, so that it will be added anew
-                at=tparse[0]+' '+tparse[1]
-                # don't modify list while iterating!
-                newTidList=[]
-                for tidList in self.dmd['outings'][at]['tids']:
-                    if not all(elem in tidList for elem in corrList):
-                        newTidList.append(tidList)
-                self.dmd['outings'][at]['tids']=newTidList
-                del self.dmd[sid]
+                self.removeOutingTracks(corrList)
+                self.removeCorrespondence(sid)
                 self.newFeatureCallback(f) # this will crop the track automatically
+                self.recheckDuplicatesOf(sid)
             else:
-                for tid in self.dmd[sid]:
+                for tid in self.dmd['corr'].get(sid,[]):
                     if 'geometry' in self.sts2.getFeature(id=tid).keys():
                         logging.info('  corresponding target map feature '+tid+' has geometry; setting it equal to the edited source feature geometry')
                         self.sts2.editObject(id=tid,geometry=sg)
+                        if tid in self.printIndex:
+                            self.printIndex.insert(tid,sg)
                     else:
                         logging.info('  corresponding target map feature '+tid+' has no geometry; no edit performed')
-        elif sid in osids:
-            for ot in self.dmd['outings'].keys():
+        elif sid in self.sidToOutings:
+            for ot in self.sidToOutings[sid]:
                 o=self.dmd['outings'][ot]
-                if o['sid']==sid and ot==st: # the title is current
+                if ot==st: # the title is current
                     logging.info('  assignment geometry was edited: applying the same edit to corresponding target map boundary that has the same title "'+st+'" as the edited feature (to preserve previous outing boundaries)')
                     self.sts2.editObject(id=o['bid'],geometry=sg)
+                    self.forgetCropBoundary(o['bid'])
         # # 1. determine which target-map feature, if any, corresponds to the edited source-map feature
         # if sid in corr.keys():
         #     cval=corr[sid]
@@ -856,19 +2050,24 @@ class sartopo_bg():
 
     def deletedFeatureCallback(self,f):
         sid=f['id']
+        self.sourceIds.discard(sid)
+        self.trackCropState.pop(sid,None)
+        self.propertyFingerprints.pop(sid,None)
+        self.trackFingerprints.pop(sid,None)
+        self.unlinkDuplicateTrack(sid)
         logging.info('deletedFeatureCallback called for feature '+str(sid)+' :')
-        logging.info(json.dumps(f,indent=3))
+        logging.debug('%s',LazyJson(f))
         # 1. determine which target-map feature, if any, corresponds to the edited source-map feature
         # logging.info('corr keys:')
         # logging.info(str(dmd['corr'].keys()))
-        logging.info('dmd:\n'+str(json.dumps(self.dmd,indent=3)))
         if sid in self.dmd['corr'].keys():
             cval=self.dmd['corr'][sid]
             for tid in cval:
                 logging.info('deleting corresponding target map feature '+tid)
-                self.sts2.delObject(f['properties']['class'],existingId=tid)
-            del self.dmd['corr'][sid] # not currently iterating, so, del should be fine
-            self.writeDmdFile()
+                self.delTargetFeature(f['properties']['class'],tid)
+            self.removeOutingTracks(cval)
+            self.removeCorrespondence(sid)
+            self.recheckDuplicatesOf(sid)
         else:
             logging.info('source map feature does not have any corresponding feature in target map; nothing deleted')
 
@@ -910,5 +2109,55 @@ class sartopo_bg():
     # initial processing complete; now register the callback
     # sts1.newFeatureCallback=newFeatureCallback
 
+def main():
+    parser=argparse.ArgumentParser(description='Debrief Map Generator: keep a debrief map up to date with an incident map')
+    parser.add_argument('sourceMapID',help='incident map ID')
+    parser.add_argument('targetMapID',help='debrief map ID (must already be a saved map)')
+    parser.add_argument('--domain',default='localhost:8080',help='domain and port of the SARTopo / CalTopo Desktop server')
+    parser.add_argument('--workers',type=int,default=4,help='number of concurrent target map writers')
+    parser.add_argument('--coalesce',type=float,default=1.0,help='event coalescing window in seconds (negative: no coalescing)')
+    parser.add_argument('--server-crop',action='store_true',help='crop tracks with sts2.crop instead of locally')
+    parser.add_argument('--roaming-distance',type=float,default=10000,help='crop tracks of roaming teams (trailing dogs, trackers) to this many meters from the assignment; 0: crop to the boundary')
+    parser.add_argument('--simplify-scale',type=float,default=None,help='simplify tracks to the detail visible at this print scale (e.g. 24000 for 1:24000) before uploading them')
+    parser.add_argument('--duplicate-tracks',choices=['import','exact','near'],default='exact',help='skip tracks that are exact copies (or near-identical copies) of another track in the same outing')
+    parser.add_argument('--dmd-store',choices=['json','sqlite'],default='json',help='dmd persistence: json snapshot and journal files, or an SQLite database')
+    parser.add_argument('--sync-batching',action='store_true',help='handle the source map changes from each sync as one batch, and save dmd once per batch')
+    parser.add_argument('--record',default=None,help='record source map events to this file (see dmg_replay.py)')
+    parser.add_argument('--pdf-dir',default=None,help='directory for debrief PDFs; send SIGUSR1 to render all outings that changed since they were last rendered')
+    parser.add_argument('--auto-pdf',action='store_true',help='render the debrief PDF of each outing whenever it is ready (see --ready-settle)')
+    parser.add_argument('--ready-settle',type=float,default=300,help='an outing is ready for debrief once its boundary, tracks and clues have not changed for this many seconds')
+    parser.add_argument('--pdf-workers',type=int,default=4,help='number of debrief PDF rendering processes')
+    parser.add_argument('--tile-dir',default=None,help='local tile cache for debrief PDFs (<zoom>/<x>/<y>.jpg)')
+    parser.add_argument('--metrics-port',type=int,default=None,help='serve metrics at http://localhost:<port>/metrics (Prometheus text) and /stats (json)')
+    parser.add_argument('--profile-seconds',type=float,default=30,help='length of the profile capture started by SIGUSR2')
+    parser.add_argument('--cold-start',action='store_true',help='ignore the map cache from the previous run, and do a full sync and reconcile')
+    parser.add_argument('--log-level',default='INFO',help='DEBUG, INFO, WARNING or ERROR')
+    args=parser.parse_args()
+    if args.auto_pdf and not args.pdf_dir:
+        parser.error('--auto-pdf requires --pdf-dir')
+    options={
+        'localCrop':not args.server_crop,
+        'coalesceWindow':None if args.coalesce<0 else args.coalesce,
+        'writeWorkers':args.workers,
+        'logLevel':getattr(logging,args.log_level.upper()),
+        'domainAndPort':args.domain,
+        'recordFile':args.record,
+        'warmStart':not args.cold_start,
+        'pdfDir':args.pdf_dir,
+        'pdfWorkers':args.pdf_workers,
+        'tileDir':args.tile_dir,
+        'roamingDistance':args.roaming_distance,
+        'simplifyScale':args.simplify_scale,
+        'duplicateTracks':args.duplicate_tracks,
+        'dmdBackend':args.dmd_store,
+        'syncBatching':args.sync_batching,
+        'readySettle':args.ready_settle,
+        'autoPdf':args.auto_pdf,
+        'metricsPort':args.metrics_port,
+        'profileSeconds':args.profile_seconds}
+    bg=sartopo_bg(args.sourceMapID,args.targetMapID,options)
+    bg.start()
+    bg.runForever()
+
 if __name__ == '__main__':
-	bg = sartopo_bg('9B1','UG1')
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -0,0 +1,5 @@
+import sys
+from os import path
+
+# the dmg modules are at the top level of the repo
+sys.path.insert(0,path.dirname(path.dirname(path.abspath(__file__))))
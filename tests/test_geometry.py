@@ -0,0 +1,209 @@
+import numpy as np
+import pytest
+import shapely
+from dmg_geometry import CropBoundary,DistanceBoundary,cropLine,GridIndex,simplifyLine,TrackFingerprint
+
+# cropLine replaces the server-side crop (SartopoSession.crop), so its results must match
+#  SartopoSession._intersection2, which the server crop uses, on a corpus of random
+#  boundary / track pairs
+#
+# documented difference: a segment with both vertices outside the boundary, that passes through
+#  it, becomes a two-point piece; _intersection2 returns its points in boundary ring order, and
+#  cropLine returns them in track order, so two-point pieces may be reversed
+
+beyond=0.001
+
+def serverCrop(session,poly,coords):
+    bg=session._buffer2(shapely.Polygon(poly),beyond)
+    tg=shapely.LineString(session._removeSpurs(coords))
+    if not bg.intersects(tg):
+        return []
+    r=session._intersection2(tg,bg)
+    if r is None:
+        return []
+    if isinstance(r,shapely.LineString):
+        return [list(map(list,r.coords))]
+    return [list(map(list,g.coords)) for g in r.geoms]
+
+def samePieces(expected,actual):
+    if len(expected)!=len(actual):
+        return False
+    for (e,a) in zip(expected,actual):
+        if len(e)!=len(a):
+            return False
+        if not np.allclose(e,a,atol=1e-9) and not (len(e)==2 and np.allclose(e[::-1],a,atol=1e-9)):
+            return False
+    return True
+
+def randomCase(rng):
+    k=rng.integers(4,12)
+    ang=np.sort(rng.uniform(0,2*np.pi,k))
+    rad=rng.uniform(0.02,0.06,k)
+    poly=np.c_[-120+rad*np.cos(ang),39+rad*np.sin(ang)].tolist()
+    poly.append(poly[0])
+    coords=(np.cumsum(rng.normal(0,0.01,(rng.integers(5,80),2)),axis=0)+[-120.03,38.98]).tolist()
+    return (poly,coords)
+
+def testCropLineMatchesServerCrop():
+    sartopo_python=pytest.importorskip('sartopo_python.sartopo_python')
+    session=sartopo_python.SartopoSession.__new__(sartopo_python.SartopoSession) # no server connection
+    session.mapID=None # so that __del__ works without __init__
+    session.sync=False
+    rng=np.random.default_rng(1)
+    compared=0
+    for trial in range(400):
+        (poly,coords)=randomCase(rng)
+        try:
+            expected=serverCrop(session,poly,coords)
+        except Exception: # _intersection2 can't handle some geometries; nothing to compare
+            continue
+        actual=cropLine(coords,CropBoundary({'type':'Polygon','coordinates':[poly]},beyond))
+        assert samePieces(expected,actual),'trial '+str(trial)+': '+str([len(p) for p in expected])+' != '+str([len(p) for p in actual])
+        compared+=1
+    assert compared>=300
+
+def testCropLineInterpolatesExtraElements():
+    square=[[0,0],[0.01,0],[0.01,0.01],[0,0.01],[0,0]]
+    boundary=CropBoundary({'type':'Polygon','coordinates':[square]},0)
+    # elevation and timestamp of the crossing points are interpolated
+    pieces=cropLine([[-0.01,0.005,100,1000],[0.005,0.005,200,2000],[0.02,0.005,300,3000]],boundary)
+    assert len(pieces)==1
+    assert np.allclose(pieces[0],[[0,0.005,166.666667,1666.666667],[0.005,0.005,200,2000],[0.01,0.005,233.333333,2333.333333]])
+
+def testCropLineOutside():
+    square=[[0,0],[0.01,0],[0.01,0.01],[0,0.01],[0,0]]
+    boundary=CropBoundary({'type':'Polygon','coordinates':[square]},0)
+    assert cropLine([[0.02,0.02],[0.03,0.03]],boundary)==[]
+    assert cropLine([[0.005,0.005]],boundary)==[]
+
+def testDistanceBoundaryCropsAtRadius():
+    # roaming assignment: a line segment along the equator; one degree of latitude or (at the
+    #  equator) longitude is ky meters
+    ky=np.radians(1)*DistanceBoundary.earthRadius
+    boundary=DistanceBoundary({'type':'LineString','coordinates':[[0,0],[0.01,0]]},1000)
+    # a track going north from the middle of the line ends its piece 1000m from the line
+    pieces=cropLine([[0.005,y] for y in np.linspace(0,0.03,31)],boundary)
+    assert len(pieces)==1
+    assert abs(pieces[0][-1][1]*ky-1000)<0.1
+    # a track going east, 900m north of the line, is inside from 436m before the start of the line
+    #  (sqrt(1000^2-900^2)) to 436m after its end
+    pieces=cropLine([[-0.02,900/ky],[0.03,900/ky]],boundary)
+    assert len(pieces)==1
+    assert np.allclose([p[0]*ky for p in pieces[0]],[-np.sqrt(1000**2-900**2),0.01*ky+np.sqrt(1000**2-900**2)],atol=0.1)
+    # 1100m north, the track never gets close enough
+    assert cropLine([[-0.02,1100/ky],[0.03,1100/ky]],boundary)==[]
+    assert boundary.containsPoint([0.005,999/ky]) and not boundary.containsPoint([0.005,1001/ky])
+    # inside a polygon assignment, the distance is 0
+    square=DistanceBoundary({'type':'Polygon','coordinates':[[[0,0],[0.1,0],[0.1,0.1],[0,0.1],[0,0]]]},1000)
+    assert square.distances(np.asarray([[0.05,0.05],[0.05,0.1+500/ky]]),exact=True).tolist()==pytest.approx([0,500],abs=0.1)
+
+# segmentDistances - distances (meters) from the points p to the segment a-b, all in local meters
+def segmentDistances(p,a,b):
+    ab=b-a
+    t=np.clip(((p-a)@ab)/max(ab@ab,1e-12),0,1)
+    return np.hypot(*(p-a-t[:,None]*ab).T)
+
+# recursiveSimplify - textbook recursive Douglas-Peucker, for comparison; returns the kept indices
+def recursiveSimplify(xy,tolerance,i=0,j=None):
+    j=len(xy)-1 if j is None else j
+    if j<=i+1:
+        return [i,j] if j>i else [i]
+    d=segmentDistances(xy[i+1:j],xy[i],xy[j])
+    k=i+1+int(d.argmax())
+    if d.max()<=tolerance:
+        return [i,j]
+    return recursiveSimplify(xy,tolerance,i,k)[:-1]+recursiveSimplify(xy,tolerance,k,j)
+
+def testSimplifyLine():
+    rng=np.random.default_rng(3)
+    ky=np.radians(1)*DistanceBoundary.earthRadius
+    for trial in range(20):
+        n=int(rng.integers(3,400))
+        lonLat=np.cumsum(rng.normal(0,0.0002,(n,2)),axis=0)+[-120,39]
+        coords=[[lon,lat,1500+i,1600000000000+i*1000] for (i,(lon,lat)) in enumerate(lonLat.tolist())]
+        tolerance=float(rng.uniform(1,30))
+        simplified=simplifyLine(coords,tolerance)
+        # endpoints are kept, and kept vertices are unchanged, with their extra elements
+        assert simplified[0]==coords[0] and simplified[-1]==coords[-1]
+        kept=[coords.index(c) for c in simplified]
+        assert kept==sorted(kept)
+        # same vertices as the recursive algorithm (on the same local projection)
+        xy=np.column_stack(((lonLat[:,0]-lonLat[0,0])*ky*np.cos(np.radians(lonLat[:,1].mean())),(lonLat[:,1]-lonLat[0,1])*ky))
+        assert kept==recursiveSimplify(xy,tolerance)
+        # every removed vertex is within tolerance of the simplified segment that replaces it
+        for (i,j) in zip(kept[:-1],kept[1:]):
+            if j>i+1:
+                assert segmentDistances(xy[i+1:j],xy[i],xy[j]).max()<=tolerance
+    # quantizing rounds lon and lat only
+    assert simplifyLine([[-120.1234567,39.7654321,1500]],5,5)==[[-120.12346,39.76543,1500]]
+    # short lines are not changed
+    assert simplifyLine([[0,0],[1,1]],10)==[[0,0],[1,1]] and simplifyLine([],10)==[]
+
+def testTrackFingerprint():
+    rng=np.random.default_rng(4)
+    ky=np.radians(1)*DistanceBoundary.earthRadius
+    lonLat=np.cumsum(rng.normal(0,0.0003,(300,2)),axis=0)+[-120,39]
+    track=[[lon,lat,1500,1600000000000+i*1000] for (i,(lon,lat)) in enumerate(lonLat.tolist())]
+    fp=TrackFingerprint(track)
+    # the same log imported again, without elevation and time: an exact copy
+    copy=TrackFingerprint([c[:2] for c in track])
+    assert copy.hash==fp.hash and copy.matches(fp) and fp.matches(copy,near=True)
+    # a second device carried by the same team: different vertices, a few meters of GPS noise
+    mid=(lonLat[:-1]+lonLat[1:])/2
+    other=np.insert(lonLat,np.arange(1,300),mid,axis=0)+rng.normal(0,3/ky,(599,2))
+    near=TrackFingerprint(other.tolist())
+    assert near.hash!=fp.hash
+    assert not near.matches(fp) and near.matches(fp,near=True) and fp.matches(near,near=True)
+    # different tracks: another walk in the same area, half of the same walk, and the same walk
+    #  offset by 50m
+    for coords in [np.cumsum(rng.normal(0,0.0003,(300,2)),axis=0)+[-120,39],lonLat[:150],lonLat+[0,50/ky]]:
+        assert not TrackFingerprint(coords.tolist()).matches(fp,near=True)
+        assert not fp.matches(TrackFingerprint(coords.tolist()),near=True)
+
+# bruteForceQuery - the pieces of every geometry (split the same way as GridIndex.pieces) whose
+#  bounding box intersects the extent
+def bruteForceQuery(geometries,extent,pieceSize):
+    rval=[]
+    for (id,g) in geometries.items():
+        gc=g['coordinates']
+        if g['type']=='Point':
+            pieces=[gc]
+        else:
+            gc=gc[0] if g['type']=='Polygon' else gc
+            pieces=[gc[i:i+pieceSize+1] for i in range(0,max(1,len(gc)-1),pieceSize)]
+        for piece in pieces:
+            a=np.asarray([piece] if g['type']=='Point' else piece)
+            if a[:,0].min()<=extent[2] and a[:,0].max()>=extent[0] and a[:,1].min()<=extent[3] and a[:,1].max()>=extent[1]:
+                rval.append((id,piece))
+    return sorted(rval)
+
+def testGridIndexMatchesBruteForce():
+    rng=np.random.default_rng(2)
+    index=GridIndex(cellSize=0.01,pieceSize=8,maxCells=40)
+    geometries={}
+    def randomGeometry():
+        kind=rng.integers(3)
+        if kind==0:
+            return {'type':'Point','coordinates':rng.uniform(0,0.2,2).tolist()}
+        # some lines are long random walks, some are long straight lines that cover many cells
+        step=0.002 if rng.random()<0.8 else 0.05
+        coords=(np.cumsum(rng.normal(0,step,(rng.integers(2,60),2)),axis=0)+rng.uniform(0,0.2,2)).tolist()
+        if kind==1:
+            return {'type':'LineString','coordinates':coords}
+        return {'type':'Polygon','coordinates':[coords+[coords[0]]]}
+    for step in range(300):
+        id='f'+str(rng.integers(150))
+        if id in geometries and rng.random()<0.3:
+            index.remove(id)
+            del geometries[id]
+        else: # new feature, or a changed geometry
+            geometries[id]=randomGeometry()
+            index.insert(id,geometries[id])
+        if step%10==0:
+            for q in range(10):
+                (x,y)=rng.uniform(-0.05,0.25,2)
+                (w,h)=rng.uniform(0,0.1,2)
+                extent=(x,y,x+w,y+h)
+                assert sorted(index.query(extent))==bruteForceQuery(geometries,extent,8)
+    assert len(index)==len(geometries)
+    assert index.large # the long straight lines were kept out of the grid
@@ -0,0 +1,61 @@
+from dmg_readiness import ReadinessTracker
+
+def newTracker(descriptions,settle=300):
+    events=[]
+    tracker=ReadinessTracker(descriptions.get,lambda title,event,state:events.append((title,event)),settle=settle)
+    return (tracker,events)
+
+def outing(hash,tracks=1,uncropped=0,boundary=True,rendered=None):
+    return {'tracks':tracks,'uncropped':uncropped,'clues':0,'boundary':boundary,'hash':hash,'rendered':rendered}
+
+def check(tracker,now,*titles):
+    for title in titles:
+        tracker.touch(title)
+    tracker.check(now)
+
+def testReadyAfterSettle():
+    descriptions={'AA 101':outing('h1')}
+    (tracker,events)=newTracker(descriptions)
+    check(tracker,1000,'AA 101')
+    check(tracker,1299)
+    assert events==[] and tracker.isChanged('AA 101')
+    check(tracker,1300)
+    assert events==[('AA 101','ready')]
+    assert tracker.getStates()['AA 101']['ready']
+    # ready is emitted once per version of the content
+    check(tracker,1400,'AA 101')
+    assert events==[('AA 101','ready')]
+    # a change starts the settle time again
+    descriptions['AA 101']=outing('h2',tracks=2)
+    check(tracker,1500,'AA 101')
+    assert events[1:]==[('AA 101','changed')] and not tracker.getStates()['AA 101']['ready']
+    check(tracker,1799)
+    check(tracker,1800)
+    assert events[1:]==[('AA 101','changed'),('AA 101','ready')]
+    assert tracker.getStats()['readyEvents']==2
+
+def testNotReadyUntilComplete():
+    descriptions={'AA 101':outing('h1',uncropped=1),'AB 102':outing('h2',boundary=False),
+        'AC 103':outing('h3',tracks=0),'AD 104':outing('h4',rendered='h4')}
+    (tracker,events)=newTracker(descriptions)
+    check(tracker,0,*descriptions)
+    check(tracker,1000)
+    assert events==[]
+    assert not tracker.isChanged('AD 104') # already rendered
+    # the boundary arrives, and the waiting track is cropped: the content changed, so it has to
+    #  settle again
+    descriptions['AA 101']=outing('h5')
+    check(tracker,1100,'AA 101')
+    check(tracker,1399)
+    assert events==[('AA 101','changed')]
+    check(tracker,1400)
+    assert events==[('AA 101','changed'),('AA 101','ready')]
+
+def testDeletedOuting():
+    descriptions={'AA 101':outing('h1')}
+    (tracker,events)=newTracker(descriptions)
+    check(tracker,0,'AA 101')
+    del descriptions['AA 101']
+    check(tracker,100,'AA 101')
+    check(tracker,1000)
+    assert events==[] and tracker.getStates()=={}
@@ -0,0 +1,66 @@
+import re
+import pytest
+import dmg_fakesession
+from dmg_fakesession import FakeSession,newFeature
+from dmg_render import choosePrintLayout,computePrintExtent,pdfFileName
+from sartopo_bg import sartopo_bg
+
+sourceMapID='SRC01'
+targetMapID='TGT01'
+
+@pytest.fixture(autouse=True)
+def emptyMaps(tmp_path,monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    dmg_fakesession.clearMaps()
+    yield
+    dmg_fakesession.clearMaps()
+
+# checkPdf - check the structure of a PDF file written by dmg_render.PdfPage, and return the
+#  page sizes, as [width,height] from each page's MediaBox
+def checkPdf(fileName):
+    with open(fileName,'rb') as f:
+        data=f.read()
+    assert data.startswith(b'%PDF-')
+    assert data.endswith(b'%%EOF\n')
+    xref=int(re.search(rb'startxref\n(\d+)\n%%EOF\n$',data).group(1))
+    assert data[xref:].startswith(b'xref\n')
+    m=re.match(rb'xref\n0 (\d+)\n',data[xref:])
+    n=int(m.group(1))
+    entries=data[xref+m.end():].split(b'\n')[:n]
+    assert entries[0]==b'0000000000 65535 f '
+    for (i,entry) in enumerate(entries[1:],1):
+        offset=int(entry[:10])
+        assert entry.endswith(b' 00000 n ')
+        assert data[offset:].startswith(b'%d 0 obj\n'%i)
+    assert b'/Size %d'%n in data[xref:]
+    pages=re.findall(rb'/Type /Page /Parent \d+ 0 R /MediaBox \[0 0 (\d+) (\d+)\]',data)
+    assert re.search(rb'/Type /Pages /Kids \[[^\]]*\] /Count %d'%len(pages),data)
+    return [[int(w),int(h)] for (w,h) in pages]
+
+# a wide outing should be printed in landscape, and a tall one in portrait
+@pytest.mark.parametrize('width,height,orientation',[(0.04,0.01,'landscape'),(0.01,0.03,'portrait')])
+def testDebriefPdf(tmp_path,width,height,orientation):
+    (x0,y0)=(-120.0,39.0)
+    ring=[[x0,y0],[x0+width,y0],[x0+width,y0+height],[x0,y0+height],[x0,y0]]
+    track=[[x0+width*i/20,y0+height*(0.5+0.3*(-1)**i)] for i in range(21)]
+    src=FakeSession(mapID=sourceMapID)
+    src.put(newFeature('Assignment',{'type':'Polygon','coordinates':[ring]},title='AA 101',letter='AA',number='101'))
+    src.put(newFeature('Shape',{'type':'LineString','coordinates':track},title='AA101a',stroke='#FF0000'))
+    src.put(newFeature('Clue',{'type':'Point','coordinates':[x0+width/2,y0+height/2]},title='clue 1'))
+    pdfDir=tmp_path/'pdf'
+    pdfDir.mkdir()
+    bg=sartopo_bg(sourceMapID,targetMapID,{'coalesceWindow':None,'pdfDir':str(pdfDir),'pdfWorkers':1},
+        logLevel=None,sessionClass=FakeSession)
+    bg.start()
+    results=[]
+    pdfRendered=bg.renderQueue.resultCallback
+    bg.renderQueue.resultCallback=lambda result:(results.append(result),pdfRendered(result))
+    bg.requestPdf(['AA 101'])
+    assert bg.renderQueue.wait(60)
+    bg.stop()
+    assert len(results)==1 and not results[0].get('error')
+    layout=choosePrintLayout(computePrintExtent([ring,track]))
+    assert layout['orientation']==orientation
+    pages=checkPdf(pdfFileName(str(pdfDir),'AA 101'))
+    assert pages==[list(layout['pageSize'])]
+    assert (pages[0][0]>pages[0][1])==(orientation=='landscape')
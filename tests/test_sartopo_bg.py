@@ -0,0 +1,135 @@
+import math
+import pytest
+from functools import partial
+import dmg_fakesession
+from dmg_fakesession import FakeSession,newFeature
+from dmg_bench import generateIncident
+from sartopo_bg import sartopo_bg
+
+sourceMapID='SRC01'
+targetMapID='TGT01'
+
+@pytest.fixture(autouse=True)
+def emptyMaps(tmp_path,monkeypatch):
+    monkeypatch.chdir(tmp_path) # dmd and map cache files
+    dmg_fakesession.clearMaps()
+    yield
+    dmg_fakesession.clearMaps()
+
+# newBg - a sartopo_bg instance on the fake maps, with every source event handled as soon as it
+#  is received (no coalescing)
+def newBg(**options):
+    options.setdefault('coalesceWindow',None)
+    options.setdefault('sessionClass',FakeSession)
+    return sartopo_bg(sourceMapID,targetMapID,options,logLevel=None)
+
+def addAssignment(src,title,x0=-120.0,y0=39.0,size=0.02):
+    return src.put(newFeature('Assignment',
+        {'type':'Polygon','coordinates':[[[x0,y0],[x0+size,y0],[x0+size,y0+size],[x0,y0+size],[x0,y0]]]},
+        title=title,letter=title.split()[0],number=title.split()[1]))
+
+def addTrack(src,title,coords):
+    return src.put(newFeature('Shape',{'type':'LineString','coordinates':coords},
+        title=title,stroke='#FF0000',pattern='solid',**{'stroke-width':2,'stroke-opacity':1}))
+
+@pytest.mark.parametrize('warmStart',[True,False])
+def testRestartWritesNothing(warmStart):
+    src=FakeSession(mapID=sourceMapID)
+    for f in generateIncident(assignments=4,tracksPerTeam=2,vertices=100,clues=5,markers=3):
+        src.put(f)
+    bg=newBg(warmStart=warmStart)
+    bg.start()
+    assert bg.sts2.getWriteCount()>0
+    bg.stop()
+    bg=newBg(warmStart=warmStart)
+    bg.start()
+    assert bg.sts2.getWriteCount()==0
+    assert bg.reconcile(dryRun=True)==[]
+    bg.stop()
+
+# curve - vertices i0 to i1-1 of a smooth track, about 2m apart, inside the assignment boundary,
+#  so that simplification removes most of them
+def curve(i0,i1):
+    return [[-119.995+0.00002*i,39.01+0.005*math.sin(i/150.0)] for i in range(i0,i1)]
+
+def testGrownSimplifiedTrackConvergesOnRestart():
+    src=FakeSession(mapID=sourceMapID)
+    addAssignment(src,'AA 101')
+    sid=addTrack(src,'AA101a',curve(0,200))
+    bg=newBg(simplifyScale=24000)
+    bg.start()
+    # a live track grows
+    for n in range(250,750,50):
+        bg.sts1.simulateEdit(sid,geometry={'type':'LineString','coordinates':curve(0,n)})
+    bg.writer.drain()
+    # the updates were handled incrementally, and the result is what a full import would give
+    assert bg.sts2.calls.get('delObject',0)==0
+    assert bg.reconcile(dryRun=True)==[]
+    bg.stop()
+    bg=newBg(simplifyScale=24000)
+    bg.start()
+    assert bg.sts2.getWriteCount()==0
+    assert bg.reconcile(dryRun=True)==[]
+    bg.stop()
+
+def testTrackGrowsIncrementallyAfterRestart():
+    src=FakeSession(mapID=sourceMapID)
+    addAssignment(src,'AA 101')
+    sid=addTrack(src,'AA101a',curve(0,200))
+    bg=newBg()
+    bg.start()
+    bg.stop()
+    bg=newBg()
+    bg.start()
+    bg.sts1.simulateEdit(sid,geometry={'type':'LineString','coordinates':curve(0,250)})
+    bg.writer.drain()
+    # the existing cropped line was extended, not deleted and imported again
+    assert bg.sts2.calls=={'editObject':1}
+    assert bg.reconcile(dryRun=True)==[]
+    bg.stop()
+
+def testAddThenDeleteInOneWindowWritesNothing():
+    src=FakeSession(mapID=sourceMapID)
+    addAssignment(src,'AA 101')
+    bg=newBg(coalesceWindow=10)
+    bg.start()
+    writes=bg.sts2.getWriteCount()
+    clue=newFeature('Clue',{'type':'Point','coordinates':[-119.99,39.01]},title='clue 1')
+    track=newFeature('Shape',{'type':'LineString','coordinates':curve(0,100)},title='AA101a',stroke='#FF0000')
+    for f in [clue,track]:
+        bg.sts1.simulateNew(f)
+        bg.sts1.simulateEdit(f['id'],properties=dict(f['properties'],description='edited'))
+        bg.sts1.simulateDelete(f['id'])
+    assert bg.eventQueue.flush(timeout=5)
+    bg.writer.drain()
+    assert bg.eventQueue.getStats()['cancelled']==2
+    assert bg.sts2.getWriteCount()==writes
+    assert clue['id'] not in bg.dmd['corr'] and track['id'] not in bg.dmd['corr']
+    bg.stop()
+
+def testRetitledTrackEventsStayInOrder():
+    src=FakeSession(mapID=sourceMapID)
+    addAssignment(src,'AA 101')
+    addAssignment(src,'AB 102')
+    sid=addTrack(src,'AA101a',curve(0,200))
+    bg=newBg(sessionClass=partial(FakeSession,latency=0.02))
+    bg.start()
+    handled=[]
+    def recording(kind,handler,f):
+        handled.append(kind+' started')
+        handler(f)
+        handled.append(kind+' done')
+    for kind in ['geometry','property']:
+        bg.sourceEventHandlers[kind]=partial(recording,kind,bg.sourceEventHandlers[kind])
+    # the geometry update is handled under key AA 101, and the retitle under key AB 102, which
+    #  must wait for it
+    bg.sts1.simulateEdit(sid,geometry={'type':'LineString','coordinates':curve(0,300)})
+    p=dict(bg.sts1.getFeature(id=sid)['properties'],title='AB102a')
+    bg.sts1.simulateEdit(sid,properties=p)
+    bg.writer.drain()
+    assert handled==['geometry started','geometry done','property started','property done']
+    tids=bg.dmd['corr'][sid]
+    assert tids and set(tids)<=set(sum(bg.dmd['outings']['AB 102']['tids'],[]))
+    assert not sum(bg.dmd['outings']['AA 101']['tids'],[])
+    assert bg.reconcile(dryRun=True)==[]
+    bg.stop()
@@ -0,0 +1,125 @@
+import copy
+import json
+from dmg_store import DmdJournal,DmdDatabase
+
+def newDmd():
+    return {'outings':{},'corr':{},'dups':{}}
+
+def addOuting(dmd,title,n):
+    dmd['outings'][title]={'bid':'b'+title,'fid':'f'+title,'sid':'s'+title,'cids':[],
+        'tids':[['t'+title+str(i)] for i in range(n)],'utids':[]}
+
+# record each change the way sartopo_bg.journalDmd does, writing a snapshot when asked to
+def change(store,dmd,section,key,value):
+    if value is None:
+        dmd[section].pop(key,None)
+    else:
+        dmd[section][key]=value
+    if store.record(dmd,section,key):
+        store.writeSnapshot(dmd)
+
+def testJournalReplay(tmp_path):
+    base=str(tmp_path/'S_T')
+    store=DmdJournal(base)
+    dmd=newDmd()
+    addOuting(dmd,'AA 101',2)
+    store.record(dmd,'outings','AA 101')
+    change(store,dmd,'corr','sid1',['tid1','tid2'])
+    change(store,dmd,'corr','sid2',['tid3'])
+    change(store,dmd,'corr','sid1',None)
+    change(store,dmd,'dups','sid4','sid2')
+    store.close()
+    assert DmdJournal(base).load()==dmd
+
+def testJournalReplayAfterCompaction(tmp_path):
+    base=str(tmp_path/'S_T')
+    store=DmdJournal(base,compactEvery=5)
+    dmd=newDmd()
+    for i in range(23):
+        change(store,dmd,'corr','sid'+str(i),['tid'+str(i)])
+        if i%3==0:
+            change(store,dmd,'corr','sid'+str(i//2),None)
+    assert store.recordCount<5 # snapshots were written, and the journal was truncated each time
+    store.close()
+    assert DmdJournal(base).load()==dmd
+
+def testJournalReplayOnNewerSnapshot(tmp_path):
+    # crash after a snapshot was moved into place, but before the journal was truncated: the
+    #  journal records are already in the snapshot, and replaying them again changes nothing
+    base=str(tmp_path/'S_T')
+    store=DmdJournal(base)
+    dmd=newDmd()
+    for i in range(5):
+        change(store,dmd,'corr','sid'+str(i),['tid'+str(i)])
+    change(store,dmd,'corr','sid0',None)
+    store.close()
+    with open(base+'.json','w') as snapshotFile:
+        json.dump(dmd,snapshotFile)
+    assert DmdJournal(base).load()==dmd
+
+def testJournalTornLastLine(tmp_path):
+    base=str(tmp_path/'S_T')
+    store=DmdJournal(base)
+    dmd=newDmd()
+    change(store,dmd,'corr','sid1',['tid1'])
+    change(store,dmd,'corr','sid2',['tid2'])
+    store.close()
+    saved=copy.deepcopy(dmd)
+    with open(base+'_journal.jsonl','a') as journalFile:
+        journalFile.write('{"s":"corr","k":"sid3","v":["ti') # crash during append
+    store=DmdJournal(base)
+    assert store.load()==saved
+    # the next record after a restart is not lost by being appended to the torn line
+    change(store,saved,'corr','sid4',['tid4'])
+    store.close()
+    assert DmdJournal(base).load()==saved
+
+# a dmd with the shapes that a plain table layout could lose: empty lines of tids (in the middle
+#  and at the end), an empty correspondence, extra outing keys, and uncropped tracks
+def awkwardDmd():
+    dmd=newDmd()
+    addOuting(dmd,'AA 101',3)
+    dmd['outings']['AA 101']['tids'][1]=[]
+    dmd['outings']['AA 101']['tids'].append([])
+    dmd['outings']['AA 101']['cids']=['c1','c2']
+    dmd['outings']['AA 101']['rendered']='0123abcd'
+    dmd['outings']['AB 102']={'bid':None,'fid':'fAB','sid':None,'cids':[],'tids':[],'utids':['u1','u2']}
+    addOuting(dmd,'AC 103',0)
+    dmd['outings']['AC 103']['tids']=[[]]
+    dmd['corr']={'sid1':['tAA 1010'],'sid2':[],'sid3':['x','y','z']}
+    dmd['dups']={'sid5':'sid1'}
+    return dmd
+
+def testDatabaseRoundTrip(tmp_path):
+    base=str(tmp_path/'S_T')
+    dmd=awkwardDmd()
+    store=DmdDatabase(base)
+    for (section,entries) in dmd.items():
+        for key in entries:
+            store.record(dmd,section,key)
+    store.close()
+    assert DmdDatabase(base).load()==dmd
+
+def testDatabaseChangesAndSnapshot(tmp_path):
+    base=str(tmp_path/'S_T')
+    dmd=awkwardDmd()
+    store=DmdDatabase(base,batched=True)
+    store.writeSnapshot(dmd)
+    change(store,dmd,'outings','AA 101',None)
+    change(store,dmd,'corr','sid3',[])
+    change(store,dmd,'corr','sid1',None)
+    change(store,dmd,'dups','sid6','sid3')
+    dmd['outings']['AC 103']['tids'].append([])
+    change(store,dmd,'outings','AC 103',dmd['outings']['AC 103'])
+    store.flush()
+    store.close()
+    assert DmdDatabase(base).load()==dmd
+
+def testDatabaseReadsJournal(tmp_path):
+    # switching an existing map pair to the sqlite store keeps its dmd
+    base=str(tmp_path/'S_T')
+    dmd=awkwardDmd()
+    journal=DmdJournal(base)
+    journal.writeSnapshot(dmd)
+    journal.close()
+    assert DmdDatabase(base).load()==dmd
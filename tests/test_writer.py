@@ -0,0 +1,61 @@
+import random
+import threading
+import time
+from dmg_writer import TargetWriter
+
+def testSameKeyRunsInSubmissionOrder():
+    writer=TargetWriter(maxWorkers=4)
+    rng=random.Random(0)
+    done={} # key = task key, val = list of task numbers in the order they ran
+    lock=threading.Lock()
+    def task(key,i):
+        time.sleep(rng.uniform(0,0.002))
+        with lock:
+            done.setdefault(key,[]).append(i)
+    for i in range(200):
+        key='k'+str(i%5)
+        writer.submit(key,task,key,i)
+    assert writer.drain(timeout=10)
+    assert sorted(done.keys())==['k'+str(j) for j in range(5)]
+    for (key,order) in done.items():
+        assert order==sorted(order) and len(order)==40
+    writer.shutdown()
+
+def testSubmitAfterWaitsForOtherKey():
+    # a track moved from outing AA 101 to AB 102: its event under the new key must not run
+    #  before its pending event under the old key, even though nothing else is running for AB 102
+    writer=TargetWriter(maxWorkers=4)
+    release=threading.Event()
+    ran=[]
+    first=writer.submit('AA 101',lambda:(release.wait(5),ran.append('old key')))
+    second=writer.submitAfter(first,'AB 102',ran.append,'new key')
+    other=writer.submit('AB 102',ran.append,'other')
+    other.result(timeout=5)
+    time.sleep(0.05)
+    assert ran==['other'] and not second.done()
+    release.set()
+    second.result(timeout=5)
+    assert ran==['other','old key','new key']
+    # a task submitted after an already finished task runs right away
+    assert writer.submitAfter(second,'AC 103',lambda:'done').result(timeout=5)=='done'
+    writer.shutdown()
+
+def testSubmitAfterWithoutPool():
+    writer=TargetWriter(maxWorkers=1)
+    ran=[]
+    first=writer.submit('AA 101',ran.append,'old key')
+    second=writer.submitAfter(first,'AB 102',ran.append,'new key')
+    assert second.done() and ran==['old key','new key']
+
+def testDrainTimeout():
+    writer=TargetWriter(maxWorkers=2)
+    release=threading.Event()
+    writer.submit('AA 101',release.wait,5)
+    t0=time.time()
+    assert writer.drain(timeout=0.1) is False
+    assert 0.1<=time.time()-t0<1
+    assert writer.getStats()['outstanding']==1
+    release.set()
+    assert writer.drain(timeout=5) is True
+    assert writer.getStats()['outstanding']==0
+    writer.shutdown()